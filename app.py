@@ -1,16 +1,59 @@
+import atexit
+import bisect
+import contextlib
+import cProfile
 import csv
+import dataclasses
+import gzip
+import hashlib
+import io
+import json
+import logging
 import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+import click
+import numpy as np
 import pandas as pd
-from flask import Flask, render_template, request, redirect, url_for, jsonify, session, make_response
-from datetime import date
+from flask import Flask, render_template, request, redirect, url_for, jsonify, session, make_response, Response, stream_with_context
+from flask import g, has_request_context, before_render_template, template_rendered
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.datastructures import MultiDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timezone
+from typing import Optional
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, writes are then only serialized within one process
+    fcntl = None
+
+try:
+    import brotli
+except ImportError:
+    # Responses are then compressed with gzip only, see compress_response
+    brotli = None
+
+try:
+    import pyarrow
+    import pyarrow.feather
+    import pyarrow.parquet
+except ImportError:
+    # Only needed for the binary snapshot formats, see SNAPSHOT_FORMAT
+    pyarrow = None
 
 app = Flask(__name__)
 app.secret_key = "test"
 
 VALID_USERS = ["user1", "user2", "user3"]
 
-# Path to the CSV files - consider using relative paths or environment variables
-CSV_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+# Path to the CSV files, CSV_DIR in the environment points the app at another
+# data directory (benchmark.py uses that for its generated ledgers)
+CSV_DIR = os.environ.get('CSV_DIR') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
 os.makedirs(CSV_DIR, exist_ok=True)  # Create directory if it doesn't exist
 
 bets_csv = os.path.join(CSV_DIR, 'bets.csv')
@@ -18,144 +61,2944 @@ gamble_csv = os.path.join(CSV_DIR, 'gambling.csv')
 websites_csv = os.path.join(CSV_DIR, 'websites.csv')
 machines_csv = os.path.join(CSV_DIR, 'machines.csv')
 bank_csv = os.path.join(CSV_DIR, 'bank.csv')
+gamble_journal = os.path.join(CSV_DIR, 'gambling.journal')
+bank_journal = os.path.join(CSV_DIR, 'bank.journal')
+bets_journal = os.path.join(CSV_DIR, 'bets.journal')
+# Held while writing, shared by all worker processes
+storage_lock_file = os.path.join(CSV_DIR, 'storage.lock')
+# Highest id handed out per table, so ids are never reused
+sequences_json = os.path.join(CSV_DIR, 'sequences.json')
+
+# Storage backend: 'csv' (files in CSV_DIR), 'sharded' (the same files, but
+# one set per user in shards_dir, see ShardedStorage) or 'sqlite' (embedded
+# database). Import existing CSV data into SQLite once with
+# `flask --app app import-csv`.
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'csv')
+shards_dir = os.path.join(CSV_DIR, 'users')
+# Change history of each user, see ChangeHistory
+history_dir = os.path.join(CSV_DIR, 'history')
+sqlite_path = os.environ.get('SQLITE_PATH', os.path.join(CSV_DIR, 'gamba.sqlite3'))
+
+# Snapshot format of the csv backend: 'csv', or a binary columnar format with
+# a fixed schema, 'parquet' or 'feather' (Arrow IPC, memory-mapped when read).
+# The binary formats need pyarrow. CSV stays the import/export format, see
+# `flask --app app write-snapshots`.
+SNAPSHOT_FORMAT = os.environ.get('SNAPSHOT_FORMAT', 'csv')
+SNAPSHOT_EXTENSIONS = {'csv': '.csv', 'parquet': '.parquet', 'feather': '.arrow'}
+
+# Saved running totals per user and site, see get_user_aggregates
+aggregates_json = os.path.join(CSV_DIR, 'aggregates.json')
+
+# Request instrumentation, off by default: METRICS_ENABLED=1 turns on /metrics
+# and a JSON log line per request. PROFILE_SLOW_MS additionally runs every
+# request under cProfile and dumps the profiles of requests slower than that
+# many milliseconds to PROFILE_DIR.
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '').lower() not in ('', '0', 'false', 'no')
+PROFILE_SLOW_MS = float(os.environ.get('PROFILE_SLOW_MS') or 0)
+PROFILE_DIR = os.environ.get('PROFILE_DIR', os.path.join(CSV_DIR, 'profiles'))
+
+# JSON and HTML responses of at least this many bytes are compressed with
+# brotli (if installed) or gzip for clients that accept it
+COMPRESS_MIN_BYTES = int(os.environ.get('COMPRESS_MIN_BYTES', 1024))
+COMPRESS_MIMETYPES = ('application/json', 'text/html')
+
+# Every row carries a version that goes up by one on each edit, see StaleRowError
+GAMBLE_COLUMNS = ['id', 'date', 'website', 'machine', 'win', 'free_win',
+                  'free_win_m', 'note', 'start_amount', 'end_amount', 'user', 'profit', 'version']
+GAMBLE_NUMERIC_COLUMNS = ['id', 'win', 'free_win', 'start_amount', 'end_amount', 'profit', 'version']
+BANK_COLUMNS = ['id', 'date', 'type', 'amount', 'site', 'user', 'version']
+BANK_NUMERIC_COLUMNS = ['id', 'amount', 'version']
+
+# Matched bets, one row per back bet at a site laid off on the exchange. The
+# inputs are kept, the other columns are worked out from them, see bet_values.
+# Bets placed for the same offer share a ref.
+BET_COLUMNS = ['id', 'date', 'site', 'bet', 'kind', 'back_stake', 'back_odds', 'lay_odds', 'commission',
+               'result', 'ref', 'note', 'lay_stake', 'liability', 'back_profit', 'lay_profit',
+               'qualifying_loss', 'profit', 'roi', 'user', 'version']
+BET_DERIVED_COLUMNS = ['lay_stake', 'liability', 'back_profit', 'lay_profit', 'qualifying_loss', 'profit', 'roi']
+BET_NUMERIC_COLUMNS = ['id', 'back_stake', 'back_odds', 'lay_odds', 'commission'] + BET_DERIVED_COLUMNS + ['version']
+# A qualifying bet is placed with the user's own money, the stake of a free
+# bet isn't paid out with the winnings
+BET_KINDS = ['qualifying', 'free']
+# Which side of a settled bet won, '' while it is open
+BET_RESULTS = ['back', 'lay']
+# Exchange commission on lay winnings, for bets that don't give their own
+BET_COMMISSION = float(os.environ.get('BET_COMMISSION', 0.05))
+
+# Type of date fields. Record classes can't write Optional[date] because
+# their field named date hides datetime.date in the class body.
+OptionalDate = Optional[date]
+
+# Kind of value held by a record field of each annotated type. Optional
+# numbers (the amounts of a gamble) can be left out, which isn't the same as 0.
+FIELD_KINDS = {int: 'integer', float: 'number', Optional[float]: 'optional number', str: 'text',
+               OptionalDate: 'date'}
+
+# Convert one value from a form, a JSON edit or the store to a kind of field:
+# numbers become floats (0.0 when empty or not a number), optional numbers
+# floats or None, integers ints, dates datetime.date (None when missing) and
+# text str ('' when missing)
+def coerce_value(kind, value):
+    if kind == 'date':
+        text = format_date_for_storage(value)
+        return datetime.strptime(text, DATE_FORMATS['iso']).date() if text else None
+    if kind == 'text':
+        return '' if value is None or (pd.api.types.is_scalar(value) and pd.isna(value)) else str(value)
+    if kind == 'optional number':
+        try:
+            number = float(value)
+        except (TypeError, ValueError):
+            return None
+        return number if number == number else None
+    try:
+        number = float(value)
+        if number != number:
+            number = 0.0
+        return int(number) if kind == 'integer' else number
+    except (TypeError, ValueError, OverflowError):
+        return 0 if kind == 'integer' else 0.0
+
+# Convert a whole column the way coerce_value converts one value, except that
+# dates stay datetime64 with NaT for missing ones and optional numbers float
+# with NaN
+def coerce_column(kind, values):
+    if kind == 'date':
+        return parse_dates(values)
+    if kind == 'text':
+        values = pd.Series(values, dtype=object)
+        return values.where(values.notna(), '').astype(str)
+    if kind == 'optional number':
+        return pd.to_numeric(pd.Series(values, dtype=object), errors='coerce').astype(float)
+    numbers = pd.to_numeric(pd.Series(values), errors='coerce').fillna(0)
+    return numbers.astype(int) if kind == 'integer' else numbers.astype(float)
+
+# A single row of a table. Subclasses are slotted dataclasses (see
+# record_type), so a record takes a fraction of the memory of a dict or a
+# DataFrame row and its fields always have the types their annotations say.
+class Record:
+    __slots__ = ()
+
+    # Record of a row from the store, a dict of column values. Missing
+    # fields are left at their defaults.
+    @classmethod
+    def from_row(cls, row):
+        return cls(**{name: cls.coerce_field(name, row[name]) for name in cls.kinds if name in row})
+
+    # A value for one field. Blank values ('', None or NaN) take the field's
+    # default, so a bet without a commission pays BET_COMMISSION the way
+    # prepare_bets fills it in.
+    @classmethod
+    def coerce_field(cls, name, value):
+        if pd.api.types.is_scalar(value) and (pd.isna(value) or value == ''):
+            return cls.defaults[name]
+        return coerce_value(cls.kinds[name], value)
+
+    # Records of every row of a DataFrame, converted a column at a time
+    @classmethod
+    def from_frame(cls, df):
+        columns = []
+        for name, kind in cls.kinds.items():
+            if name not in df.columns:
+                columns.append([cls.defaults[name]] * len(df))
+            elif kind == 'date':
+                dates = coerce_column(kind, df[name])
+                columns.append(dates.dt.date.astype(object).where(dates.notna(), None).tolist())
+            elif kind == 'optional number':
+                numbers = coerce_column(kind, df[name])
+                columns.append(numbers.astype(object).where(numbers.notna(), None).tolist())
+            else:
+                columns.append(coerce_column(kind, df[name]).tolist())
+        return [cls(*values) for values in zip(*columns)]
+
+    # The given fields of data (form data or a JSON object) converted for
+    # storing, leaving out the ones data doesn't have. Returns {field: value}
+    # for insert_rows and update_rows.
+    @classmethod
+    def coerce_fields(cls, data, names):
+        return {name: cls.coerce_field(name, data[name]) for name in names if name in data}
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.kinds}
+
+    # JSON-ready values, with dates as YYYY-MM-DD and '' for a missing date like json_records
+    def to_json(self):
+        values = self.to_dict()
+        for name, kind in self.kinds.items():
+            if kind == 'date':
+                values[name] = values[name].strftime(DATE_FORMATS['iso']) if values[name] else ''
+        return values
+
+# Turn a Record subclass into a slotted dataclass and note the kind and
+# default of each field
+def record_type(cls):
+    cls = dataclasses.dataclass(slots=True)(cls)
+    cls.kinds = {field.name: FIELD_KINDS[field.type] for field in dataclasses.fields(cls)}
+    cls.defaults = {field.name: field.default for field in dataclasses.fields(cls)}
+    return cls
+
+@record_type
+class Gamble(Record):
+    id: int = 0
+    date: OptionalDate = None
+    website: str = ''
+    machine: str = ''
+    win: float = 0.0
+    free_win: float = 0.0
+    free_win_m: str = ''
+    note: str = ''
+    start_amount: Optional[float] = None
+    end_amount: Optional[float] = None
+    f_start_amount: Optional[float] = None
+    f_end_amount: Optional[float] = None
+    user: str = ''
+    profit: float = 0.0
+    version: int = 0
+
+    # Profit is always win + free_win, like prepare_gambles makes it
+    def __post_init__(self):
+        self.profit = self.win + self.free_win
+
+@record_type
+class BankTransaction(Record):
+    id: int = 0
+    date: OptionalDate = None
+    type: str = ''
+    amount: float = 0.0
+    site: str = ''
+    user: str = ''
+    version: int = 0
+
+@record_type
+class Bet(Record):
+    id: int = 0
+    date: OptionalDate = None
+    site: str = ''
+    bet: str = ''
+    kind: str = 'qualifying'
+    back_stake: float = 0.0
+    back_odds: float = 0.0
+    lay_odds: float = 0.0
+    commission: float = BET_COMMISSION
+    result: str = ''
+    ref: str = ''
+    note: str = ''
+    lay_stake: float = 0.0
+    liability: float = 0.0
+    back_profit: float = 0.0
+    lay_profit: float = 0.0
+    qualifying_loss: float = 0.0
+    profit: float = 0.0
+    roi: float = 0.0
+    user: str = ''
+    version: int = 0
+
+    # The derived values always follow the inputs, like prepare_bets makes them
+    def __post_init__(self):
+        values = bet_values(self.kind, self.result, self.back_stake, self.back_odds, self.lay_odds, self.commission)
+        for name, value in values.items():
+            setattr(self, name, float(value))
+
+# Fields of a gamble or a bank transaction a user can set, the rest are
+# filled in by the storage layer
+GAMBLE_INPUT_FIELDS = [name for name in Gamble.kinds if name not in ('id', 'user', 'profit', 'version')]
+BANK_INPUT_FIELDS = ['date', 'type', 'amount', 'site']
+BET_INPUT_FIELDS = ['date', 'site', 'bet', 'kind', 'back_stake', 'back_odds', 'lay_odds', 'commission',
+                    'result', 'ref', 'note']
 
 # Initialize CSV files if they don't exist
 def initialize_csv_files():
     # Initialize gambling.csv
     if not os.path.exists(gamble_csv):
-        pd.DataFrame(columns=[
-            'id', 'date', 'website', 'machine', 'win', 'free_win', 
-            'free_win_m', 'note', 'start_amount', 'end_amount', 'profit'
-        ]).to_csv(gamble_csv, index=False)
+        pd.DataFrame(columns=GAMBLE_COLUMNS).to_csv(gamble_csv, index=False)
     
     # Initialize bank.csv if it doesn't exist
     if not os.path.exists(bank_csv):
-        pd.DataFrame(columns=['date', 'type', 'amount', 'site', 'user']).to_csv(bank_csv, index=False)
+        pd.DataFrame(columns=BANK_COLUMNS).to_csv(bank_csv, index=False)
+    
+    # Initialize bets.csv if it doesn't exist
+    if not os.path.exists(bets_csv):
+        pd.DataFrame(columns=BET_COLUMNS).to_csv(bets_csv, index=False)
     
     # Initialize other CSVs if needed
     for file_path, header in [
         (websites_csv, ['website']),
-        (machines_csv, ['machine']),
-        (bets_csv, ['id', 'date', 'bet', 'odds', 'stake', 'win', 'website', 'note'])
+        (machines_csv, ['machine'])
     ]:
         if not os.path.exists(file_path):
             pd.DataFrame(columns=header).to_csv(file_path, index=False)
 
-# Load gambles from the CSV file with optional user filtering
-# Update the load_gambles function to ensure profit column exists
-def load_gambles(user=None):
+# Inserts, edits and deletes are appended to a journal next to each CSV
+# snapshot instead of rewriting the whole file. Once the journal holds this
+# many records it is folded back into the snapshot.
+JOURNAL_COMPACT_THRESHOLD = 1000
+# A journal with fewer records, but at least JOURNAL_FLUSH_MIN_RECORDS, is
+# folded in this many milliseconds after it reached that size (0 turns that
+# off). Folding rewrites the whole snapshot while holding the lock reads take
+# too, so a handful of edits stays in the journal rather than stalling the
+# readers of a large table every few seconds; it is synced already and cheap
+# to replay. Pending records are also folded in when the process exits, see
+# flush_storage.
+JOURNAL_FLUSH_MS = int(os.environ.get('JOURNAL_FLUSH_MS', 30000))
+JOURNAL_FLUSH_MIN_RECORDS = int(os.environ.get('JOURNAL_FLUSH_MIN_RECORDS', 100))
+
+# Identify the current version of a file on disk, or None if it is missing
+def file_stamp(file_path):
     try:
-        if os.path.exists(gamble_csv):
-            df = pd.read_csv(gamble_csv)
-            
-            # Ensure all required columns exist
-            required_columns = ['id', 'date', 'website', 'machine', 'win', 
-                               'free_win', 'free_win_m', 'note', 'start_amount', 
-                               'end_amount', 'user', 'profit']
-            for col in required_columns:
-                if col not in df.columns:
-                    df[col] = ''
-            
-            # Ensure numeric columns are numeric
-            for col in ['id', 'win', 'free_win', 'start_amount', 'end_amount', 'profit']:
+        stat = os.stat(file_path)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+# Text columns are kept as plain object columns so that edits can store any
+# value in them without dtype errors. Date columns stay datetime64.
+def _text_columns_to_object(df, numeric_columns):
+    for col in df.columns:
+        if col not in numeric_columns and df[col].dtype != object and not pd.api.types.is_datetime64_any_dtype(df[col]):
+            df[col] = df[col].astype(object)
+    return df
+
+# Bring a raw gambles DataFrame into the typed shape the routes expect
+def prepare_gambles(df):
+    # Ensure all required columns exist
+    for col in GAMBLE_COLUMNS:
+        if col not in df.columns:
+            df[col] = ''
+
+    # Numbers are floats and id and version ints, see coerce_column
+    for col in GAMBLE_NUMERIC_COLUMNS:
+        df[col] = coerce_column(Gamble.kinds[col], df[col])
+
+    # Dates are kept as datetime64, whatever format they were stored in
+    df['date'] = coerce_column('date', df['date'])
+
+    # Calculate profit as win + free_win
+    df['profit'] = df['win'] + df['free_win']
+    return _text_columns_to_object(df, GAMBLE_NUMERIC_COLUMNS)
+
+# Recalculate profit for the given row positions after an edit
+def refresh_gamble_rows(df, positions):
+    profit_col = df.columns.get_loc('profit')
+    df.iloc[positions, profit_col] = (
+        df['win'].to_numpy()[positions] + df['free_win'].to_numpy()[positions]
+    )
+
+# Bring a raw bank transactions DataFrame into the typed shape the routes expect
+def prepare_bank_transactions(df):
+    # Ensure all required columns exist
+    for col in BANK_COLUMNS:
+        if col not in df.columns:
+            df[col] = None
+
+    df['amount'] = coerce_column('number', df['amount'])
+
+    # Give transactions without an id one after the current highest id
+    ids = pd.to_numeric(df['id'], errors='coerce')
+    missing = ids.isna()
+    if missing.any():
+        start = int(ids.max()) + 1 if not ids.isna().all() else 1
+        ids[missing] = range(start, start + int(missing.sum()))
+    df['id'] = ids.astype(int)
+    df['version'] = coerce_column('integer', df['version'])
+    df['date'] = coerce_column('date', df['date'])
+    return _text_columns_to_object(df, BANK_NUMERIC_COLUMNS)
+
+# Lay stake, liability and profit of matched bets, for whole columns at once
+# or for single values. The lay stake evens out both outcomes: the back bet
+# of a qualifying bet pays out stake and winnings, a free bet only the
+# winnings. profit is what a settled bet made, and what an open one makes
+# whichever side wins; an open qualifying bet costs its qualifying loss.
+def bet_values(kind, result, back_stake, back_odds, lay_odds, commission):
+    free = np.asarray(kind) == 'free'
+    result = np.asarray(result)
+    back_stake = np.asarray(back_stake, dtype=float)
+    back_odds = np.asarray(back_odds, dtype=float)
+    lay_odds = np.asarray(lay_odds, dtype=float)
+    commission = np.asarray(commission, dtype=float)
+    
+    payout = np.where(free, back_stake * (back_odds - 1), back_stake * back_odds)
+    lay_price = lay_odds - commission
+    with np.errstate(divide='ignore', invalid='ignore'):
+        lay_stake = np.where(lay_price > 0, payout / lay_price, 0.0)
+    liability = lay_stake * (lay_odds - 1)
+    back_profit = back_stake * (back_odds - 1) - liability
+    lay_profit = lay_stake * (1 - commission) - np.where(free, 0.0, back_stake)
+    worst = np.minimum(back_profit, lay_profit)
+    profit = np.where(result == 'back', back_profit, np.where(result == 'lay', lay_profit, worst))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        roi = np.where(back_stake > 0, profit / back_stake, 0.0)
+    return {
+        'lay_stake': lay_stake,
+        'liability': liability,
+        'back_profit': back_profit,
+        'lay_profit': lay_profit,
+        'qualifying_loss': np.where(free, 0.0, np.maximum(-worst, 0.0)),
+        'profit': profit,
+        'roi': roi,
+    }
+
+# The same as bet_values in SQL, for SqliteStorage.update
+def _bet_sql_refresh():
+    free = "kind = 'free'"
+    payout = f"CASE WHEN {free} THEN back_stake * (back_odds - 1) ELSE back_stake * back_odds END"
+    lay_stake = f"(CASE WHEN lay_odds - commission > 0 THEN ({payout}) / (lay_odds - commission) ELSE 0 END)"
+    liability = f"({lay_stake} * (lay_odds - 1))"
+    back_profit = f"(back_stake * (back_odds - 1) - {liability})"
+    lay_profit = f"({lay_stake} * (1 - commission) - CASE WHEN {free} THEN 0 ELSE back_stake END)"
+    worst = f"MIN({back_profit}, {lay_profit})"
+    profit = f"(CASE result WHEN 'back' THEN {back_profit} WHEN 'lay' THEN {lay_profit} ELSE {worst} END)"
+    return ', '.join([
+        f"lay_stake = {lay_stake}",
+        f"liability = {liability}",
+        f"back_profit = {back_profit}",
+        f"lay_profit = {lay_profit}",
+        f"qualifying_loss = CASE WHEN {free} THEN 0 ELSE MAX(-{worst}, 0) END",
+        f"profit = {profit}",
+        f"roi = CASE WHEN back_stake > 0 THEN {profit} / back_stake ELSE 0 END",
+    ])
+
+# bets.csv used to be exported from a matched-betting sheet with a pair of
+# bets per row. pandas numbers the repeated headers of the second one .1.
+LEGACY_BET_LEGS = [('ID 1', ''), ('ID 2', '.1')]
+
+# Turn the rows of the old sheet into one row per bet for user. The sheet has
+# no stake column, the stake follows from the Betfair risk (the liability).
+def legacy_bets_frame(df, user):
+    legs = []
+    for id_col, suffix in LEGACY_BET_LEGS:
+        back_odds = coerce_column('number', df[f'SITE ODDS{suffix}']).to_numpy()
+        lay_odds = coerce_column('number', df[f'BETFAIR ODDS{suffix}']).to_numpy()
+        liability = coerce_column('number', df[f'BETFAIR RISK{suffix}']).to_numpy()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            stake = np.where((back_odds > 0) & (lay_odds > 1),
+                             liability * (lay_odds - BET_COMMISSION) / (back_odds * (lay_odds - 1)), 0.0)
+        done = coerce_column('text', df['DONE']).str.strip().str.lower() == 'yes'
+        lay_won = coerce_column('text', df[f'BETFAIR WIN{suffix}']).str.strip().str.lower() == 'win'
+        legs.append(pd.DataFrame({
+            'id': df[id_col].to_numpy(),
+            'date': df['DATO'].to_numpy(),
+            'site': df['SITE'].to_numpy(),
+            'bet': df['BET'].to_numpy(),
+            'kind': 'qualifying',
+            'back_stake': stake,
+            'back_odds': back_odds,
+            'lay_odds': lay_odds,
+            'commission': BET_COMMISSION,
+            'result': np.where(done, np.where(lay_won, 'lay', 'back'), ''),
+            'ref': df['REF'].to_numpy(),
+            'user': user,
+        }))
+    return pd.concat(legs, ignore_index=True)
+
+# Bring a raw bets DataFrame into the typed shape the routes expect
+def prepare_bets(df):
+    # The old sheet has no user column, its bets would belong to nobody.
+    # Refusing to load it also keeps a later save from overwriting it.
+    if 'SITE ODDS' in df.columns:
+        raise ValueError("bets.csv is in the old spreadsheet format, convert it with "
+                         "`flask --app app migrate-bets --user <user>`")
+
+    # Ensure all required columns exist
+    for col in BET_COLUMNS:
+        if col not in df.columns:
+            df[col] = ''
+
+    # Bets without a commission of their own pay the default one
+    commission = pd.to_numeric(df['commission'], errors='coerce')
+    df['commission'] = commission.fillna(BET_COMMISSION)
+    for col in BET_NUMERIC_COLUMNS:
+        df[col] = coerce_column(Bet.kinds[col], df[col])
+    for col in ['kind', 'result']:
+        df[col] = coerce_column('text', df[col]).str.strip().str.lower()
+    df['date'] = coerce_column('date', df['date'])
+
+    values = bet_values(df['kind'], df['result'], df['back_stake'], df['back_odds'], df['lay_odds'],
+                        df['commission'])
+    for col in BET_DERIVED_COLUMNS:
+        df[col] = values[col]
+    return _text_columns_to_object(df, BET_NUMERIC_COLUMNS)
+
+# Recalculate the derived columns for the given row positions after an edit
+def refresh_bet_rows(df, positions):
+    inputs = [df[col].to_numpy()[positions]
+              for col in ['kind', 'result', 'back_stake', 'back_odds', 'lay_odds', 'commission']]
+    values = bet_values(*inputs)
+    for col in BET_DERIVED_COLUMNS:
+        df.iloc[positions, df.columns.get_loc(col)] = values[col]
+
+# Storage layout and typing of every table
+TABLES = {
+    'gambles': {
+        'csv': gamble_csv,
+        'journal': gamble_journal,
+        'columns': GAMBLE_COLUMNS,
+        'numeric': GAMBLE_NUMERIC_COLUMNS,
+        'prepare': prepare_gambles,
+        'record': Gamble,
+        'refresh': refresh_gamble_rows,
+        'sql_refresh': 'profit = COALESCE(win, 0) + COALESCE(free_win, 0)',
+        'filters': ['website', 'machine'],
+        'categories': ['website', 'machine', 'user'],
+        'sums': ['win', 'free_win', 'profit'],
+        'schema': {
+            'id': 'INTEGER PRIMARY KEY', 'date': 'DATE', 'website': 'TEXT',
+            'machine': 'TEXT', 'win': 'REAL', 'free_win': 'REAL', 'free_win_m': 'TEXT',
+            'note': 'TEXT', 'start_amount': 'REAL', 'end_amount': 'REAL',
+            'f_start_amount': 'REAL', 'f_end_amount': 'REAL', 'user': 'TEXT', 'profit': 'REAL',
+            'version': 'INTEGER',
+        },
+    },
+    'bank': {
+        'csv': bank_csv,
+        'journal': bank_journal,
+        'columns': BANK_COLUMNS,
+        'numeric': BANK_NUMERIC_COLUMNS,
+        'prepare': prepare_bank_transactions,
+        'record': BankTransaction,
+        'refresh': None,
+        'sql_refresh': None,
+        'filters': ['type', 'site'],
+        'categories': ['type', 'site', 'user'],
+        'sums': ['amount'],
+        'schema': {
+            'id': 'INTEGER PRIMARY KEY', 'date': 'DATE', 'type': 'TEXT',
+            'amount': 'REAL', 'site': 'TEXT', 'user': 'TEXT', 'version': 'INTEGER',
+        },
+    },
+    'bets': {
+        'csv': bets_csv,
+        'journal': bets_journal,
+        'columns': BET_COLUMNS,
+        'numeric': BET_NUMERIC_COLUMNS,
+        'prepare': prepare_bets,
+        'record': Bet,
+        'refresh': refresh_bet_rows,
+        'sql_refresh': _bet_sql_refresh(),
+        'filters': ['site', 'kind', 'result', 'ref'],
+        'categories': ['site', 'kind', 'result', 'user'],
+        'sums': ['back_stake', 'liability', 'qualifying_loss', 'profit'],
+        'schema': {
+            'id': 'INTEGER PRIMARY KEY', 'date': 'DATE', 'site': 'TEXT', 'bet': 'TEXT', 'kind': 'TEXT',
+            'back_stake': 'REAL', 'back_odds': 'REAL', 'lay_odds': 'REAL', 'commission': 'REAL',
+            'result': 'TEXT', 'ref': 'TEXT', 'note': 'TEXT', 'lay_stake': 'REAL', 'liability': 'REAL',
+            'back_profit': 'REAL', 'lay_profit': 'REAL', 'qualifying_loss': 'REAL', 'profit': 'REAL',
+            'roi': 'REAL', 'user': 'TEXT', 'version': 'INTEGER',
+        },
+    },
+}
+
+# Convert numpy scalars, dates and NaN to plain JSON values for the journal
+def _journal_value(value):
+    if value is None:
+        return None
+    if isinstance(value, (date, np.datetime64)):
+        return format_date_for_storage(value) or None
+    if hasattr(value, 'item'):
+        value = value.item()
+    if isinstance(value, float) and value != value:
+        return None
+    return value
+
+# Journal values of a row's fields. Dates are written as YYYY-MM-DD however
+# the client sent them.
+def _journal_fields(fields):
+    journal_fields = {key: _journal_value(value) for key, value in fields.items()}
+    if 'date' in journal_fields:
+        journal_fields['date'] = format_date_for_storage(journal_fields['date']) or None
+    return journal_fields
+
+# Compare a stored value with an edited one, treating NaN, None and '' as equal
+def values_equal(current, value):
+    current = _journal_value(current)
+    value = _journal_value(value)
+    if current in (None, '') and value in (None, ''):
+        return True
+    return current == value
+
+# Read the records of a journal file from a byte offset on. Only complete
+# lines are read, a record another worker is still appending is picked up by
+# the next read. Returns the records and the offset to continue from. A torn
+# line (crash while appending) is skipped.
+def read_journal_from(journal_path, offset=0):
+    records = []
+    try:
+        with open(journal_path, 'rb') as f:
+            f.seek(offset)
+            data = f.read()
+    except FileNotFoundError:
+        return records, 0
+    end = data.rfind(b'\n') + 1
+    for line in data[:end].splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            print(f"Skipping unreadable journal record in {journal_path}")
+    return records, offset + end
+
+# Read all records from a journal file
+def read_journal(journal_path):
+    return read_journal_from(journal_path)[0]
+
+# Journal appends reach the disk in group commits. append_journal only
+# writes the records, and the writer calls journal_commits.wait() once it has
+# released write_lock. The first waiter finding no sync running fsyncs every
+# journal appended to so far, for itself and for all the writers that
+# appended meanwhile, so concurrent edits share one sync instead of each
+# holding the lock through their own.
+class GroupCommit:
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.appended = 0
+        self.synced = 0
+        self.syncing = False
+        self.dirty = set()
+        self.local = threading.local()
+
+    # Note that the current thread appended to path
+    def appended_to(self, path):
+        with self.condition:
+            self.appended += 1
+            self.dirty.add(path)
+            self.local.ticket = self.appended
+
+    # Return once everything the current thread appended is on disk
+    def wait(self):
+        ticket = getattr(self.local, 'ticket', 0)
+        with self.condition:
+            while self.synced < ticket:
+                if self.syncing:
+                    self.condition.wait()
+                    continue
+                self.syncing = True
+                upto, paths = self.appended, self.dirty
+                self.dirty = set()
+                self.condition.release()
+                done = False
                 try:
-                    df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0)
-                except:
-                    df[col] = 0
-            
-            # Ensure id is integer
-            df['id'] = df['id'].astype(int)
-            
-            # Calculate profit as win + free_win
-            df['profit'] = df['win'] + df['free_win']
-            
-            # Filter by user if specified
-            if user:
-                df = df[df['user'] == user]
-            
-            return df
+                    for path in paths:
+                        _fsync_file(path)
+                    done = True
+                finally:
+                    self.condition.acquire()
+                    self.syncing = False
+                    if done:
+                        self.synced = max(self.synced, upto)
+                    else:
+                        self.dirty |= paths
+                    self.condition.notify_all()
+
+# fsync a file by name. A journal that is gone was folded into its snapshot.
+def _fsync_file(path):
+    try:
+        fd = os.open(path, os.O_WRONLY)
+    except FileNotFoundError:
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+# fsync a directory, so a file renamed into it stays renamed after a crash.
+# Windows can't open directories and doesn't need it.
+def _fsync_dir(path):
+    if os.name == 'nt':
+        return
+    fd = os.open(path or '.', os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+journal_commits = GroupCommit()
+
+# Append records to a journal file in one write. They are durable once
+# journal_commits.wait() returned.
+def append_journal(journal_path, records):
+    lines = ''.join(json.dumps(record) + '\n' for record in records)
+    with open(journal_path, 'a+b') as f:
+        # Start on a new line if an earlier append was cut off
+        if f.tell() > 0:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b'\n':
+                lines = '\n' + lines
+        f.write(lines.encode('utf-8'))
+    journal_commits.appended_to(journal_path)
+
+# Write a file under a temporary name and rename it into place, so readers in
+# this or another worker never see it half written. Both the file and the
+# rename are on disk when it returns, so a crash leaves the old file or the
+# whole new one, and a journal folded into it can be removed.
+def replace_file(file_path, write):
+    temp_path = f"{file_path}.{os.getpid()}.tmp"
+    try:
+        write(temp_path)
+        _fsync_file(temp_path)
+        os.replace(temp_path, file_path)
+        _fsync_dir(os.path.dirname(file_path))
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+# Apply journal records to a table. Records are folded per id first so a
+# long journal costs one concat, one filter and one assignment per field.
+# Replaying is idempotent: an insert for an id that already exists replaces it.
+# id_index, if given, must be pd.Index(df['id']) and saves rebuilding it.
+def apply_journal_records(table, df, records, id_index=None):
+    spec = TABLES[table]
+    inserted = {}
+    updates = {}
+    deleted = set()
+    for record in records:
+        op = record.get('op')
+        if op == 'insert':
+            row = dict(record['row'])
+            row_id = int(row['id'])
+            deleted.add(row_id)
+            updates.pop(row_id, None)
+            inserted[row_id] = row
+        elif op == 'update':
+            row_id = int(record['id'])
+            if row_id in inserted:
+                inserted[row_id].update(record['fields'])
+            else:
+                updates.setdefault(row_id, {}).update(record['fields'])
+        elif op == 'delete':
+            row_id = int(record['id'])
+            inserted.pop(row_id, None)
+            updates.pop(row_id, None)
+            deleted.add(row_id)
+
+    if deleted:
+        df = df[~df['id'].isin(deleted)].reset_index(drop=True)
+        id_index = None
+
+    if updates:
+        if id_index is None:
+            id_index = pd.Index(df['id'])
+        positions = id_index.get_indexer(list(updates.keys()))
+        found = positions >= 0
+        row_updates = [fields for fields, ok in zip(updates.values(), found) if ok]
+        positions = positions[found]
+        if len(positions):
+            fields_by_column = {}
+            for i, fields in enumerate(row_updates):
+                for field, value in fields.items():
+                    fields_by_column.setdefault(field, ([], []))
+                    fields_by_column[field][0].append(positions[i])
+                    fields_by_column[field][1].append(value)
+            for field, (pos, values) in fields_by_column.items():
+                if field == 'id':
+                    continue
+                if field not in df.columns:
+                    df[field] = None
+                if field in spec['numeric'] or field == 'date':
+                    values = coerce_column(spec['record'].kinds[field], values).to_numpy()
+                elif df[field].dtype != object:
+                    df[field] = df[field].astype(object)
+                df.iloc[pos, df.columns.get_loc(field)] = values
+            if spec['refresh']:
+                spec['refresh'](df, positions)
+
+    if inserted:
+        new_rows = spec['prepare'](pd.DataFrame(list(inserted.values())))
+        df = pd.concat([df, new_rows], ignore_index=True) if not df.empty else new_rows
+
+    return df
+
+# Path of a table's snapshot in the given format, next to its CSV file
+def snapshot_path(table, snapshot_format):
+    return os.path.splitext(TABLES[table]['csv'])[0] + SNAPSHOT_EXTENSIONS[snapshot_format]
+
+# Bring a table into the fixed schema of the binary snapshots: only the
+# columns of spec['schema'] (junk columns of old CSV files are dropped),
+# int64 and float64 numbers, timestamps for dates, categoricals for
+# spec['categories'] and strings for the other text columns
+def snapshot_frame(table, df):
+    spec = TABLES[table]
+    frame = pd.DataFrame(index=range(len(df)))
+    for col, col_type in spec['schema'].items():
+        if col in df.columns:
+            values = df[col].reset_index(drop=True)
+        else:
+            values = pd.Series([None] * len(df), dtype=object)
+        if col_type.startswith('INTEGER'):
+            frame[col] = pd.to_numeric(values, errors='coerce').fillna(0).astype('int64')
+        elif col_type == 'REAL':
+            frame[col] = pd.to_numeric(values, errors='coerce').astype('float64')
+        elif col_type == 'DATE':
+            frame[col] = parse_dates(values)
         else:
-            # Return empty DataFrame with required columns if file doesn't exist
-            return pd.DataFrame(columns=[
-                'id', 'date', 'website', 'machine', 'win', 'free_win', 
-                'free_win_m', 'note', 'start_amount', 'end_amount', 'user', 'profit'
+            text = values.astype(object)
+            present = text.notna()
+            text[present] = text[present].astype(str)
+            frame[col] = text.astype('category') if col in spec['categories'] else text
+    return frame
+
+def read_snapshot(path, snapshot_format):
+    if snapshot_format == 'parquet':
+        return pyarrow.parquet.read_table(path, memory_map=True).to_pandas()
+    if snapshot_format == 'feather':
+        return pyarrow.feather.read_table(path, memory_map=True).to_pandas()
+    return pd.read_csv(path, low_memory=False)
+
+def write_snapshot(table, df, path, snapshot_format):
+    if snapshot_format == 'csv':
+        replace_file(path, lambda temp_path: df.to_csv(temp_path, index=False, date_format='%Y-%m-%d'))
+        return
+    arrow_table = pyarrow.Table.from_pandas(snapshot_frame(table, df), preserve_index=False)
+    if snapshot_format == 'parquet':
+        replace_file(path, lambda temp_path: pyarrow.parquet.write_table(arrow_table, temp_path))
+    else:
+        # Uncompressed, so reading maps the file instead of decoding it
+        replace_file(path, lambda temp_path: pyarrow.feather.write_feather(
+            arrow_table, temp_path, compression='uncompressed'))
+
+# Raised when a client saves a row that was changed since it loaded it. Routes
+# answer it with 409 so the grid reloads the row instead of overwriting it.
+class StaleRowError(Exception):
+    def __init__(self, table, ids):
+        super().__init__(f"{table} rows {ids} were changed by someone else, reload and try again")
+        self.table = table
+        self.ids = ids
+
+# Compare the versions a client last saw, {id: version}, with the current
+# ones and raise StaleRowError for rows that have moved on
+def check_versions(table, current, expected):
+    if not expected:
+        return
+    stale = [
+        int(row_id) for row_id, version in expected.items()
+        if version not in (None, '') and int(row_id) in current and current[int(row_id)] != int(version)
+    ]
+    if stale:
+        raise StaleRowError(table, stale)
+
+# Exclusive write lock shared by all worker processes through flock on a lock
+# file. Threads of one process queue on thread_lock first, and the lock is
+# re-entrant within a thread like the RLock it wraps.
+class StorageLock:
+    def __init__(self, path, thread_lock):
+        self.path = path
+        self.thread_lock = thread_lock
+        self.depth = 0
+        self.fd = None
+
+    def __enter__(self):
+        self.thread_lock.acquire()
+        if self.depth == 0 and fcntl is not None:
+            try:
+                self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT)
+                fcntl.flock(self.fd, fcntl.LOCK_EX)
+            except BaseException:
+                if self.fd is not None:
+                    os.close(self.fd)
+                    self.fd = None
+                self.thread_lock.release()
+                raise
+        self.depth += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        self.depth -= 1
+        if self.depth == 0 and self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+        self.thread_lock.release()
+
+# Functions called after every write, see on_storage_change
+_change_listeners = []
+
+# Register fn(table, old_rows, new_rows) to be called after every write.
+# old_rows/new_rows are DataFrames of the affected rows before and after the
+# write (None for inserts and deletes). fn(table, None, None) means the table
+# changed wholesale, e.g. it was replaced or edited outside this process, and
+# anything derived from it must be rebuilt; table is None for all tables.
+def on_storage_change(fn):
+    _change_listeners.append(fn)
+    return fn
+
+def notify_storage_change(table, old_rows=None, new_rows=None):
+    for fn in _change_listeners:
+        try:
+            fn(table, old_rows, new_rows)
+        except Exception as e:
+            print(f"Error in storage change listener {fn.__name__}: {str(e)}")
+
+# Worker threads for background jobs
+JOB_WORKERS = max(1, int(os.environ.get('JOB_WORKERS', 2)))
+# Finished jobs kept around for /jobs/<job_id>
+JOB_HISTORY = 1000
+
+# Work that doesn't have to finish before the response goes out (compacting
+# a journal, rebuilding running totals or statistics) runs on a small pool of
+# worker threads in this process. A job is named by its kind and key, and
+# submitting one while the same job is still waiting to start returns the
+# waiting one instead of queueing it twice. Once a job started it may have
+# read the data already, so the next submit queues a new run. fn raising or
+# returning False, like the storage methods do on failure, fails the job.
+# Jobs are per process: /jobs/<job_id> only knows the ones queued here.
+class JobQueue:
+    def __init__(self, workers):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job')
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.waiting = {}
+
+    # Queue fn(*args) unless the same job is waiting already. user is who
+    # may look the job up, None for everybody. Returns the job id.
+    def submit(self, kind, key, fn, *args, user=None):
+        with self.lock:
+            job_id = self.waiting.get((kind, key))
+            if job_id is not None:
+                self.jobs[job_id]['coalesced'] += 1
+                return job_id
+            job = {
+                'id': uuid.uuid4().hex,
+                'kind': kind,
+                'key': key,
+                'user': user,
+                'status': 'queued',
+                'coalesced': 0,
+                'error': None,
+                'submitted': time.time(),
+                'started': None,
+                'finished': None,
+            }
+            self.jobs[job['id']] = job
+            self.waiting[(kind, key)] = job['id']
+            self._trim()
+        try:
+            self.executor.submit(self._run, job, fn, args)
+        except RuntimeError:
+            # The pool is shut down once the interpreter exits, jobs queued
+            # after that run right here
+            self._run(job, fn, args)
+        return job['id']
+
+    def _run(self, job, fn, args):
+        with self.lock:
+            self.waiting.pop((job['kind'], job['key']), None)
+            job.update(status='running', started=time.time())
+        try:
+            if fn(*args) is False:
+                raise RuntimeError(f"{job['kind']} {job['key']} failed")
+            status, error = 'done', None
+        except Exception as e:
+            print(f"Error in job {job['kind']} {job['key']}: {str(e)}")
+            status, error = 'failed', str(e)
+        with self.lock:
+            job.update(status=status, error=error, finished=time.time())
+
+    # Forget the oldest finished jobs beyond JOB_HISTORY
+    def _trim(self):
+        while len(self.jobs) > JOB_HISTORY:
+            oldest = next(iter(self.jobs.values()))
+            if oldest['status'] not in ('done', 'failed'):
+                break
+            del self.jobs[oldest['id']]
+
+    # A copy of the job, or None if it's unknown
+    def get(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+jobs = JobQueue(JOB_WORKERS)
+
+# Storage backed by the files in CSV_DIR. Every table is a snapshot (CSV, or
+# Parquet/Arrow with SNAPSHOT_FORMAT) plus a journal, and a process-wide copy
+# of each table (snapshot + journal replayed) is kept in memory. The files are only parsed again when their
+# mtime/size changes on disk, e.g. when they are edited by hand. Writes hold
+# write_lock, which other worker processes share through storage_lock_file;
+# records they append are picked up by replaying just the new journal tail.
+class CsvStorage:
+    # directory holds the tables' files, named like the ones in CSV_DIR.
+    # ShardedStorage passes its own lock and write_lock, shared by all shards.
+    def __init__(self, snapshot_format='csv', directory=None, lock=None, write_lock=None):
+        if snapshot_format not in SNAPSHOT_EXTENSIONS:
+            raise ValueError(f"Unknown snapshot format: {snapshot_format}")
+        if snapshot_format != 'csv' and pyarrow is None:
+            raise ValueError(f"Snapshot format {snapshot_format} needs pyarrow")
+        self.snapshot_format = snapshot_format
+        self.directory = directory or CSV_DIR
+        os.makedirs(self.directory, exist_ok=True)
+        self.files = {
+            table: {key: os.path.join(self.directory, os.path.basename(spec[key])) for key in ('csv', 'journal')}
+            for table, spec in TABLES.items()
+        }
+        self.snapshots = {table: self.snapshot_path(table, snapshot_format) for table in TABLES}
+        self.cache = {name: {'df': None, 'stamp': None, 'journal_records': 0, 'journal_offset': 0} for name in TABLES}
+        self.lock = lock or threading.RLock()
+        self.write_lock = write_lock or StorageLock(storage_lock_file, self.lock)
+        self.item_files = {'websites': websites_csv, 'machines': machines_csv}
+
+    # Path of a table's snapshot in the given format, next to its CSV file
+    def snapshot_path(self, table, snapshot_format):
+        return os.path.splitext(self.files[table]['csv'])[0] + SNAPSHOT_EXTENSIONS[snapshot_format]
+
+    def _stamp(self, table):
+        return (file_stamp(self.snapshots[table]), file_stamp(self.files[table]['journal']))
+
+    # First use of a binary snapshot format: convert the table's CSV file. The
+    # journal stays, replaying it on top of the new snapshot is harmless.
+    def _import_csv(self, table):
+        spec = TABLES[table]
+        with self.write_lock:
+            if not os.path.exists(self.snapshots[table]):
+                df = spec['prepare'](pd.read_csv(self.files[table]['csv']))
+                write_snapshot(table, df, self.snapshots[table], self.snapshot_format)
+
+    # Return the cached table, re-reading snapshot + journal only if they changed on disk
+    def cached(self, table):
+        spec = TABLES[table]
+        with self.lock:
+            entry = self.cache[table]
+            stamp = self._stamp(table)
+            if stamp[0] is None and self.snapshot_format != 'csv' and os.path.exists(self.files[table]['csv']):
+                self._import_csv(table)
+                stamp = self._stamp(table)
+            if stamp[0] is None and stamp[1] is None:
+                entry.update(df=None, stamp=None, journal_records=0, journal_offset=0)
+                return None
+            if entry['df'] is not None and entry['stamp'] != stamp:
+                if entry['stamp'][0] == stamp[0] and stamp[1] is not None and stamp[1][1] >= entry['journal_offset']:
+                    # Same snapshot and the journal only grew: apply the new records
+                    records, offset = read_journal_from(self.files[table]['journal'], entry['journal_offset'])
+                    df = entry['df']
+                    entry.update(
+                        df=apply_journal_records(table, df, records, self._id_index(table, df)),
+                        stamp=stamp,
+                        journal_records=entry['journal_records'] + len(records),
+                        journal_offset=offset,
+                    )
+                    notify_storage_change(table)
+                    return entry['df']
+                entry['df'] = None
+                notify_storage_change(table)
+            if entry['df'] is None:
+                if stamp[0] is not None:
+                    df = spec['prepare'](read_snapshot(self.snapshots[table], self.snapshot_format))
+                else:
+                    df = spec['prepare'](pd.DataFrame(columns=spec['columns']))
+                records, offset = read_journal_from(self.files[table]['journal'])
+                if records:
+                    df = apply_journal_records(table, df, records)
+                entry.update(df=df, stamp=stamp, journal_records=len(records), journal_offset=offset)
+            return entry['df']
+
+    # Pick up writes made outside this process
+    def refresh(self):
+        with self.lock:
+            for table, entry in self.cache.items():
+                if entry['df'] is not None and entry['stamp'] != self._stamp(table):
+                    self.cached(table)
+
+    # Identifies the current contents of all tables
+    def stamp(self):
+        return repr([self._stamp(table) for table in TABLES])
+
+    def load(self, table, user=None):
+        df = self.cached(table)
+        if df is None:
+            return TABLES[table]['prepare'](pd.DataFrame(columns=TABLES[table]['columns']))
+
+        # Always hand out a copy so callers can modify the result without
+        # touching the cache
+        if user:
+            return df[df['user'] == user].copy()
+        return df.copy()
+
+    # id -> row position lookup for the cached table. Edits update the cached
+    # DataFrame in place, so this is only rebuilt after inserts, deletes and reloads.
+    def _id_index(self, table, df):
+        entry = self.cache[table]
+        if entry.get('index_df') is not df:
+            entry['index'] = pd.Index(df['id'])
+            entry['index_df'] = df
+        return entry['index']
+
+    # Rows by id, with user only the ones that belong to that user
+    def get_rows(self, table, ids, user=None):
+        with self.lock:
+            df = self.cached(table)
+            if df is None:
+                return TABLES[table]['prepare'](pd.DataFrame(columns=TABLES[table]['columns']))
+            positions = self._id_index(table, df).get_indexer([int(row_id) for row_id in ids])
+            rows = df.iloc[positions[positions >= 0]]
+            if user is not None:
+                rows = rows[rows['user'] == user]
+            return rows.copy()
+
+    # Arrays of the columns a record reads, kept until the table changes.
+    # Edits can change the cached DataFrame in place, so they are matched
+    # against the table's stamp as well.
+    def _record_arrays(self, table, df):
+        entry = self.cache[table]
+        if entry.get('arrays_df') is not df or entry.get('arrays_stamp') != entry['stamp']:
+            record = TABLES[table]['record']
+            entry['arrays'] = {col: df[col].array for col in record.kinds if col in df.columns}
+            entry['arrays_df'] = df
+            entry['arrays_stamp'] = entry['stamp']
+        return entry['arrays']
+
+    # A single row as a record, read straight from the cached columns
+    # without building a DataFrame for it
+    def get_row(self, table, row_id, user=None):
+        with self.lock:
+            df = self.cached(table)
+            if df is None:
+                return None
+            try:
+                position = self._id_index(table, df).get_loc(int(row_id))
+            except KeyError:
+                return None
+            arrays = self._record_arrays(table, df)
+            if user is not None and arrays['user'][position] != user:
+                return None
+            return TABLES[table]['record'].from_row({col: values[position] for col, values in arrays.items()})
+
+    # Yield a table's rows (optionally one user's) as DataFrames of at most
+    # chunk_size rows, copying one chunk at a time
+    def iter_rows(self, table, user=None, chunk_size=1000):
+        with self.lock:
+            df = self.cached(table)
+            if df is None:
+                return
+            positions = np.flatnonzero((df['user'] == user).to_numpy()) if user else np.arange(len(df))
+        for start in range(0, len(positions), chunk_size):
+            with self.lock:
+                chunk = df.iloc[positions[start:start + chunk_size]].copy()
+            yield chunk
+
+    # The table's dates as they are written in the snapshot and journal, before
+    # parsing, as a DataFrame of id and date. Used by migrate-dates.
+    def raw_dates(self, table):
+        with self.write_lock:
+            frames = []
+            if os.path.exists(self.snapshots[table]):
+                snapshot = read_snapshot(self.snapshots[table], self.snapshot_format)
+                frames.append(snapshot.reindex(columns=['id', 'date']).astype(object))
+            elif os.path.exists(self.files[table]['csv']):
+                frames.append(pd.read_csv(self.files[table]['csv'], dtype=object).reindex(columns=['id', 'date']))
+            journal_dates = []
+            for record in read_journal(self.files[table]['journal']):
+                fields = record.get('row') if record.get('op') == 'insert' else record.get('fields')
+                if fields and 'date' in fields:
+                    journal_dates.append({'id': fields.get('id', record.get('id')), 'date': fields['date']})
+            frames.append(pd.DataFrame(journal_dates, columns=['id', 'date'], dtype=object))
+            return pd.concat(frames, ignore_index=True)
+
+    # Current version of each of the given rows that exists (and belongs to
+    # user, if given), {id: version}
+    def _versions(self, table, ids, user=None):
+        rows = self.get_rows(table, ids, user)
+        return dict(zip(rows['id'].tolist(), rows['version'].astype(int).tolist()))
+
+    # (snapshot stamp, row count, sum of ids, sum of versions) of a user's
+    # rows. Every write changes it: edits raise a version, and ids are never
+    # given out twice, so inserts and deletes change the count or the id sum.
+    # Writes that replace the table (save_table, migrate-dates, hand edits of
+    # the CSV file) don't raise versions but rewrite the snapshot. Compaction
+    # rewrites it too, which only costs clients one full response.
+    def fingerprint(self, table, user):
+        with self.lock:
+            df = self.cached(table)
+            if df is None:
+                return (None, 0, 0, 0)
+            mask = (df['user'] == user).to_numpy()
+            return (self.cache[table]['stamp'][0], int(mask.sum()), int(df['id'].to_numpy()[mask].sum()),
+                    int(df['version'].to_numpy()[mask].sum()))
+
+    # Replace a table completely: write a fresh snapshot and drop its journal.
+    # The journal goes only once the snapshot is on disk (see replace_file).
+    def save(self, table, df):
+        spec = TABLES[table]
+        with self.write_lock:
+            entry = self.cache[table]
+            try:
+                write_snapshot(table, df, self.snapshots[table], self.snapshot_format)
+                if os.path.exists(self.files[table]['journal']):
+                    os.remove(self.files[table]['journal'])
+            except Exception as e:
+                print(f"Error saving {table}: {str(e)}")
+                # Force a reload on the next read, the journal may still be there
+                entry['df'] = None
+                return False
+            entry.update(df=spec['prepare'](df.copy()), stamp=self._stamp(table), journal_records=0, journal_offset=0)
+            return True
+
+    # Append records to a table's journal and apply them to the cache. The
+    # caller holds write_lock and has brought the cache up to date.
+    def _write(self, table, records):
+        spec = TABLES[table]
+        entry = self.cache[table]
+        df = self.cached(table)
+        if df is None:
+            df = spec['prepare'](pd.DataFrame(columns=spec['columns']))
+        append_journal(self.files[table]['journal'], records)
+        stamp = self._stamp(table)
+        entry.update(
+            df=apply_journal_records(table, df, records, self._id_index(table, df)),
+            stamp=stamp,
+            journal_records=entry['journal_records'] + len(records),
+            journal_offset=stamp[1][1],
+        )
+        if entry['journal_records'] >= JOURNAL_COMPACT_THRESHOLD:
+            # Folding the journal in rewrites the whole snapshot, which
+            # doesn't have to hold up this write
+            self._queue_compaction(table)
+        elif (JOURNAL_FLUSH_MS > 0 and entry['journal_records'] >= JOURNAL_FLUSH_MIN_RECORDS
+              and entry.get('flush_timer') is None):
+            # Enough edits to be worth a rewrite are folded in a while later, all in one go
+            timer = threading.Timer(JOURNAL_FLUSH_MS / 1000, self._flush_timer_fired, [table])
+            timer.daemon = True
+            entry['flush_timer'] = timer
+            timer.start()
+
+    def _queue_compaction(self, table):
+        name = os.path.normpath(os.path.join(os.path.relpath(self.directory, CSV_DIR), table))
+        jobs.submit('compact', name, self.compact, table)
+
+    def _flush_timer_fired(self, table):
+        self.cache[table]['flush_timer'] = None
+        self._queue_compaction(table)
+
+    # Reserve count new ids and return the first. The highest id handed out
+    # is kept in sequences_json, so ids of deleted rows are never given out
+    # again. The caller holds write_lock.
+    def _allocate_ids(self, table, count, highest_id):
+        sequences = {}
+        if os.path.exists(sequences_json):
+            with open(sequences_json, encoding='utf-8') as f:
+                sequences = json.load(f)
+        first_id = max(int(sequences.get(table, 0)), highest_id) + 1
+        sequences[table] = first_id + count - 1
+
+        def write(path):
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(sequences, f)
+        replace_file(sequences_json, write)
+        return first_id
+
+    def insert(self, table, rows):
+        with self.write_lock:
+            df = self.cached(table)
+            highest_id = int(df['id'].max()) if df is not None and not df.empty else 0
+            first_id = self._allocate_ids(table, len(rows), highest_id)
+            records = []
+            for offset, row in enumerate(rows):
+                row = dict(row, id=first_id + offset, version=1)
+                records.append({'op': 'insert', 'row': _journal_fields(row)})
+            self._write(table, records)
+            return [record['row']['id'] for record in records]
+
+    # Insert a DataFrame of new rows. Small batches go through the journal like
+    # insert; big ones are added to the table and written as a new snapshot in
+    # one go, which is what compaction would do right after anyway.
+    def insert_frame(self, table, rows):
+        if len(rows) < JOURNAL_COMPACT_THRESHOLD:
+            return self.insert(table, rows.to_dict(orient='records'))
+        spec = TABLES[table]
+        with self.write_lock:
+            df = self.cached(table)
+            if df is None:
+                df = spec['prepare'](pd.DataFrame(columns=spec['columns']))
+            highest_id = int(df['id'].max()) if not df.empty else 0
+            first_id = self._allocate_ids(table, len(rows), highest_id)
+            new_rows = spec['prepare'](rows.reset_index(drop=True).assign(
+                id=np.arange(first_id, first_id + len(rows)), version=1))
+            if not self.save(table, pd.concat([df, new_rows], ignore_index=True)):
+                raise OSError(f"Failed to save {table}")
+            return new_rows['id'].tolist()
+
+    # Every update raises the row's version. The new version is written into
+    # the journal record, so replaying it stays idempotent. With user, rows of
+    # other users are left alone.
+    def update(self, table, changes, versions=None, user=None):
+        with self.write_lock:
+            current = self._versions(table, list(changes), user)
+            check_versions(table, current, versions)
+            if user is not None:
+                changes = {row_id: fields for row_id, fields in changes.items() if int(row_id) in current}
+            self._write(table, [
+                {'op': 'update', 'id': int(row_id),
+                 'fields': _journal_fields(dict(fields, version=current.get(int(row_id), 0) + 1))}
+                for row_id, fields in changes.items()
             ])
+
+    def delete(self, table, ids, versions=None, user=None):
+        with self.write_lock:
+            if versions or user is not None:
+                current = self._versions(table, ids, user)
+                check_versions(table, current, versions)
+                if user is not None:
+                    ids = [row_id for row_id in ids if int(row_id) in current]
+            self._write(table, [{'op': 'delete', 'id': int(row_id)} for row_id in ids])
+
+    # Fold the journal back into the snapshot. Safe to interrupt: the journal is
+    # removed only after the new snapshot is written, and replaying it on top of
+    # that snapshot gives the same result.
+    def compact(self, table):
+        with self.write_lock:
+            df = self.cached(table)
+            if df is None or self.cache[table]['journal_records'] == 0:
+                return True
+            return self.save(table, df)
+
+    # Fold the pending journal records of the tables loaded in this process
+    # into their snapshots
+    def flush(self):
+        loaded = [table for table, entry in self.cache.items() if entry['df'] is not None]
+        return all([self.compact(table) for table in loaded])
+
+    def load_items(self, kind):
+        return load_items_from_csv(self.item_files[kind])
+
+    # Identifies the current contents of a websites or machines file
+    def items_stamp(self, kind):
+        return file_stamp(self.item_files[kind])
+
+    # Append an item the caller checked isn't in the file yet
+    def add_item(self, kind, item):
+        with self.write_lock:
+            return add_item_to_csv(self.item_files[kind], item)
+
+# Storage backed by an embedded SQLite database. Rows are indexed on
+# (user, id) and (user, date), so per-user reads and single-row edits don't
+# scan the whole ledger. WAL mode lets readers work while a write is running,
+# and every write is one BEGIN IMMEDIATE transaction, so workers in other
+# processes can't interleave with it.
+class SqliteStorage:
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.lock = threading.RLock()
+        self.write_lock = self.lock
+        # Last generation this process has seen, see _bump_generation
+        self.generation = None
+        with self.connection() as conn:
+            self._create_schema(conn)
+
+    # One connection per thread, sqlite3 connections can't be shared
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            # Every commit syncs the write-ahead log, so an acknowledged edit
+            # survives a power failure like a synced csv journal record
+            conn.execute('PRAGMA synchronous=FULL')
+            self.local.conn = conn
+        return conn
+
+    # Write transaction that takes SQLite's write lock up front, so what is
+    # read inside it (versions, the highest id) can't change before the commit
+    @contextlib.contextmanager
+    def transaction(self):
+        conn = self.connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+
+    def _create_schema(self, conn):
+        for table, spec in TABLES.items():
+            columns = ', '.join(f'"{col}" {col_type}' for col, col_type in spec['schema'].items())
+            conn.execute(f'CREATE TABLE IF NOT EXISTS {table} ({columns})')
+            # Add columns introduced after the database was created
+            existing = {row[1] for row in conn.execute(f'PRAGMA table_info({table})')}
+            for col, col_type in spec['schema'].items():
+                if col not in existing:
+                    conn.execute(f'ALTER TABLE {table} ADD COLUMN "{col}" {col_type} DEFAULT 0')
+            conn.execute(f'CREATE INDEX IF NOT EXISTS {table}_user_id ON {table} (user, id)')
+            conn.execute(f'CREATE INDEX IF NOT EXISTS {table}_user_date ON {table} (user, date)')
+        for kind in ['websites', 'machines']:
+            conn.execute(f'CREATE TABLE IF NOT EXISTS {kind} (name TEXT PRIMARY KEY)')
+        # Write counter shared by all processes using the database
+        conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER)')
+        conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('generation', 0)")
+
+    def _read_generation(self, conn):
+        return conn.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()[0]
+
+    # Count a write. Returns True if somebody else wrote since our last write.
+    def _bump_generation(self, conn):
+        conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'generation'")
+        generation = self._read_generation(conn)
+        changed_outside = self.generation is not None and generation != self.generation + 1
+        self.generation = generation
+        return changed_outside
+
+    # Notice writes made by other processes
+    def refresh(self):
+        generation = self._read_generation(self.connection())
+        if self.generation is not None and generation != self.generation:
+            notify_storage_change(None)
+        self.generation = generation
+
+    # Identifies the current contents of all tables
+    def stamp(self):
+        return str(self._read_generation(self.connection()))
+
+    def _columns(self, table, fields):
+        return [field for field in fields if field in TABLES[table]['schema']]
+
+    def load(self, table, user=None):
+        query = f'SELECT * FROM {table}'
+        params = []
+        if user:
+            query += ' WHERE user = ?'
+            params.append(user)
+        df = pd.read_sql_query(query + ' ORDER BY id', self.connection(), params=params)
+        return TABLES[table]['prepare'](df)
+
+    # The table's dates as stored, see CsvStorage.raw_dates
+    def raw_dates(self, table):
+        return pd.read_sql_query(f'SELECT id, date FROM {table}', self.connection()).astype(object)
+
+    # Rows by id, with user only the ones that belong to that user
+    def get_rows(self, table, ids, user=None):
+        ids = [int(row_id) for row_id in ids]
+        user_filter, user_params = self._user_filter(user)
+        rows = []
+        # Stay below SQLite's limit on bound parameters
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            placeholders = ', '.join('?' for _ in chunk)
+            rows += self.connection().execute(
+                f'SELECT * FROM {table} WHERE id IN ({placeholders}){user_filter}', chunk + user_params
+            ).fetchall()
+        if not rows:
+            return TABLES[table]['prepare'](pd.DataFrame(columns=TABLES[table]['columns']))
+        return TABLES[table]['prepare'](pd.DataFrame([dict(row) for row in rows]))
+
+    def get_row(self, table, row_id, user=None):
+        user_filter, user_params = self._user_filter(user)
+        row = self.connection().execute(
+            f'SELECT * FROM {table} WHERE id = ?{user_filter}', [int(row_id)] + user_params
+        ).fetchone()
+        return TABLES[table]['record'].from_row(dict(row)) if row is not None else None
+
+    # Condition and parameters that limit a query by id to one user's rows,
+    # nothing without a user
+    def _user_filter(self, user):
+        return (' AND user = ?', [user]) if user is not None else ('', [])
+
+    # Yield a table's rows (optionally one user's) as DataFrames of at most
+    # chunk_size rows, fetched from the database one chunk at a time. Uses its
+    # own connection so it can be consumed while other queries run.
+    def iter_rows(self, table, user=None, chunk_size=1000):
+        query = f'SELECT * FROM {table}'
+        params = []
+        if user:
+            query += ' WHERE user = ?'
+            params.append(user)
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            cursor = conn.execute(query + ' ORDER BY id', params)
+            columns = [description[0] for description in cursor.description]
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield TABLES[table]['prepare'](pd.DataFrame(rows, columns=columns))
+        finally:
+            conn.close()
+
+    def _insert_frame(self, conn, table, df):
+        columns = self._columns(table, df.columns)
+        placeholders = ', '.join('?' for _ in columns)
+        names = ', '.join(f'"{col}"' for col in columns)
+        # Plain Python values with None for missing ones, converted per
+        # column. Dates are stored as YYYY-MM-DD text.
+        values = dates_as_text(df[columns]).astype(object)
+        values = values.where(df[columns].notna(), None)
+        conn.executemany(
+            f'INSERT OR REPLACE INTO {table} ({names}) VALUES ({placeholders})',
+            values.itertuples(index=False, name=None),
+        )
+
+    # Replace a table completely. The number of times a table was replaced is
+    # kept in meta for fingerprint, versions don't say the rows changed.
+    def save(self, table, df):
+        try:
+            with self.lock, self.transaction() as conn:
+                conn.execute(f'DELETE FROM {table}')
+                self._insert_frame(conn, table, TABLES[table]['prepare'](df.copy()))
+                key = f'{table}_saves'
+                conn.execute('INSERT OR IGNORE INTO meta (key, value) VALUES (?, 0)', (key,))
+                conn.execute('UPDATE meta SET value = value + 1 WHERE key = ?', (key,))
+                self._bump_generation(conn)
+            return True
+        except Exception as e:
+            print(f"Error saving {table}: {str(e)}")
+            return False
+
+    # Reserve count new ids and return the first. The highest id handed out is
+    # kept in meta, so ids of deleted rows are never given out again.
+    def _allocate_ids(self, conn, table, count):
+        key = f'{table}_last_id'
+        conn.execute('INSERT OR IGNORE INTO meta (key, value) VALUES (?, 0)', (key,))
+        first_id = conn.execute(
+            f'SELECT MAX((SELECT value FROM meta WHERE key = ?), (SELECT COALESCE(MAX(id), 0) FROM {table})) + 1',
+            (key,),
+        ).fetchone()[0]
+        conn.execute('UPDATE meta SET value = ? WHERE key = ?', (first_id + count - 1, key))
+        return first_id
+
+    # Current version of each of the given rows that exists (and belongs to
+    # user, if given), {id: version}
+    def _versions(self, conn, table, ids, user=None):
+        versions = {}
+        ids = [int(row_id) for row_id in ids]
+        user_filter, user_params = self._user_filter(user)
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            placeholders = ', '.join('?' for _ in chunk)
+            for row_id, version in conn.execute(
+                f'SELECT id, COALESCE(version, 0) FROM {table} WHERE id IN ({placeholders}){user_filter}',
+                chunk + user_params,
+            ):
+                versions[row_id] = version
+        return versions
+
+    # See CsvStorage.fingerprint, the count of saves takes the snapshot's place
+    def fingerprint(self, table, user):
+        row = self.connection().execute(
+            f"SELECT (SELECT value FROM meta WHERE key = ?), COUNT(*), COALESCE(SUM(id), 0), "
+            f"COALESCE(SUM(version), 0) FROM {table} WHERE user = ?",
+            (f'{table}_saves', user),
+        ).fetchone()
+        return tuple(row)
+
+    def insert(self, table, rows):
+        return self.insert_frame(table, pd.DataFrame(list(rows)))
+
+    # Insert a DataFrame of new rows in one transaction
+    def insert_frame(self, table, rows):
+        with self.lock, self.transaction() as conn:
+            next_id = self._allocate_ids(conn, table, len(rows))
+            ids = list(range(next_id, next_id + len(rows)))
+            df = rows.reset_index(drop=True).assign(id=ids, version=1)
+            self._insert_frame(conn, table, TABLES[table]['prepare'](df))
+            changed_outside = self._bump_generation(conn)
+        if changed_outside:
+            notify_storage_change(None)
+        return ids
+
+    # With user, rows of other users are left alone
+    def update(self, table, changes, versions=None, user=None):
+        spec = TABLES[table]
+        user_filter, user_params = self._user_filter(user)
+        with self.lock, self.transaction() as conn:
+            if versions:
+                check_versions(table, self._versions(conn, table, list(changes), user), versions)
+            for row_id, fields in changes.items():
+                columns = [col for col in self._columns(table, fields) if col not in ('id', 'version')]
+                if not columns:
+                    continue
+                stored = _journal_fields(fields)
+                values = [
+                    coerce_value(spec['record'].kinds[col], fields[col]) if col in spec['numeric'] else stored[col]
+                    for col in columns
+                ]
+                assignments = ', '.join(f'"{col}" = ?' for col in columns)
+                assignments += ', version = COALESCE(version, 0) + 1'
+                conn.execute(f'UPDATE {table} SET {assignments} WHERE id = ?{user_filter}',
+                             values + [int(row_id)] + user_params)
+                # A statement of its own, the right-hand sides of one UPDATE
+                # see the values from before it
+                if spec['sql_refresh']:
+                    conn.execute(f'UPDATE {table} SET {spec["sql_refresh"]} WHERE id = ?{user_filter}',
+                                 [int(row_id)] + user_params)
+            changed_outside = self._bump_generation(conn)
+        if changed_outside:
+            notify_storage_change(None)
+
+    def delete(self, table, ids, versions=None, user=None):
+        user_filter, user_params = self._user_filter(user)
+        with self.lock, self.transaction() as conn:
+            if versions:
+                check_versions(table, self._versions(conn, table, ids, user), versions)
+            conn.executemany(f'DELETE FROM {table} WHERE id = ?{user_filter}',
+                             [[int(row_id)] + user_params for row_id in ids])
+            changed_outside = self._bump_generation(conn)
+        if changed_outside:
+            notify_storage_change(None)
+
+    def compact(self, table):
+        return True
+
+    # Move committed transactions from the write-ahead log into the database
+    # file, so the next start doesn't have to
+    def flush(self):
+        try:
+            with self.lock:
+                self.connection().execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            return True
+        except sqlite3.Error as e:
+            print(f"Error flushing the database: {str(e)}")
+            return False
+
+    def load_items(self, kind):
+        rows = self.connection().execute(f'SELECT name FROM {kind} ORDER BY rowid').fetchall()
+        return [row[0] for row in rows]
+
+    def items_stamp(self, kind):
+        return tuple(self.connection().execute(f'SELECT COUNT(*), MAX(rowid) FROM {kind}').fetchone())
+
+    def add_item(self, kind, item):
+        try:
+            with self.connection() as conn:
+                conn.execute(f'INSERT OR IGNORE INTO {kind} (name) VALUES (?)', (item,))
+            return True
+        except Exception as e:
+            print(f"Error adding item to {kind}: {str(e)}")
+            return False
+
+# Storage with every user's ledgers in their own CsvStorage (a shard) under
+# shards_dir, so a request reads, caches and rewrites only the rows of the
+# user it is for. Calls with a user, and inserts (by the rows' user), go to
+# that user's shard. Calls without one go to every shard and are meant for
+# the cross-user jobs: rebuilding aggregates and the item usage counts,
+# copying to SQLite and the admin commands. All shards share one write lock,
+# and ids come from sequences_json for all users, so they stay unique
+# across shards.
+class ShardedStorage:
+    def __init__(self, snapshot_format='csv'):
+        self.snapshot_format = snapshot_format
+        self.lock = threading.RLock()
+        self.write_lock = StorageLock(storage_lock_file, self.lock)
+        # The shared files in CSV_DIR, the websites and machines lists live there
+        self.shared = CsvStorage(snapshot_format, lock=self.lock, write_lock=self.write_lock)
+        self.shards = {}
+        self.split = False
+
+    # The first time the storage is used on a data directory without shards,
+    # split the shared tables by user. The shards are written next to
+    # shards_dir and moved into place when complete, so an interrupted split
+    # is simply done again. The shared files are left as they are but no
+    # longer read.
+    def _split_shared_tables(self):
+        if self.split:
+            return
+        with self.write_lock:
+            if not os.path.isdir(shards_dir):
+                temp_dir = shards_dir + '.tmp'
+                shutil.rmtree(temp_dir, ignore_errors=True)
+                for table in TABLES:
+                    df = self.shared.load(table)
+                    highest_id = int(df['id'].max()) if not df.empty else 0
+                    users = df['user'].fillna('').astype(str)
+                    for user, rows in df.groupby(users, sort=False):
+                        shard = CsvStorage(self.snapshot_format, os.path.join(temp_dir, self._shard_name(user)),
+                                           self.lock, self.write_lock)
+                        if not shard.save(table, rows):
+                            raise OSError(f"Failed to split {table}")
+                    # Keep the ids handed out so far from being given out again by a shard
+                    self.shared._allocate_ids(table, 0, highest_id)
+                os.makedirs(temp_dir, exist_ok=True)
+                os.replace(temp_dir, shards_dir)
+                _fsync_dir(os.path.dirname(shards_dir))
+            self.split = True
+
+    # Directory name of a user's shard. Rows without a user keep their own shard.
+    @staticmethod
+    def _shard_name(user):
+        name = str(user) if user not in (None, '') else '_unassigned'
+        if name in ('.', '..') or os.path.basename(name) != name:
+            raise ValueError(f"Invalid user code: {user!r}")
+        return name
+
+    def shard(self, user):
+        name = self._shard_name(user)
+        with self.lock:
+            if name not in self.shards:
+                self._split_shared_tables()
+                self.shards[name] = CsvStorage(
+                    self.snapshot_format, os.path.join(shards_dir, name), self.lock, self.write_lock)
+            return self.shards[name]
+
+    # Every shard on disk, for the calls without a user
+    def all_shards(self):
+        self._split_shared_tables()
+        names = sorted(name for name in os.listdir(shards_dir) if os.path.isdir(os.path.join(shards_dir, name)))
+        return [self.shard(name) for name in names]
+
+    def _empty(self, table):
+        return TABLES[table]['prepare'](pd.DataFrame(columns=TABLES[table]['columns']))
+
+    # Rows of all shards in one DataFrame, in id order like the shared table
+    def _concat(self, table, frames):
+        frames = [df for df in frames if not df.empty]
+        if not frames:
+            return self._empty(table)
+        return pd.concat(frames, ignore_index=True).sort_values('id', kind='stable', ignore_index=True)
+
+    def refresh(self):
+        with self.lock:
+            for shard in self.shards.values():
+                shard.refresh()
+
+    # Identifies the current contents of all tables
+    def stamp(self):
+        return repr([(shard.directory, shard.stamp()) for shard in self.all_shards()])
+
+    def load(self, table, user=None):
+        if user:
+            return self.shard(user).load(table)
+        return self._concat(table, [shard.load(table) for shard in self.all_shards()])
+
+    def raw_dates(self, table):
+        frames = [shard.raw_dates(table) for shard in self.all_shards()]
+        return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=['id', 'date'], dtype=object)
+
+    def get_rows(self, table, ids, user=None):
+        if user is not None:
+            return self.shard(user).get_rows(table, ids)
+        return self._concat(table, [shard.get_rows(table, ids) for shard in self.all_shards()])
+
+    def get_row(self, table, row_id, user=None):
+        if user is not None:
+            return self.shard(user).get_row(table, row_id)
+        for shard in self.all_shards():
+            row = shard.get_row(table, row_id)
+            if row is not None:
+                return row
+        return None
+
+    def iter_rows(self, table, user=None, chunk_size=1000):
+        shards = [self.shard(user)] if user else self.all_shards()
+        for shard in shards:
+            yield from shard.iter_rows(table, chunk_size=chunk_size)
+
+    def fingerprint(self, table, user):
+        return self.shard(user).fingerprint(table, user)
+
+    # Replace a table completely: every shard gets the rows of its user,
+    # shards of users without rows are emptied
+    def save(self, table, df):
+        with self.write_lock:
+            groups = dict(list(df.groupby(df['user'].fillna('').astype(str), sort=False))) if not df.empty else {}
+            shards = {self._shard_name(user): rows for user, rows in groups.items()}
+            for shard in self.all_shards():
+                shards.setdefault(os.path.basename(shard.directory), df.iloc[:0])
+            return all([self.shard(name).save(table, rows) for name, rows in shards.items()])
+
+    # The shards of ids that exist, [(shard, [ids])], for calls without a user
+    def _locate(self, table, ids, user):
+        if user is not None:
+            return [(self.shard(user), [int(row_id) for row_id in ids])]
+        located = []
+        remaining = {int(row_id) for row_id in ids}
+        for shard in self.all_shards():
+            if not remaining:
+                break
+            found = list(shard._versions(table, list(remaining)))
+            if found:
+                located.append((shard, found))
+                remaining.difference_update(found)
+        return located
+
+    # Inserts go to the shard of each row's user. Returns the new ids in the
+    # order of rows.
+    def insert(self, table, rows):
+        rows = list(rows)
+        groups = {}
+        for position, row in enumerate(rows):
+            groups.setdefault(row.get('user'), []).append(position)
+        ids = [None] * len(rows)
+        with self.write_lock:
+            for user, positions in groups.items():
+                new_ids = self.shard(user).insert(table, [rows[position] for position in positions])
+                for position, row_id in zip(positions, new_ids):
+                    ids[position] = row_id
+        return ids
+
+    def insert_frame(self, table, rows):
+        rows = rows.reset_index(drop=True)
+        ids = np.zeros(len(rows), dtype=int)
+        with self.write_lock:
+            for user, group in rows.groupby(rows['user'].fillna('').astype(str), sort=False):
+                ids[group.index.to_numpy()] = self.shard(user).insert_frame(table, group)
+        return ids.tolist()
+
+    # Versions of all affected rows are checked before any shard is written,
+    # so a stale row stops the whole update like on the other storages
+    def update(self, table, changes, versions=None, user=None):
+        with self.write_lock:
+            located = self._locate(table, changes, user)
+            for shard, ids in located:
+                check_versions(table, shard._versions(table, ids), versions)
+            for shard, ids in located:
+                ids = set(ids)
+                shard.update(table, {row_id: fields for row_id, fields in changes.items() if int(row_id) in ids},
+                             user=user)
+
+    def delete(self, table, ids, versions=None, user=None):
+        with self.write_lock:
+            located = self._locate(table, ids, user)
+            for shard, shard_ids in located:
+                check_versions(table, shard._versions(table, shard_ids), versions)
+            for shard, shard_ids in located:
+                shard.delete(table, shard_ids, user=user)
+
+    def compact(self, table):
+        return all([shard.compact(table) for shard in self.all_shards()])
+
+    # Only the shards this process opened can have pending records of its own
+    def flush(self):
+        with self.lock:
+            shards = [self.shared] + list(self.shards.values())
+        return all([shard.flush() for shard in shards])
+
+    def load_items(self, kind):
+        return self.shared.load_items(kind)
+
+    def items_stamp(self, kind):
+        return self.shared.items_stamp(kind)
+
+    def add_item(self, kind, item):
+        return self.shared.add_item(kind, item)
+
+# Create the CSV files once at startup
+initialize_csv_files()
+
+# Pick the storage backend from STORAGE_BACKEND
+def create_storage(backend):
+    if backend == 'sqlite':
+        return SqliteStorage(sqlite_path)
+    if backend == 'csv':
+        return CsvStorage(SNAPSHOT_FORMAT)
+    if backend == 'sharded':
+        return ShardedStorage(SNAPSHOT_FORMAT)
+    raise ValueError(f"Unknown storage backend: {backend}")
+
+# Copy everything from the CSV files (snapshots and journals) into a SQLite
+# database. Once the files were split by user, the shards are what is current.
+def import_csv_into_sqlite(target, source=None):
+    if source is None:
+        source = ShardedStorage(SNAPSHOT_FORMAT) if os.path.isdir(shards_dir) else CsvStorage(SNAPSHOT_FORMAT)
+    counts = {}
+    for table in TABLES:
+        df = source.load(table)
+        target.save(table, df)
+        counts[table] = len(df)
+    for kind in ['websites', 'machines']:
+        items = source.load_items(kind)
+        for item in items:
+            target.add_item(kind, item)
+        counts[kind] = len(items)
+    return counts
+
+storage = create_storage(STORAGE_BACKEND)
+
+# Where a request spends its time, see METRICS_ENABLED: load (reading
+# tables), write (storage writes), serialize (JSON encoding), render
+# (templates) and other, the rest, which is mostly pandas work in the routes.
+# Per route the latency histogram, the time per phase and the rows read and
+# written are added up and served by /metrics. The figures are per process.
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+METRICS_PHASES = ['load', 'write', 'serialize', 'render', 'other']
+
+request_log = logging.getLogger('gamba.requests')
+if METRICS_ENABLED and not request_log.handlers:
+    _log_handler = logging.StreamHandler()
+    _log_handler.setFormatter(logging.Formatter('%(message)s'))
+    request_log.addHandler(_log_handler)
+    request_log.setLevel(logging.INFO)
+    request_log.propagate = False
+
+class RequestMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.routes = {}
+
+    def record(self, route, method, status, duration, phases, rows_read, rows_written):
+        with self.lock:
+            entry = self.routes.get((route, method))
+            if entry is None:
+                entry = self.routes[(route, method)] = {
+                    'buckets': [0] * len(METRICS_BUCKETS), 'sum': 0.0, 'count': 0, 'statuses': {},
+                    'phases': dict.fromkeys(METRICS_PHASES, 0.0), 'rows_read': 0, 'rows_written': 0,
+                }
+            # Buckets are cumulative: each counts the requests that took at most its bound
+            for i, bound in enumerate(METRICS_BUCKETS):
+                if duration <= bound:
+                    entry['buckets'][i] += 1
+            entry['sum'] += duration
+            entry['count'] += 1
+            entry['statuses'][status] = entry['statuses'].get(status, 0) + 1
+            for phase, seconds in phases.items():
+                entry['phases'][phase] += seconds
+            entry['rows_read'] += rows_read
+            entry['rows_written'] += rows_written
+
+    # All figures in the Prometheus text format
+    def render(self):
+        def labels(**values):
+            escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+                       for value in values.values())
+            return '{' + ','.join(f'{key}="{value}"' for key, value in zip(values, escaped)) + '}'
+
+        lines = [
+            '# HELP gamba_request_duration_seconds Time to answer a request.',
+            '# TYPE gamba_request_duration_seconds histogram',
+        ]
+        with self.lock:
+            routes = sorted(self.routes.items())
+            for (route, method), entry in routes:
+                for bound, count in zip(METRICS_BUCKETS, entry['buckets']):
+                    lines.append(f'gamba_request_duration_seconds_bucket{labels(route=route, method=method, le=bound)} {count}')
+                lines.append(f'gamba_request_duration_seconds_bucket{labels(route=route, method=method, le="+Inf")} {entry["count"]}')
+                lines.append(f'gamba_request_duration_seconds_sum{labels(route=route, method=method)} {entry["sum"]}')
+                lines.append(f'gamba_request_duration_seconds_count{labels(route=route, method=method)} {entry["count"]}')
+            lines += ['# HELP gamba_requests_total Requests answered, by status.',
+                      '# TYPE gamba_requests_total counter']
+            for (route, method), entry in routes:
+                for status, count in sorted(entry['statuses'].items()):
+                    lines.append(f'gamba_requests_total{labels(route=route, method=method, status=status)} {count}')
+            lines += ['# HELP gamba_request_phase_seconds_total Time spent per phase of a request.',
+                      '# TYPE gamba_request_phase_seconds_total counter']
+            for (route, method), entry in routes:
+                for phase, seconds in entry['phases'].items():
+                    lines.append(f'gamba_request_phase_seconds_total{labels(route=route, method=method, phase=phase)} {seconds}')
+            for name, key, help_text in [('gamba_rows_read_total', 'rows_read', 'Ledger rows read.'),
+                                         ('gamba_rows_written_total', 'rows_written', 'Ledger rows written.')]:
+                lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+                for (route, method), entry in routes:
+                    lines.append(f'{name}{labels(route=route, method=method)} {entry[key]}')
+        return '\n'.join(lines) + '\n'
+
+request_metrics = RequestMetrics()
+
+# Measures one phase of the current request. Phases don't nest: the reads a
+# write makes count as part of the write.
+class _PhaseTimer:
+    def __init__(self, metrics, phase):
+        self.metrics = metrics
+        self.phase = phase
+        self.outer = False
+
+    def __enter__(self):
+        if self.metrics['phase'] is None:
+            self.outer = True
+            self.metrics['phase'] = self.phase
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.outer:
+            self.metrics['phases'][self.phase] += time.perf_counter() - self.start
+            self.metrics['phase'] = None
+
+def timed(phase):
+    if METRICS_ENABLED and has_request_context() and 'metrics' in g:
+        return _PhaseTimer(g.metrics, phase)
+    return contextlib.nullcontext()
+
+# Count ledger rows read or written ('rows_read', 'rows_written') by the current request
+def count_rows(key, count):
+    if METRICS_ENABLED and has_request_context() and 'metrics' in g:
+        g.metrics[key] += count
+
+# JSON encoding counts as the serialize phase
+class TimedJSONProvider(DefaultJSONProvider):
+    def dumps(self, obj, **kwargs):
+        with timed('serialize'):
+            return super().dumps(obj, **kwargs)
+
+app.json = TimedJSONProvider(app)
+
+@before_render_template.connect_via(app)
+def _start_render(sender, template, context, **extra):
+    if METRICS_ENABLED and 'metrics' in g:
+        g.metrics['render_timer'] = timed('render')
+        g.metrics['render_timer'].__enter__()
+
+@template_rendered.connect_via(app)
+def _end_render(sender, template, context, **extra):
+    if METRICS_ENABLED and 'metrics' in g and g.metrics.get('render_timer'):
+        g.metrics.pop('render_timer').__exit__(None, None, None)
+
+@app.before_request
+def start_request_metrics():
+    if not METRICS_ENABLED:
+        return
+    g.metrics = {'start': time.perf_counter(), 'phases': dict.fromkeys(METRICS_PHASES, 0.0),
+                 'phase': None, 'rows_read': 0, 'rows_written': 0, 'profile': None}
+    if PROFILE_SLOW_MS > 0:
+        g.metrics['profile'] = cProfile.Profile()
+        g.metrics['profile'].enable()
+
+# Record the request, log it as one JSON line and keep its profile if it was slow.
+# For streamed responses this covers the time until the body starts.
+@app.after_request
+def record_request_metrics(response):
+    metrics = g.pop('metrics', None)
+    if metrics is None:
+        return response
+    profile = metrics['profile']
+    if profile is not None:
+        profile.disable()
+    duration = time.perf_counter() - metrics['start']
+    phases = metrics['phases']
+    phases['other'] = max(duration - sum(phases.values()), 0.0)
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    request_metrics.record(route, request.method, response.status_code, duration, phases,
+                           metrics['rows_read'], metrics['rows_written'])
+
+    entry = {
+        'event': 'request', 'method': request.method, 'route': route, 'path': request.path,
+        'status': response.status_code, 'duration_ms': round(duration * 1000, 2),
+        'phases_ms': {phase: round(seconds * 1000, 2) for phase, seconds in phases.items()},
+        'rows_read': metrics['rows_read'], 'rows_written': metrics['rows_written'],
+        'user': session.get('user_code'),
+    }
+    if profile is not None and duration * 1000 >= PROFILE_SLOW_MS:
+        try:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            entry['profile'] = os.path.join(PROFILE_DIR, '{}-{}-{}ms.prof'.format(
+                datetime.now().strftime('%Y%m%d-%H%M%S-%f'), request.endpoint or 'unmatched', round(duration * 1000)))
+            profile.dump_stats(entry['profile'])
+        except OSError as e:
+            print(f"Error writing profile: {str(e)}")
+    request_log.info(json.dumps(entry))
+    return response
+
+# Compress big JSON and HTML responses, brotli preferred over gzip. Streamed
+# responses like /export are left alone. Registered after the metrics hook,
+# so it runs before it and the time counts as serialize.
+@app.after_request
+def compress_response(response):
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers or response.mimetype not in COMPRESS_MIMETYPES):
+        return response
+    response.vary.add('Accept-Encoding')
+    if response.content_length is not None and response.content_length < COMPRESS_MIN_BYTES:
+        return response
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        encoding = 'br'
+    elif accepted['gzip']:
+        encoding = 'gzip'
+    else:
+        return response
+    with timed('serialize'):
+        data = response.get_data()
+        if len(data) < COMPRESS_MIN_BYTES:
+            return response
+        if encoding == 'br':
+            data = brotli.compress(data, quality=5)
+        else:
+            data = gzip.compress(data, compresslevel=6)
+    response.set_data(data)
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+# Load a table with optional user filtering
+def load_table(table, user=None):
+    with timed('load'):
+        df = storage.load(table, user=user)
+    count_rows('rows_read', len(df))
+    return df
+
+# Look up a single row by id, returns a record (Gamble or BankTransaction) or
+# None. With user only that user's rows are looked at, which on the sharded
+# storage means only that user's shard is read.
+def get_row(table, row_id, user=None):
+    with timed('load'):
+        row = storage.get_row(table, row_id, user)
+    count_rows('rows_read', row is not None)
+    return row
+
+# Look up several rows by id, returns a DataFrame with the ones that exist
+# (and belong to user, if given)
+def get_rows(table, ids, user=None):
+    with timed('load'):
+        rows = storage.get_rows(table, ids, user)
+    count_rows('rows_read', len(rows))
+    return rows
+
+# The user all the given users are, or None if they are several
+def _single_user(users):
+    users = set(users)
+    return users.pop() if len(users) == 1 else None
+
+# Iterate over a table in DataFrame chunks with optional user filtering
+def iter_table(table, user=None, chunk_size=1000):
+    chunks = storage.iter_rows(table, user=user, chunk_size=chunk_size)
+    while True:
+        with timed('load'):
+            chunk = next(chunks, None)
+        if chunk is None:
+            return
+        count_rows('rows_read', len(chunk))
+        yield chunk
+
+# Replace a table completely
+def save_table(table, df):
+    with timed('write'):
+        saved = storage.save(table, df)
+        notify_storage_change(table)
+    count_rows('rows_written', len(df))
+    return saved
+
+# Insert new rows, giving each the next free id. Returns the new ids.
+def insert_rows(table, rows):
+    with timed('write'), storage.write_lock:
+        ids = storage.insert(table, rows)
+        if _change_listeners:
+            notify_storage_change(table, None, get_rows(table, ids, _single_user(row.get('user') for row in rows)))
+    with timed('write'):
+        journal_commits.wait()
+    count_rows('rows_written', len(ids))
+    return ids
+
+# Insert a DataFrame of new rows in one write, for bulk imports. Returns the new ids.
+def insert_frame(table, rows):
+    with timed('write'), storage.write_lock:
+        ids = storage.insert_frame(table, rows)
+        if _change_listeners:
+            notify_storage_change(table, None, get_rows(table, ids, _single_user(rows['user'])))
+    with timed('write'):
+        journal_commits.wait()
+    count_rows('rows_written', len(ids))
+    return ids
+
+# Update fields of existing rows, given as {id: {field: value}}. versions,
+# {id: version}, are the versions the client last saw; if any row has moved
+# on since, nothing is written and StaleRowError is raised. With user, rows
+# of other users are left alone.
+def update_rows(table, changes, versions=None, user=None):
+    if not changes:
+        return True
+    try:
+        with timed('write'), storage.write_lock:
+            old_rows = get_rows(table, list(changes), user) if _change_listeners else None
+            storage.update(table, changes, versions, user)
+            if _change_listeners:
+                notify_storage_change(table, old_rows, get_rows(table, list(changes), user))
+        with timed('write'):
+            journal_commits.wait()
+        count_rows('rows_written', len(changes))
+        return True
+    except StaleRowError:
+        raise
+    except Exception as e:
+        print(f"Error updating {table}: {str(e)}")
+        return False
+
+# Delete rows by id, checking versions and user like update_rows
+def delete_rows(table, ids, versions=None, user=None):
+    if not ids:
+        return True
+    try:
+        with timed('write'), storage.write_lock:
+            old_rows = get_rows(table, ids, user) if _change_listeners else None
+            storage.delete(table, ids, versions, user)
+            if _change_listeners:
+                notify_storage_change(table, old_rows, None)
+        with timed('write'):
+            journal_commits.wait()
+        count_rows('rows_written', len(ids))
+        return True
+    except StaleRowError:
+        raise
+    except Exception as e:
+        print(f"Error deleting from {table}: {str(e)}")
+        return False
+
+# Fold any pending journal back into the table's snapshot
+def compact_table(table):
+    return storage.compact(table)
+
+# Fold what is still pending into the canonical store when the process exits.
+# Acknowledged edits are safe in the journals either way; this leaves the
+# snapshots (or the SQLite database file) current for the next start and for
+# anything reading the files directly.
+@atexit.register
+def flush_storage():
+    try:
+        storage.flush()
+    except Exception as e:
+        print(f"Error flushing storage: {str(e)}")
+
+# Changes kept per user, older ones are dropped
+HISTORY_LIMIT = max(1, int(os.environ.get('HISTORY_LIMIT', 1000)))
+
+# Every write to a user's rows is kept as a numbered change in a JSON-lines
+# file per user in history_dir, e.g.
+#   {"change": 12, "time": 1718000000.0, "table": "gambles", "op": "update",
+#    "rows": [{"id": 5, "before": {"win": 10, "version": 3}, "after": {"win": 30, "version": 4}}]}
+# Updates keep only the fields that changed, inserts the new rows and deletes
+# the rows as they were, so a change costs what it touched, not the table.
+# Undoing a change writes its inverse and redoing one writes the inverse of
+# that undo; both are changes of their own, marked with undoes/redoes. The
+# first line of a file is {"op": "start", "time": ...}, the earliest time the
+# user's rows can be rewound to.
+class ChangeHistory:
+    def __init__(self, directory, limit):
+        self.directory = directory
+        self.limit = limit
+        os.makedirs(directory, exist_ok=True)
+        # Taken after storage.write_lock, never before it
+        self.lock = StorageLock(os.path.join(directory, 'history.lock'), threading.RLock())
+        self.users = {}
+        self.local = threading.local()
+
+    def _path(self, user):
+        return os.path.join(self.directory, ShardedStorage._shard_name(user) + '.jsonl')
+
+    # A user's changes, read from the file as far as it grew since the last
+    # call. The caller holds lock.
+    def _load(self, user):
+        path = self._path(user)
+        try:
+            stat = os.stat(path)
+            identity = (stat.st_dev, stat.st_ino)
+        except FileNotFoundError:
+            identity = None
+        entry = self.users.get(user)
+        # A new file (created, or trimmed by another worker) is read from the start
+        if entry is None or entry['identity'] != identity:
+            entry = {'identity': identity, 'offset': 0, 'since': None, 'changes': {}, 'undone': {}, 'applied': {}}
+            self.users[user] = entry
+        records, entry['offset'] = read_journal_from(path, entry['offset'])
+        for record in records:
+            if record.get('op') == 'start':
+                entry['since'] = record['time']
+                continue
+            change_id = record['change']
+            entry['changes'][change_id] = record
+            # undone: change -> the undo in effect; applied: change -> the
+            # change whose rows undoing it has to revert (itself or its latest redo)
+            if 'undoes' in record:
+                entry['undone'][record['undoes']] = change_id
+            if 'redoes' in record:
+                entry['undone'].pop(record['redoes'], None)
+                entry['applied'][record['redoes']] = change_id
+        return entry
+
+    # Rows of one user as {id: journal fields}
+    @staticmethod
+    def _rows(df, user):
+        if df is None:
+            return {}
+        rows = df[(df['user'] == user).to_numpy()]
+        return {int(row['id']): _journal_fields(row) for row in rows.to_dict(orient='records')}
+
+    # Storage change listener, see on_storage_change
+    def record(self, table, old_rows, new_rows):
+        frames = [rows for rows in (old_rows, new_rows) if rows is not None and not rows.empty]
+        if not frames or 'user' not in frames[0].columns:
+            return
+        users = set()
+        for rows in frames:
+            users.update(user for user in rows['user'].dropna().unique() if user != '')
+        for user in users:
+            before = self._rows(old_rows, user)
+            after = self._rows(new_rows, user)
+            if old_rows is None:
+                op, rows = 'insert', [{'id': row_id, 'after': fields} for row_id, fields in after.items()]
+            elif new_rows is None:
+                op, rows = 'delete', [{'id': row_id, 'before': fields} for row_id, fields in before.items()]
+            else:
+                op, rows = 'update', []
+                for row_id, fields in after.items():
+                    old = before.get(row_id)
+                    if old is None:
+                        continue
+                    changed = [field for field in fields
+                               if field != 'version' and not values_equal(old.get(field), fields[field])]
+                    rows.append({
+                        'id': row_id,
+                        'before': {field: old.get(field) for field in changed + ['version']},
+                        'after': {field: fields[field] for field in changed + ['version']},
+                    })
+            if rows:
+                self._append(user, dict(table=table, op=op, rows=rows, **(getattr(self.local, 'marker', None) or {})))
+
+    def _append(self, user, record):
+        with self.lock:
+            entry = self._load(user)
+            records = []
+            if entry['identity'] is None:
+                records.append({'op': 'start', 'time': time.time()})
+            record = dict(record, change=next(reversed(entry['changes']), 0) + 1, time=time.time())
+            append_journal(self._path(user), records + [record])
+            entry = self._load(user)
+            if len(entry['changes']) > 2 * self.limit:
+                self._trim(user, entry)
+        self.local.last = record['change']
+
+    # Keep the newest limit changes. Rows can then be rewound to just after
+    # the newest change dropped.
+    def _trim(self, user, entry):
+        changes = list(entry['changes'].values())
+        lines = [{'op': 'start', 'time': changes[-self.limit - 1]['time']}] + changes[-self.limit:]
+
+        def write(path):
+            with open(path, 'w', encoding='utf-8') as f:
+                f.writelines(json.dumps(line) + '\n' for line in lines)
+        replace_file(self._path(user), write)
+        self.users.pop(user, None)
+        self._load(user)
+
+    # Id of the change the current thread's latest write was recorded as
+    def last_change(self):
+        return getattr(self.local, 'last', None)
+
+    # A user's changes, newest first, without the row values
+    def changes(self, user, table=None, limit=50):
+        with self.lock:
+            entry = self._load(user)
+            changes = [change for change in reversed(entry['changes'].values())
+                       if table is None or change['table'] == table][:limit]
+            undone = dict(entry['undone'])
+        return [
+            dict({key: change[key] for key in ('change', 'time', 'table', 'op', 'undoes', 'redoes') if key in change},
+                 ids=[row['id'] for row in change['rows']], undone=change['change'] in undone)
+            for change in changes
+        ]
+
+    # Revert a change. Returns the id of the undo, the table and the ids of
+    # the rows it wrote, or None if there is no such change.
+    def undo(self, user, change_id):
+        with storage.write_lock, self.lock:
+            entry = self._load(user)
+            if change_id not in entry['changes']:
+                return None
+            if change_id in entry['undone']:
+                raise ValueError(f"Change {change_id} is already undone")
+            target = entry['changes'][entry['applied'].get(change_id, change_id)]
+            return self._revert(user, target, {'undoes': change_id})
+
+    # Apply an undone change again, by reverting its undo. Returns like undo.
+    def redo(self, user, change_id):
+        with storage.write_lock, self.lock:
+            entry = self._load(user)
+            if change_id not in entry['changes']:
+                return None
+            if change_id not in entry['undone']:
+                raise ValueError(f"Change {change_id} isn't undone")
+            return self._revert(user, entry['changes'][entry['undone'][change_id]], {'redoes': change_id})
+
+    # Write the inverse of a change. Rows edited since it was made are left
+    # alone and StaleRowError is raised. Deleted rows come back under new
+    # ids, ids are never given out twice.
+    def _revert(self, user, change, marker):
+        table, rows = change['table'], change['rows']
+        self.local.marker = marker
+        self.local.last = None
+        try:
+            if change['op'] == 'insert':
+                ids = [row['id'] for row in rows]
+                saved = delete_rows(table, ids, {row['id']: row['after'].get('version') for row in rows}, user)
+            elif change['op'] == 'delete':
+                ids = insert_rows(table, [
+                    {field: value for field, value in row['before'].items() if field not in ('id', 'version')}
+                    for row in rows
+                ])
+                saved = True
+            else:
+                ids = [row['id'] for row in rows]
+                saved = update_rows(
+                    table,
+                    {row['id']: {field: value for field, value in row['before'].items() if field != 'version'}
+                     for row in rows},
+                    {row['id']: row['after'].get('version') for row in rows},
+                    user,
+                )
+        finally:
+            self.local.marker = None
+        if not saved:
+            raise OSError(f"Failed to revert change {change['change']}")
+        if self.last_change() is None:
+            raise ValueError(f"The rows of change {change['change']} no longer exist")
+        return self.last_change(), table, ids
+
+    # A user's rows of a table (df, as loaded now) as they were at as_of,
+    # seconds since the epoch, by reverting the later changes newest first
+    def rewind(self, table, user, df, as_of):
+        with self.lock:
+            entry = self._load(user)
+            if entry['since'] is None or as_of < entry['since']:
+                since = datetime.fromtimestamp(entry['since'], timezone.utc).isoformat() if entry['since'] else None
+                raise ValueError(f"History goes back to {since}" if since else "No history recorded")
+            later = [change for change in entry['changes'].values() if change['time'] > as_of and change['table'] == table]
+        records = []
+        for change in reversed(later):
+            for row in change['rows']:
+                if change['op'] == 'insert':
+                    records.append({'op': 'delete', 'id': row['id']})
+                elif change['op'] == 'delete':
+                    records.append({'op': 'insert', 'row': row['before']})
+                else:
+                    records.append({'op': 'update', 'id': row['id'], 'fields': row['before']})
+        return apply_journal_records(table, df, records) if records else df
+
+change_history = ChangeHistory(history_dir, HISTORY_LIMIT)
+on_storage_change(change_history.record)
+
+# Load websites or machines, sorted
+def load_items(kind):
+    return item_registry.names(kind)
+
+# Add a website or machine if it isn't known yet
+def add_item(kind, item):
+    return item_registry.add(kind, item)
+
+# Load gambles with optional user filtering
+def load_gambles(user=None):
+    try:
+        return load_table('gambles', user=user)
     except Exception as e:
         print(f"Error loading gambles: {str(e)}")
-        return pd.DataFrame(columns=[
-            'id', 'date', 'website', 'machine', 'win', 'free_win', 
-            'free_win_m', 'note', 'start_amount', 'end_amount', 'user', 'profit'
-        ])
+        return pd.DataFrame(columns=GAMBLE_COLUMNS)
 
 # Save gambles to the CSV file with error handling
 def save_gambles(df):
+    return save_table('gambles', df)
+
+# Function to load bank transactions with optional user filtering
+def load_bank_transactions(user=None):
     try:
-        df.to_csv(gamble_csv, index=False)
-        return True
+        return load_table('bank', user=user)
     except Exception as e:
-        print(f"Error saving gambles: {str(e)}")
-        return False
+        print(f"Error loading bank transactions: {str(e)}")
+        return pd.DataFrame(columns=BANK_COLUMNS)
+
+# Save bank transactions to CSV
+def save_bank_transactions(df):
+    return save_table('bank', df)
 
-# Load items from simple CSV files (websites, machines)
+# Load items from simple CSV files (websites, machines). The files are UTF-8;
+# one saved with the DOS code page (cp850) is converted on first read, so
+# items appended later don't mix encodings.
 def load_items_from_csv(file_path):
     try:
         if os.path.exists(file_path):
-            with open(file_path, newline='') as f:
-                return [row[0] for row in csv.reader(f) if row]
+            with open(file_path, 'rb') as f:
+                data = f.read()
+            try:
+                text = data.decode('utf-8')
+            except UnicodeDecodeError:
+                text = data.decode('cp850')
+                print(f"Converting {file_path} to UTF-8")
+
+                def write(path):
+                    with open(path, 'wb') as f:
+                        f.write(text.encode('utf-8'))
+                replace_file(file_path, write)
+            return [row[0] for row in csv.reader(io.StringIO(text, newline='')) if row]
         return []
     except Exception as e:
         print(f"Error loading from {file_path}: {str(e)}")
         return []
 
-# Add a new item to a simple CSV file
+# Append a new item to a simple CSV file. The caller checks it isn't there yet.
 def add_item_to_csv(file_path, item):
     try:
-        items = load_items_from_csv(file_path)
-        if item not in items:
-            items.append(item)
-            with open(file_path, 'w', newline='') as f:
-                writer = csv.writer(f)
-                writer.writerows([[item] for item in items])
+        line = io.StringIO()
+        csv.writer(line).writerow([item])
+        with open(file_path, 'a+b') as f:
+            # Start on a new line if the file doesn't end with one
+            if f.tell() > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    f.write(b'\r\n')
+            f.write(line.getvalue().encode('utf-8'))
         return True
     except Exception as e:
         print(f"Error adding item to {file_path}: {str(e)}")
         return False
 
-# Format date from YYYY-MM-DD to DD-MM-YYYY for display
-def format_date_for_display(date_str):
-    try:
-        if not date_str or pd.isna(date_str):
-            return ''
-        parts = date_str.split('-')
-        if len(parts) == 3:
-            return f"{parts[2]}-{parts[1]}-{parts[0]}"
-        return date_str
-    except:
-        return date_str
-
-# Format date from DD-MM-YYYY to YYYY-MM-DD for storage
-def format_date_for_storage(date_str):
-    try:
-        if not date_str or pd.isna(date_str):
-            return ''
-        parts = date_str.split('-')
-        if len(parts) == 3:
-            return f"{parts[2]}-{parts[1]}-{parts[0]}"
-        return date_str
-    except:
-        return date_str
+# Ledger columns that refer to websites and machines, for usage counts
+ITEM_USAGE_COLUMNS = {
+    'websites': [('gambles', 'website'), ('bank', 'site')],
+    'machines': [('gambles', 'machine'), ('gambles', 'free_win_m')],
+}
+
+# Largest page of matches /search_items returns
+ITEM_SEARCH_PAGE_SIZE = 20
+
+# Websites and machines, kept in memory: a set for membership checks, the
+# sorted list for the dropdowns and, per user, how often every name is used
+# and which machines are played on which website. The lists are re-read only
+# when the storage's items change (another worker added one), new items are
+# appended. Usage is built per user on first search and then kept current
+# from storage change events, like the balance aggregates.
+class ItemRegistry:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.items = {}
+        self.usage = {}
+        self.usage_version = 0
+
+    def _entry(self, kind):
+        if kind not in ITEM_USAGE_COLUMNS:
+            raise ValueError(f"Unknown item kind: {kind}")
+        stamp = storage.items_stamp(kind)
+        entry = self.items.get(kind)
+        if entry is None or entry['stamp'] != stamp:
+            names = list(dict.fromkeys(name for name in storage.load_items(kind) if name))
+            entry = {'stamp': stamp, 'set': set(names), 'sorted': sorted(names, key=str.casefold)}
+            entry['folded'] = [name.casefold() for name in entry['sorted']]
+            self.items[kind] = entry
+        return entry
+
+    def names(self, kind):
+        with self.lock:
+            return list(self._entry(kind)['sorted'])
+
+    def contains(self, kind, name):
+        with self.lock:
+            return name in self._entry(kind)['set']
+
+    def add(self, kind, name):
+        with storage.write_lock, self.lock:
+            entry = self._entry(kind)
+            if name in entry['set']:
+                return True
+            if not storage.add_item(kind, name):
+                return False
+            # Keep the cache instead of re-reading the file we just appended to
+            position = bisect.bisect_right(entry['folded'], name.casefold())
+            entry['sorted'].insert(position, name)
+            entry['folded'].insert(position, name.casefold())
+            entry['set'].add(name)
+            entry['stamp'] = storage.items_stamp(kind)
+            return True
+
+    # Usage counts of one user's ledger rows: {kind: {name: count}} plus
+    # 'site_machines', {website: {machine: count}}
+    @staticmethod
+    def count_usage(tables):
+        usage = {kind: {} for kind in ITEM_USAGE_COLUMNS}
+        usage['site_machines'] = {}
+        for kind, columns in ITEM_USAGE_COLUMNS.items():
+            for table, column in columns:
+                rows = tables.get(table)
+                if rows is None or rows.empty:
+                    continue
+                for name, count in rows[column].dropna().astype(str).value_counts().items():
+                    if name:
+                        usage[kind][name] = usage[kind].get(name, 0) + int(count)
+        gambles = tables.get('gambles')
+        if gambles is not None and not gambles.empty:
+            pairs = gambles[['website', 'machine']].dropna().astype(str)
+            for (site, machine), count in pairs.value_counts().items():
+                if site and machine:
+                    usage['site_machines'].setdefault(site, {})[machine] = int(count)
+        return usage
+
+    @staticmethod
+    def _add_usage(usage, delta, sign):
+        for key, counts in delta.items():
+            if key == 'site_machines':
+                for site, machines in counts.items():
+                    target = usage['site_machines'].setdefault(site, {})
+                    for machine, count in machines.items():
+                        target[machine] = target.get(machine, 0) + sign * count
+            else:
+                for name, count in counts.items():
+                    usage[key][name] = usage[key].get(name, 0) + sign * count
+
+    def user_usage(self, user_code):
+        # Pick up writes made by other processes
+        storage.refresh()
+        with self.lock:
+            usage = self.usage.get(user_code)
+            version = self.usage_version
+        if usage is None:
+            usage = self.count_usage({'gambles': load_gambles(user=user_code),
+                                      'bank': load_bank_transactions(user=user_code)})
+            # Keep the result unless a write happened meanwhile
+            with self.lock:
+                if self.usage_version == version:
+                    self.usage[user_code] = usage
+        return usage
+
+    def update_usage(self, table, old_rows, new_rows):
+        if table not in (None, 'gambles', 'bank'):
+            return
+        with self.lock:
+            self.usage_version += 1
+            if old_rows is None and new_rows is None:
+                self.usage = {}
+                return
+            for rows, sign in ((old_rows, -1), (new_rows, 1)):
+                if rows is None or rows.empty:
+                    continue
+                for user_code, user_rows in rows.groupby('user'):
+                    if user_code in self.usage:
+                        self._add_usage(self.usage[user_code], self.count_usage({table: user_rows}), sign)
+
+    # Names of kind matching query for a user's dropdown: names starting with
+    # the query before names containing it, then the ones the user picks most.
+    # Machines the user has played on site come first. Returns one page of
+    # names and whether there are more.
+    def search(self, kind, query, user_code, site=None, offset=0, limit=ITEM_SEARCH_PAGE_SIZE):
+        usage = self.user_usage(user_code)
+        counts = usage[kind]
+        site_counts = usage['site_machines'].get(site, {}) if kind == 'machines' and site else {}
+        query = query.strip().casefold()
+        with self.lock:
+            entry = self._entry(kind)
+            matches = []
+            for name, folded in zip(entry['sorted'], entry['folded']):
+                position = folded.find(query)
+                if position >= 0:
+                    matches.append((position != 0, -site_counts.get(name, 0), -counts.get(name, 0), folded, name))
+        matches.sort()
+        return [match[-1] for match in matches[offset:offset + limit]], len(matches) > offset + limit
+
+item_registry = ItemRegistry()
+on_storage_change(item_registry.update_usage)
+
+# Dates are kept as datetime64 in memory and written as YYYY-MM-DD. Old files
+# also hold DD-MM-YYYY dates, both are read; migrate-dates rewrites them.
+DATE_FORMATS = {'iso': '%Y-%m-%d', 'dmy': '%d-%m-%Y'}
+
+# Parse a column of dates stored as YYYY-MM-DD or DD-MM-YYYY into datetimes.
+# Columns that already hold datetimes are returned as they are.
+def parse_dates(values):
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values if isinstance(values, pd.Series) else pd.Series(values)
+    values = pd.Series(values, dtype=object)
+    # Dates repeat a lot, so only the distinct strings are parsed
+    codes, uniques = pd.factorize(values, use_na_sentinel=False)
+    uniques = pd.Series(uniques, dtype=object)
+    parsed = pd.to_datetime(uniques, format=DATE_FORMATS['iso'], errors='coerce')
+    missing = parsed.isna()
+    if missing.any():
+        parsed[missing] = pd.to_datetime(uniques[missing], format=DATE_FORMATS['dmy'], errors='coerce')
+    return pd.Series(parsed.to_numpy()[codes], index=values.index)
+
+# Format a single date (YYYY-MM-DD or DD-MM-YYYY text, or a datetime) as
+# YYYY-MM-DD for storage. Returns '' for missing values and anything that
+# isn't a date.
+def format_date_for_storage(value):
+    if isinstance(value, np.datetime64):
+        value = pd.Timestamp(value)
+    if value is None or value is pd.NaT or (isinstance(value, float) and value != value):
+        return ''
+    if isinstance(value, date):
+        return value.strftime(DATE_FORMATS['iso'])
+    text = str(value).strip()
+    for date_format in DATE_FORMATS.values():
+        try:
+            return datetime.strptime(text, date_format).strftime(DATE_FORMATS['iso'])
+        except ValueError:
+            pass
+    return ''
+
+# Which format every stored date is in: 'iso', 'dmy', 'missing' or 'invalid'
+def classify_dates(values):
+    values = pd.Series(values, dtype=object)
+    text = values.where(values.notna(), '').astype(str).str.strip()
+    kinds = pd.Series('invalid', index=values.index, dtype=object)
+    kinds[text == ''] = 'missing'
+    # Dates written by pandas or SQLite with a time of day still count as ISO
+    iso = pd.to_datetime(text.str.slice(0, 10), format=DATE_FORMATS['iso'], errors='coerce').notna()
+    kinds[iso.to_numpy()] = 'iso'
+    dmy = pd.to_datetime(text, format=DATE_FORMATS['dmy'], errors='coerce').notna()
+    kinds[dmy.to_numpy()] = 'dmy'
+    return kinds
+
+# Copy of a DataFrame with its date columns as YYYY-MM-DD text, for JSON,
+# CSV and SQLite. Missing dates become NaN like other missing values.
+def dates_as_text(df):
+    dates = {col: df[col].dt.strftime(DATE_FORMATS['iso']) for col in df.columns
+             if pd.api.types.is_datetime64_any_dtype(df[col])}
+    return df.assign(**dates) if dates else df
+
+# Rows of a DataFrame as JSON-ready dicts, with dates as YYYY-MM-DD and
+# missing values as ''
+def json_records(df):
+    return dates_as_text(df).fillna('').to_dict(orient='records')
+
+# The same values column by column: {"length": n, "columns": {name: values}}.
+# Text columns with at most half as many distinct values as rows (websites,
+# machines, sites, dates, mostly empty notes) are sent as {"dictionary":
+# [distinct values], "codes": [index per row]}, so each value goes out once.
+def columnar_records(df):
+    df = dates_as_text(df).fillna('')
+    columns = {}
+    for col in df.columns:
+        values = df[col]
+        if values.dtype == object:
+            codes, uniques = pd.factorize(values, sort=False)
+            if len(uniques) * 2 <= len(values):
+                columns[col] = {'dictionary': uniques.tolist(), 'codes': codes.tolist()}
+                continue
+        columns[col] = values.tolist()
+    return {'length': len(df), 'columns': columns}
+
+# Rows in the format the client asked for with ?format=: 'records' (the
+# default, a list of row objects) or 'columnar', see columnar_records
+def encode_rows(df, args):
+    row_format = args.get('format', 'records')
+    if row_format == 'columnar':
+        return columnar_records(df)
+    if row_format == 'records':
+        return json_records(df)
+    raise ValueError(f"Unknown format: {row_format}")
+
+# Largest page the grids can ask for in one request
+MAX_PAGE_SIZE = 1000
+
+# The page the grids start with (PAGE_SIZE and gridQuery in their scripts).
+# The gambling and bank pages embed it, so showing them takes no data call.
+GRID_FIRST_PAGE = MultiDict({'offset': 0, 'limit': 200, 'sort': 'date', 'order': 'desc', 'format': 'columnar'})
+
+# Parse a date given in a query string, in either storage or display format
+def query_date(value):
+    parsed = parse_dates([value]).iloc[0]
+    if pd.isna(parsed):
+        raise ValueError(f"Invalid date: {value}")
+    return parsed
+
+# Parse a point in time given in a query string, seconds since the epoch or
+# an ISO date or time (UTC unless it says otherwise), into seconds since the epoch
+def query_time(value):
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        parsed = pd.Timestamp(value)
+    except ValueError:
+        parsed = pd.NaT
+    if pd.isna(parsed):
+        raise ValueError(f"Invalid time: {value}")
+    if parsed.tzinfo is None:
+        parsed = parsed.tz_localize('UTC')
+    return parsed.timestamp()
+
+# A user's rows of a table as they were at ?as_of=, if it is given, see
+# ChangeHistory.rewind
+def rows_as_of(table, user_code, df, args):
+    if not args.get('as_of'):
+        return df
+    return change_history.rewind(table, user_code, df, query_time(args['as_of']))
+
+# Filter, sort and page one user's rows of a table for the grids. Reads
+# offset, limit, sort, order, date_from, date_to, as_of and the table's
+# filter columns from the query string. Returns the page together with the
+# row count and column sums of the whole filtered set.
+def query_table(table, user_code, args):
+    spec = TABLES[table]
+    df = rows_as_of(table, user_code, load_table(table, user=user_code), args)
+    
+    offset = max(int(args.get('offset', 0)), 0)
+    limit = min(max(int(args.get('limit', MAX_PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+    sort = args.get('sort', 'id')
+    if sort not in spec['columns']:
+        raise ValueError(f"Can't sort on {sort}")
+    order = args.get('order', 'asc')
+    if order not in ('asc', 'desc'):
+        raise ValueError(f"Invalid sort order: {order}")
+    
+    # Date range and exact matches on the filter columns (repeat a parameter to match several values)
+    mask = np.ones(len(df), dtype=bool)
+    if args.get('date_from') or args.get('date_to'):
+        dates = df['date']
+        if args.get('date_from'):
+            mask &= (dates >= query_date(args['date_from'])).to_numpy()
+        if args.get('date_to'):
+            mask &= (dates <= query_date(args['date_to'])).to_numpy()
+    for column in spec['filters']:
+        values = [value for value in args.getlist(column) if value]
+        if values:
+            mask &= df[column].isin(values).to_numpy()
+    df = df[mask]
+    
+    # Numbers and dates sort by value, text case-insensitively
+    if sort in spec['numeric'] or sort == 'date':
+        key = None
+    else:
+        key = lambda column: column.fillna('').astype(str).str.lower()
+    df = df.sort_values(sort, ascending=order == 'asc', key=key, kind='stable', na_position='last')
+    
+    sums = {column: float(df[column].sum()) for column in spec['sums']}
+    if table == 'bank':
+        sums['net'] = float((df['amount'].to_numpy(dtype=float) * bank_signs(df['type'])).sum())
+    
+    page = df.iloc[offset:offset + limit]
+    return {
+        "rows": encode_rows(page, args),
+        "total": len(df),
+        "offset": offset,
+        "limit": limit,
+        "sums": sums,
+    }
+
+# What an import file may carry per table: required columns, the fields that
+# are read (typed like the table's record fields) and the columns that
+# identify a row that was already imported
+IMPORT_COLUMNS = {
+    'gambles': {
+        'required': ['date', 'website'],
+        'fields': ['date', 'website', 'machine', 'win', 'free_win', 'free_win_m', 'note', 'start_amount', 'end_amount'],
+        'dedupe': ['date', 'website', 'machine', 'win', 'free_win'],
+    },
+    'bank': {
+        'required': ['date', 'type', 'amount', 'site'],
+        'fields': BANK_INPUT_FIELDS,
+        'dedupe': ['date', 'type', 'amount', 'site'],
+    },
+}
+
+# csv or ndjson, from a file name
+def import_format_for(file_name):
+    extension = os.path.splitext(file_name or '')[1].lower()
+    return 'ndjson' if extension in ('.ndjson', '.jsonl', '.json') else 'csv'
+
+# Read an import file (path or file object) into a DataFrame of raw values
+def read_import_file(source, import_format):
+    if import_format == 'csv':
+        df = pd.read_csv(source, dtype=str, keep_default_na=False)
+    elif import_format == 'ndjson':
+        df = pd.read_json(source, lines=True, dtype=False, convert_dates=False)
+    else:
+        raise ValueError(f"Unknown import format: {import_format}")
+    df.columns = [str(col).strip().lower() for col in df.columns]
+    return df.reset_index(drop=True)
+
+# Check and type a whole import file column by column. Returns the typed rows
+# and {row position: [problems]} for the rows that can't be imported.
+def validate_import(table, df):
+    spec = IMPORT_COLUMNS[table]
+    missing = [col for col in spec['required'] if col not in df.columns]
+    if missing:
+        raise ValueError(f"Missing columns: {', '.join(missing)}")
+    
+    errors = {}
+    def flag(mask, message):
+        for position in np.flatnonzero(mask):
+            errors.setdefault(int(position), []).append(message)
+    
+    kinds = TABLES[table]['record'].kinds
+    rows = pd.DataFrame(index=df.index)
+    for col in spec['fields']:
+        # Every value as stripped text first, '' for missing ones
+        values = df[col] if col in df.columns else pd.Series([''] * len(df), dtype=object)
+        values = coerce_column('text', values).str.strip()
+        blank = (values == '').to_numpy()
+        if kinds[col] == 'date':
+            dates = coerce_column('date', values)
+            flag(dates.isna().to_numpy(), "date is missing or not a date")
+            rows[col] = dates.dt.strftime(DATE_FORMATS['iso'])
+            continue
+        if kinds[col] == 'text':
+            rows[col] = values
+        else:
+            numbers = pd.to_numeric(values.where(~blank, None), errors='coerce')
+            flag(numbers.isna().to_numpy() & ~blank, f"{col} is not a number")
+            rows[col] = coerce_column(kinds[col], numbers)
+        if col in spec['required']:
+            flag(blank, f"{col} is missing")
+    
+    if table == 'bank':
+        rows['type'] = rows['type'].str.lower()
+        flag(~rows['type'].isin(list(BANK_TYPE_SIGNS)).to_numpy() & (rows['type'] != '').to_numpy(),
+             f"type must be one of {', '.join(BANK_TYPE_SIGNS)}")
+    
+    return rows, errors
+
+# Comparable key of every row for spotting rows that were already imported
+def _import_keys(table, df):
+    keys = pd.DataFrame(index=df.index)
+    kinds = TABLES[table]['record'].kinds
+    for col in IMPORT_COLUMNS[table]['dedupe']:
+        values = df[col] if col in df.columns else pd.Series([''] * len(df), index=df.index, dtype=object)
+        if kinds[col] == 'date':
+            keys[col] = coerce_column('date', values).dt.strftime(DATE_FORMATS['iso']).fillna('')
+        elif kinds[col] == 'number':
+            keys[col] = coerce_column('number', values).round(2)
+        else:
+            keys[col] = coerce_column('text', values).str.strip()
+    return pd.MultiIndex.from_frame(keys)
+
+# Import a file of gambles or bank transactions for one user. Rows with
+# problems are reported and skipped, rows already stored (or repeated in the
+# file) are skipped as duplicates, and the rest are inserted in one write
+# with one block of ids. Returns a report of what happened.
+def import_history(table, user_code, df, dry_run=False):
+    rows, errors = validate_import(table, df)
+    valid = np.ones(len(rows), dtype=bool)
+    valid[list(errors)] = False
+    rows = rows[valid]
+    
+    with storage.write_lock:
+        existing = load_table(table, user=user_code)
+        keys = _import_keys(table, rows)
+        duplicate = keys.isin(_import_keys(table, existing)) | keys.duplicated()
+        rows = rows[~duplicate]
+        
+        ids = []
+        if not dry_run and not rows.empty:
+            ids = insert_frame(table, rows.assign(user=user_code))
+    
+    return {
+        "rows": len(df),
+        "imported": 0 if dry_run else len(ids),
+        "valid": len(rows),
+        "duplicates": int(duplicate.sum()),
+        "first_id": ids[0] if ids else None,
+        "last_id": ids[-1] if ids else None,
+        # 1 is the first row after the header
+        "errors": [{"row": position + 1, "errors": problems} for position, problems in sorted(errors.items())],
+    }
 
 # Main routes
 @app.route('/index')
 def index():
     return render_template('index.html')
 
-@app.route('/betting')
+# Matched bets: the grid and the form for a new bet
+@app.route('/betting', methods=['GET', 'POST'])
 def betting():
-    return render_template('betting.html')
+    # Check if user is logged in
+    if "user_code" not in session:
+        return redirect(url_for("login"))
+
+    user_code = session["user_code"]
+    
+    if request.method == 'POST':
+        # Lay stake, liability and profit are worked out by the Bet record
+        fields = Bet.coerce_fields(request.form, BET_INPUT_FIELDS)
+        try:
+            for field in ('kind', 'result'):
+                fields[field] = _bet_choice(field, fields.get(field, Bet.defaults[field]).strip().lower())
+        except ValueError as e:
+            return str(e), 400
+        insert_rows('bets', [Bet(**fields, user=user_code).to_dict()])
+        return redirect(url_for('betting'))
+    
+    return render_template(
+        'betting.html',
+        today=date.today().strftime('%Y-%m-%d'),
+        kinds=BET_KINDS,
+        commission=BET_COMMISSION,
+        user_code=user_code
+    )
 
 @app.route('/statistics')
 def statistics():
+    # Check if user is logged in
+    if "user_code" not in session:
+        return redirect(url_for("login"))
+
     return render_template('statistics.html')
 
 @app.route('/settings')
@@ -171,111 +3014,37 @@ def gambling():
     # Get user code from session
     user_code = session["user_code"]
     
-    # Initialize CSV files if they don't exist
-    initialize_csv_files()
-    
-    # Load websites and machines
-    websites = load_items_from_csv(websites_csv)
-    machines = load_items_from_csv(machines_csv)
-    
-    # Load gambles for this user only
-    gambles_df = load_gambles(user=user_code)
-    
     if request.method == 'POST':
-        # Extract form data
+        # Extract form data, typed like every other gamble
         form_id = request.form.get('id', '')
-        form_date = request.form.get('date', '')
-        form_website = request.form.get('website', '')
-        form_machine = request.form.get('machine', '')
-        form_win = request.form.get('win', '0')
-        form_free_win = request.form.get('free_win', '0')
-        form_free_win_m = request.form.get('free_win_m', 'None')
-        form_note = request.form.get('note', '')
-        form_start_amount = request.form.get('start_amount', '')
-        form_end_amount = request.form.get('end_amount', '')
+        fields = Gamble.coerce_fields(request.form, GAMBLE_INPUT_FIELDS)
         
         # Add website to websites.csv if it's new
-        if form_website and form_website not in websites:
-            add_item_to_csv(websites_csv, form_website)
-            websites.append(form_website)
+        if fields.get('website'):
+            add_item('websites', fields['website'])
             
         # Add machine to machines.csv if it's new and not empty
-        if form_machine and form_machine not in machines and form_machine != '':
-            add_item_to_csv(machines_csv, form_machine)
-            machines.append(form_machine)
-            
-        # Convert numeric values with error handling
-        try:
-            form_win = float(form_win) if form_win else 0.0
-            form_free_win = float(form_free_win) if form_free_win else 0.0
-            form_start_amount = float(form_start_amount) if form_start_amount else None
-            form_end_amount = float(form_end_amount) if form_end_amount else None
-            
-            # Calculate profit
-            form_profit = form_win + form_free_win
-        except ValueError:
-            form_win = 0.0
-            form_free_win = 0.0
-            form_profit = 0.0
-            form_start_amount = None
-            form_end_amount = None
-            
-        # Create a new gamble entry
-        new_gamble = {
-            'date': form_date,
-            'website': form_website,
-            'machine': form_machine if form_machine else None,
-            'win': form_win,
-            'free_win': form_free_win,
-            'free_win_m': form_free_win_m,
-            'note': form_note,
-            'start_amount': form_start_amount,
-            'end_amount': form_end_amount,
-            'profit': form_profit,
-            'user': user_code
-        }
+        if fields.get('machine'):
+            add_item('machines', fields['machine'])
         
         # Handle editing existing gamble or adding new one
-        if form_id and form_id.isdigit() and int(form_id) in gambles_df['id'].values:
-            # Editing existing gamble
+        if form_id and form_id.isdigit() and get_row('gambles', int(form_id), user_code) is not None:
+            # Editing one of this user's gambles
             gamble_id = int(form_id)
-            # Only allow editing if the gamble belongs to this user
-            if gambles_df.loc[gambles_df['id'] == gamble_id, 'user'].iloc[0] == user_code:
-                gambles_df.loc[gambles_df['id'] == gamble_id, new_gamble.keys()] = new_gamble.values()
+            update_rows('gambles', {gamble_id: fields}, user=user_code)
         else:
-            # Adding new gamble
-            # Load all gambles to get the next ID (not just this user's gambles)
-            all_gambles_df = load_gambles()
-            next_id = all_gambles_df['id'].max() + 1 if not all_gambles_df.empty else 1
-            new_gamble['id'] = next_id
-            new_gamble_df = pd.DataFrame([new_gamble])
-            # Get all gambles to append to
-            all_gambles_df = pd.concat([all_gambles_df, new_gamble_df], ignore_index=True)
-            # Save all gambles
-            save_gambles(all_gambles_df)
-            # Reload user's gambles
-            gambles_df = load_gambles(user=user_code)
-            
-            return redirect(url_for('gambling'))
-        
-    # Format dates for display in table
-    if not gambles_df.empty:
-        gambles_df['date'] = gambles_df['date'].apply(format_date_for_display)
-    
-    # Convert DataFrame to list of dicts for template
-    gambles_data = []
-    if not gambles_df.empty:
-        # Replace NaN values with empty strings for template
-        gambles_df_clean = gambles_df.fillna('')
-        gambles_data = gambles_df_clean.to_dict(orient='records')
+            # Adding new gamble: append it to the journal, the id is
+            # allocated from all users' gambles
+            insert_rows('gambles', [Gamble(**fields, user=user_code).to_dict()])
+
+        return redirect(url_for('gambling'))
         
-    # Render the template
+    # Render the page with the grid's first page, the rest is fetched from
+    # /get_all_gambles as the user scrolls
     return render_template(
         'gambling.html', 
         today=date.today().strftime('%Y-%m-%d'),
-        websites=websites, 
-        machines=machines, 
-        gambles=gambles_data,
+        first_page=query_table('gambles', user_code, GRID_FIRST_PAGE),
         user_code=user_code  # Pass the user code to the template
     )
 
@@ -287,25 +3056,15 @@ def get_gamble_data():
         return jsonify({"error": "You must be logged in"}), 401
 
     user_code = session["user_code"]
-    gambles_df = load_gambles()  # Load all gambles
     gamble_id = request.args.get('id')
     
     try:
         gamble_id = int(gamble_id)
-        gamble = gambles_df[gambles_df['id'] == gamble_id]
+        # Only the logged-in user's gambles are looked at, another user's gamble isn't found
+        gamble = get_row('gambles', gamble_id, user_code)
         
-        if not gamble.empty:
-            # Check if this gamble belongs to the logged-in user
-            if gamble.iloc[0]['user'] != user_code:
-                return jsonify({"error": "You don't have permission to view this gamble"}), 403
-                
-            # Convert to dict for JSON response
-            gamble_dict = gamble.iloc[0].to_dict()
-            # Handle NaN values
-            for key, value in gamble_dict.items():
-                if pd.isna(value):
-                    gamble_dict[key] = None
-            return jsonify(gamble_dict)
+        if gamble is not None:
+            return jsonify(gamble.to_json())
         else:
             return jsonify({"error": "Gamble not found"}), 404
     except Exception as e:
@@ -313,6 +3072,71 @@ def get_gamble_data():
 
 
 
+# Conditional GET for the JSON data endpoints. Every user's rows of a table
+# have a fingerprint (see CsvStorage.fingerprint) that is kept here until a
+# write touches the user's rows, so checking whether a client's copy is
+# current doesn't read the table. The time a fingerprint was first seen
+# serves as Last-Modified.
+_fingerprints = {'tables': {}, 'version': 0}
+_fingerprints_lock = threading.Lock()
+
+@on_storage_change
+def invalidate_fingerprints(table, old_rows, new_rows):
+    users = set()
+    for rows in (old_rows, new_rows):
+        if rows is not None and not rows.empty:
+            users.update(rows['user'].dropna().unique())
+    with _fingerprints_lock:
+        _fingerprints['version'] += 1
+        for (entry_table, user), entry in _fingerprints['tables'].items():
+            # Without rows the whole table (or with table None, everything) changed
+            if table is None or (entry_table == table and (not users or user in users)):
+                entry['stale'] = True
+
+# ETag and Last-Modified of a user's rows of the given tables
+def data_version(tables, user_code):
+    # Pick up writes made by other processes
+    storage.refresh()
+    fingerprints = []
+    modified = None
+    for table in tables:
+        key = (table, user_code)
+        with _fingerprints_lock:
+            entry = _fingerprints['tables'].get(key)
+            version = _fingerprints['version']
+        if entry is None or entry['stale']:
+            fingerprint = storage.fingerprint(table, user_code)
+            with _fingerprints_lock:
+                if entry is None or entry['fingerprint'] != fingerprint:
+                    entry = {'fingerprint': fingerprint,
+                             'modified': datetime.now(timezone.utc).replace(microsecond=0)}
+                # Keep the result unless a write happened meanwhile
+                entry['stale'] = _fingerprints['version'] != version
+                _fingerprints['tables'][key] = entry
+        fingerprints.append(entry['fingerprint'])
+        modified = entry['modified'] if modified is None else max(modified, entry['modified'])
+    etag = hashlib.sha1(repr((user_code, tables, fingerprints)).encode('utf-8')).hexdigest()[:20]
+    return etag, modified
+
+# Answer a GET for the logged-in user's data with an ETag and Last-Modified.
+# If the client's copy is current the answer is an empty 304 and build(),
+# which makes the full response, isn't called.
+def conditional_response(tables, user_code, build):
+    etag, modified = data_version(tables, user_code)
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains_weak(etag)
+    else:
+        not_modified = request.if_modified_since is not None and modified <= request.if_modified_since
+    response = Response(status=304) if not_modified else make_response(build())
+    if response.status_code in (200, 304):
+        # Weak, the same data may go out compressed or not
+        response.set_etag(etag, weak=True)
+        response.last_modified = modified
+        # Browsers keep the copy but check with the server before using it
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+    return response
+
 # Get all gamble data
 @app.route('/get_all_gambles', methods=['GET'])
 def get_all_gambles():
@@ -322,15 +3146,24 @@ def get_all_gambles():
 
     user_code = session["user_code"]
     
-    try:
-        # Load gambles from CSV for this user only
-        gambles_df = load_gambles(user=user_code)
+    def build():
+        # Paged, sorted and filtered when the grid asks for a page
+        if 'limit' in request.args or 'offset' in request.args:
+            return jsonify(query_table('gambles', user_code, request.args))
+        
+        # Load gambles from CSV for this user only, or as they were at ?as_of=
+        gambles_df = rows_as_of('gambles', user_code, load_gambles(user=user_code), request.args)
         
         # Convert DataFrame to list of dictionaries
-        gambles_data = gambles_df.fillna('').to_dict(orient='records')
+        gambles_data = encode_rows(gambles_df, request.args)
         
         # Return JSON response
         return jsonify(gambles_data)
+    
+    try:
+        return conditional_response(['gambles'], user_code, build)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -349,7 +3182,6 @@ def update_gamble():
     try:
         # Get JSON data from request
         data = request.get_json()
-        print(f"Received data from frontend (update_gamble): {data}")
         
         if not data or 'gamble' not in data:
             return jsonify({"success": False, "error": "Invalid data format"}), 400
@@ -358,55 +3190,38 @@ def update_gamble():
         
         # Extract and validate ID
         if 'id' not in gamble_data or not gamble_data['id']:
-            print(f"Error: Missing gamble ID. Data received: {gamble_data}")
+            print("Error: Missing gamble ID")
             return jsonify({"success": False, "error": "Missing gamble ID"}), 400
 
         try:
             gamble_id = int(gamble_data['id'])
         except ValueError:
-            print(f"Error: Invalid gamble ID format. Data received: {gamble_data}")
+            print("Error: Invalid gamble ID format")
             return jsonify({"success": False, "error": "Invalid gamble ID format"}), 400
 
-        # Load all gambles
-        gambles_df = load_gambles()
+        # Look up the gamble by id among this user's gambles
+        current = get_row('gambles', gamble_id, user_code)
 
         # Check if gamble exists
-        if gamble_id not in gambles_df['id'].values:
+        if current is None:
             print(f"Error: Gamble ID {gamble_id} not found in database.")
             return jsonify({"success": False, "error": f"Gamble ID {gamble_id} not found"}), 404
             
-        # Check if gamble belongs to this user
-        if gambles_df.loc[gambles_df['id'] == gamble_id, 'user'].iloc[0] != user_code:
-            return jsonify({"success": False, "error": "You don't have permission to update this gamble"}), 403
-            
-        # Update gamble fields
-        for field in gamble_data:
-            if field not in ['id', 'profit']:  # Exclude profit
-                # Handle numeric fields
-                if field in ['win', 'free_win', 'start_amount', 'end_amount']:
-                    try:
-                        if gamble_data[field] in (None, ''):
-                            gambles_df.loc[gambles_df['id'] == gamble_id, field] = 0 if field in ['win', 'free_win'] else None
-                        else:
-                            gambles_df.loc[gambles_df['id'] == gamble_id, field] = float(gamble_data[field])
-                    except ValueError:
-                        gambles_df.loc[gambles_df['id'] == gamble_id, field] = 0 if field in ['win', 'free_win'] else None
-                else:
-                    gambles_df.loc[gambles_df['id'] == gamble_id, field] = gamble_data[field]
+        # Collect the changed fields, profit is recalculated by the storage layer
+        fields = Gamble.coerce_fields(gamble_data, GAMBLE_INPUT_FIELDS)
 
-        
-        # Calculate profit after updating win and free_win
-        idx = gambles_df['id'] == gamble_id
-        win = gambles_df.loc[idx, 'win'].iloc[0] or 0
-        free_win = gambles_df.loc[idx, 'free_win'].iloc[0] or 0
-        gambles_df.loc[idx, 'profit'] = win + free_win
-                    
-        # Save updated gambles
-        if save_gambles(gambles_df):
-            return jsonify({"success": True, "message": f"Gamble {gamble_id} updated successfully"})
+        # Append the edit to the journal, unless the gamble changed since the client loaded it
+        if update_rows('gambles', {gamble_id: fields}, {gamble_id: gamble_data.get('version')}, user_code):
+            # The saved row carries the new profit and version for the grid
+            gamble = json_records(get_rows('gambles', [gamble_id], user_code))[0]
+            return jsonify({"success": True, "message": f"Gamble {gamble_id} updated successfully",
+                            "version": gamble['version'], "gamble": gamble,
+                            "change": change_history.last_change()})
         else:
             return jsonify({"success": False, "error": "Failed to save gambles data"}), 500
     
+    except StaleRowError as e:
+        return stale_rows_response(e, "gambles")
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
@@ -422,7 +3237,6 @@ def update_all_gambles():
     try:
         # Get JSON data from request
         data = request.get_json()
-        print(f"Received data from frontend (update_gamble): {data}")
 
         if not data or 'gambles' not in data:
             return jsonify({"success": False, "error": "Invalid data format"}), 400
@@ -433,54 +3247,42 @@ def update_all_gambles():
         if not all(isinstance(item, dict) for item in updated_gambles):
             return jsonify({"success": False, "error": "Invalid data format. Expected list of dictionaries."}), 400
 
-        # Load all gambles
-        all_gambles_df = load_gambles()
+        # Current values of the gambles that belong to this user, by id
+        user_gambles = {gamble.id: gamble for gamble in Gamble.from_frame(load_gambles(user=user_code))}
         
-        # Get IDs of gambles that belong to this user
-        user_gamble_ids = set(all_gambles_df[all_gambles_df['user'] == user_code]['id'].tolist())
-        
-        # Update each gamble if it belongs to this user
+        # Collect only the fields that actually changed for each of the user's gambles
+        changes = {}
+        versions = {}
         for updated_gamble in updated_gambles:
             try:
                 gamble_id = int(updated_gamble.get('id', 0))
                 
-                if gamble_id == 0 or gamble_id not in all_gambles_df['id'].values:
-                    continue
-                    
-                # Skip if this gamble doesn't belong to the user
-                if gamble_id not in user_gamble_ids:
+                # Skip unknown ids and gambles that don't belong to the user
+                if gamble_id == 0 or gamble_id not in user_gambles:
                     continue
                     
-                # Handle website, machine, etc.
-                for field in ['date', 'website', 'machine', 'free_win_m', 'note']:
-                    if field in updated_gamble:
-                        all_gambles_df.loc[all_gambles_df['id'] == gamble_id, field] = updated_gamble[field]
-                        
-                # Handle numeric fields
-                for field in ['win', 'free_win']:
-                    if field in updated_gamble:
-                        try:
-                            value = updated_gamble[field]
-                            all_gambles_df.loc[all_gambles_df['id'] == gamble_id, field] = float(value) if value not in (None, '') else 0
-                        except:
-                            all_gambles_df.loc[all_gambles_df['id'] == gamble_id, field] = 0
-                
-                # Calculate profit (win + free_win)
-                idx = all_gambles_df['id'] == gamble_id
-                win = all_gambles_df.loc[idx, 'win'].iloc[0] or 0
-                free_win = all_gambles_df.loc[idx, 'free_win'].iloc[0] or 0
-                all_gambles_df.loc[idx, 'profit'] = win + free_win
+                fields = Gamble.coerce_fields(updated_gamble, GRID_GAMBLE_FIELDS)
+                current = user_gambles[gamble_id]
+                fields = {
+                    field: value for field, value in fields.items()
+                    if not values_equal(getattr(current, field), value)
+                }
+                if fields:
+                    changes[gamble_id] = fields
+                    versions[gamble_id] = updated_gamble.get('version')
                 
             except Exception as e:
                 print(f"Error processing gamble {updated_gamble.get('id', 'unknown')}: {e}")
                 continue
         
-        # Save updated gambles
-        if save_gambles(all_gambles_df):
+        # Append the edits to the journal
+        if update_rows('gambles', changes, versions, user_code):
             return jsonify({"success": True, "message": "All gambles updated successfully"})
         else:
             return jsonify({"success": False, "error": "Failed to save gambles data"}), 500
     
+    except StaleRowError as e:
+        return stale_rows_response(e, "gambles")
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
@@ -489,6 +3291,69 @@ def update_all_gambles():
 
 
 
+# 409 answer for a save based on rows that were changed in the meantime. The
+# current rows are sent back under key so the grid can show them.
+def stale_rows_response(error, key):
+    rows = json_records(get_rows(error.table, error.ids, session["user_code"]))
+    return jsonify({"success": False, "error": str(error), key: rows}), 409
+
+# Fields of a gamble that can be edited in the grid
+GRID_GAMBLE_FIELDS = ['date', 'website', 'machine', 'win', 'free_win', 'free_win_m', 'note']
+
+# Apply only the cells that changed in the grid. Expects
+# {"changes": [{"id": 12, "field": "win", "value": 30}, ...]} and updates
+# the affected gambles by id, so the cost doesn't grow with the table.
+@app.route('/patch_gambles', methods=['PATCH'])
+def patch_gambles():
+    # Check if user is logged in
+    if "user_code" not in session:
+        return jsonify({"success": False, "error": "You must be logged in"}), 401
+
+    user_code = session["user_code"]
+    
+    try:
+        data = request.get_json()
+        if not data or not isinstance(data.get('changes'), list):
+            return jsonify({"success": False, "error": "Invalid data format"}), 400
+        
+        # Group the changed cells by gamble id, with the version each row had in the grid
+        changes = {}
+        versions = {}
+        for change in data['changes']:
+            if not isinstance(change, dict):
+                return jsonify({"success": False, "error": "Invalid data format. Expected list of changes."}), 400
+            field = change.get('field')
+            if field not in GRID_GAMBLE_FIELDS:
+                return jsonify({"success": False, "error": f"Field {field} can't be edited"}), 400
+            try:
+                gamble_id = int(change.get('id'))
+            except (TypeError, ValueError):
+                return jsonify({"success": False, "error": "Invalid gamble ID format"}), 400
+            changes.setdefault(gamble_id, {})[field] = coerce_value(Gamble.kinds[field], change.get('value'))
+            if 'version' in change:
+                versions[gamble_id] = change['version']
+        
+        if not changes:
+            return jsonify({"success": True, "gambles": []})
+        
+        # Check that every gamble exists among this user's gambles
+        found = set(get_rows('gambles', list(changes), user_code)['id'].tolist())
+        for gamble_id in changes:
+            if gamble_id not in found:
+                return jsonify({"success": False, "error": f"Gamble {gamble_id} not found"}), 404
+        
+        if not update_rows('gambles', changes, versions, user_code):
+            return jsonify({"success": False, "error": "Failed to save gambles data"}), 500
+        
+        # Send back the updated rows so the grid can refresh derived values like profit
+        updated = json_records(get_rows('gambles', list(changes), user_code))
+        return jsonify({"success": True, "gambles": updated, "change": change_history.last_change()})
+    
+    except StaleRowError as e:
+        return stale_rows_response(e, "gambles")
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+
 @app.route('/delete_gamble/<int:gamble_id>', methods=['POST'])
 def delete_gamble(gamble_id):
     # Check if user is logged in
@@ -498,19 +3363,19 @@ def delete_gamble(gamble_id):
     user_code = session["user_code"]
     
     try:
-        gambles_df = load_gambles()
+        gamble = get_row('gambles', gamble_id, user_code)
         
-        if gamble_id in gambles_df['id'].values:
-            # Check if this gamble belongs to the user
-            if gambles_df.loc[gambles_df['id'] == gamble_id, 'user'].iloc[0] != user_code:
-                return jsonify({"success": False, "error": "You don't have permission to delete this gamble"}), 403
-                
-            gambles_df = gambles_df[gambles_df['id'] != gamble_id]
-            save_gambles(gambles_df)
-            return jsonify({"success": True})
+        if gamble is not None:
+            # Log a tombstone for the gamble instead of rewriting the file
+            version = (request.get_json(silent=True) or {}).get('version')
+            if delete_rows('gambles', [gamble_id], {gamble_id: version}, user_code):
+                return jsonify({"success": True})
+            return jsonify({"success": False, "error": "Failed to delete gamble"}), 500
         else:
             return jsonify({"success": False, "error": f"Gamble {gamble_id} not found"}), 404
     
+    except StaleRowError as e:
+        return stale_rows_response(e, "gambles")
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
@@ -525,82 +3390,23 @@ def bank():
 
     user_code = session["user_code"]
     
-    # Initialize CSV files if they don't exist
-    initialize_csv_files()
-    
-    # Load bank transactions for this user
-    bank_df = load_bank_transactions(user=user_code)
-    
-    # Calculate user balance
-    balance_info = calculate_user_balance(user_code)
-    
     if request.method == 'POST':
-        # Extract form data
-        form_date = request.form.get('date', '')
-        form_type = request.form.get('type', '')
-        form_amount = request.form.get('amount', '0')
-        form_site = request.form.get('site', '')
-        
-        # Validate and convert amount
-        try:
-            form_amount = float(form_amount) if form_amount else 0.0
-        except ValueError:
-            form_amount = 0.0
-        
-        # Create a new transaction
-        new_transaction = {
-            'date': form_date,
-            'type': form_type,
-            'amount': form_amount,
-            'site': form_site,
-            'user': user_code
-        }
+        # Create a new transaction from the form data
+        fields = BankTransaction.coerce_fields(request.form, BANK_INPUT_FIELDS)
+        new_transaction = BankTransaction(**fields, user=user_code)
         
-        # Handle ID generation (max ID + 1)
-        if not bank_df.empty:
-            next_id = bank_df['id'].max() + 1
-        else:
-            next_id = 1  # If no transactions exist, start with 1
-        
-        new_transaction['id'] = next_id
-        
-        # Add transaction to DataFrame and save
-        all_transactions_df = load_bank_transactions()
-        new_transaction_df = pd.DataFrame([new_transaction])
-        all_transactions_df = pd.concat([all_transactions_df, new_transaction_df], ignore_index=True)
-        
-        if save_bank_transactions(all_transactions_df):
-            # Reload user's transactions and recalculate balance
-            bank_df = load_bank_transactions(user=user_code)
-            balance_info = calculate_user_balance(user_code)
-            return redirect(url_for('bank'))
-    
-    # Format dates for display
-    if not bank_df.empty:
-        bank_df['date'] = bank_df['date'].apply(format_date_for_display)
-    
-    # Convert DataFrame to list of dicts for template
-    transactions = []
-    if not bank_df.empty:
-        bank_df_clean = bank_df.fillna('')
-        transactions = bank_df_clean.to_dict(orient='records')
-    
-    # Get sites from existing transactions and gambling entries
-    gambling_df = load_gambles(user=user_code)
-    sites = pd.unique(pd.concat([
-        bank_df['site'].dropna(), 
-        gambling_df['website'].dropna()
-    ])).tolist()
-    
-    # Remove empty values
-    sites = [site for site in sites if site]
+        # Append the transaction to the journal, the id is allocated from
+        # all users' transactions
+        insert_rows('bank', [new_transaction.to_dict()])
+        return redirect(url_for('bank'))
     
+    # Balance from the running totals, and the grid's first page, the rest
+    # is fetched from /get_all_bank_transactions as the user scrolls
     return render_template(
         'bank.html',
         today=date.today().strftime('%Y-%m-%d'),
-        transactions=transactions,
-        sites=sites,
-        balance=balance_info,
+        first_page=query_table('bank', user_code, GRID_FIRST_PAGE),
+        balance=calculate_user_balance(user_code),
         user_code=user_code
     )
 
@@ -609,73 +3415,212 @@ def bank():
 
 
 
-# Function to load bank transactions from CSV
-def load_bank_transactions(user=None):
+# Sign of each bank transaction type: deposits add to the balance, withdrawals subtract
+BANK_TYPE_SIGNS = {'deposit': 1, 'withdrawal': -1}
+
+# +1/-1/0 for every transaction type. The types are factorized first so the
+# string handling runs once per distinct type instead of once per row.
+def bank_signs(types):
+    codes, uniques = pd.factorize(types)
+    signs = [BANK_TYPE_SIGNS.get(str(value).strip().lower(), 0) for value in uniques]
+    # code -1 (missing type) picks the trailing 0
+    return np.array(signs + [0], dtype=float)[codes]
+
+AGGREGATE_COLUMNS = ['gambling_profit', 'deposits', 'withdrawals', 'bank_balance', 'sessions']
+
+# Running totals per user, per site (users) and per month (months, keyed
+# YYYY-MM). A user's totals are built once from the ledgers and then kept
+# current from storage change events, so balance reads don't touch the
+# ledgers. They are saved to aggregates.json with the storage stamp they
+# match, so a restart only rebuilds them if the data changed in the meantime.
+_aggregates = {'users': {}, 'months': {}, 'loaded': False, 'version': 0}
+_aggregates_lock = threading.RLock()
+
+# Month of each date as YYYY-MM ('' when missing)
+def ledger_months(dates):
+    dates = pd.Series(dates)
+    if not pd.api.types.is_datetime64_any_dtype(dates):
+        dates = parse_dates(dates)
+    return dates.dt.strftime('%Y-%m').fillna('').to_numpy(dtype=object)
+
+# Totals contributed by some ledger rows, as {(user, site): {column: value}},
+# or with group='month' as {(user, month): {column: value}}
+def ledger_contributions(table, rows, group='site'):
+    if rows is None or rows.empty:
+        return {}
+    if table == 'gambles':
+        frame = pd.DataFrame({
+            'user': rows['user'].to_numpy(dtype=object),
+            'site': rows['website'].to_numpy(dtype=object),
+            'gambling_profit': rows['profit'].to_numpy(dtype=float),
+            'deposits': 0.0,
+            'withdrawals': 0.0,
+            'bank_balance': 0.0,
+            'sessions': 1,
+        })
+    else:
+        amounts = rows['amount'].to_numpy(dtype=float)
+        signed = amounts * bank_signs(rows['type'])
+        frame = pd.DataFrame({
+            'user': rows['user'].to_numpy(dtype=object),
+            'site': rows['site'].to_numpy(dtype=object),
+            'gambling_profit': 0.0,
+            'deposits': np.where(signed > 0, amounts, 0),
+            'withdrawals': np.where(signed < 0, amounts, 0),
+            'bank_balance': signed,
+            'sessions': 0,
+        })
+    if group == 'month':
+        frame['site'] = ledger_months(rows['date'])
+    frame['user'] = frame['user'].fillna('')
+    frame['site'] = frame['site'].fillna('')
+    return frame.groupby(['user', 'site'], sort=False)[AGGREGATE_COLUMNS].sum().to_dict(orient='index')
+
+# Add (sign=1) or remove (sign=-1) contributions. Only users in only_users
+# are touched when it is given, the others haven't been built yet.
+def _add_contributions(users, contributions, sign, only_users=None):
+    for (user, site), values in contributions.items():
+        if only_users is not None and user not in only_users:
+            continue
+        site_totals = users.setdefault(user, {}).setdefault(site, dict.fromkeys(AGGREGATE_COLUMNS, 0))
+        for col in AGGREGATE_COLUMNS:
+            site_totals[col] += sign * values[col]
+
+# Build the totals straight from the ledgers, for one user or for everybody.
+# Returns {'users': per site totals, 'months': per month totals}.
+def build_aggregates(user=None):
+    built = {'users': {}, 'months': {}}
+    for table in ['gambles', 'bank']:
+        rows = load_table(table, user=user)
+        _add_contributions(built['users'], ledger_contributions(table, rows), 1)
+        _add_contributions(built['months'], ledger_contributions(table, rows, 'month'), 1)
+    return built
+
+# Saving runs as a background job, so a burst of writes saves the file once.
+# write_lock keeps the stamp and the totals in step.
+def _save_aggregates():
     try:
-        if os.path.exists(bank_csv):
-            df = pd.read_csv(bank_csv)
-            
-            # Ensure all required columns exist
-            required_columns = ['date', 'type', 'amount', 'site', 'user']
-            for col in required_columns:
-                if col not in df.columns:
-                    df[col] = ''
-            
-            # Ensure numeric columns are numeric
-            try:
-                df['amount'] = pd.to_numeric(df['amount'], errors='coerce').fillna(0)
-            except:
-                df['amount'] = 0
-            
-            # Filter by user if specified
-            if user:
-                df = df[df['user'] == user]
-            
-            return df
-        else:
-            # Return empty DataFrame with required columns if file doesn't exist
-            return pd.DataFrame(columns=['date', 'type', 'amount', 'site', 'user'])
+        with storage.write_lock, _aggregates_lock:
+            data = {'stamp': storage.stamp(), 'users': _aggregates['users'], 'months': _aggregates['months']}
+
+            def write(path):
+                with open(path, 'w', encoding='utf-8') as f:
+                    json.dump(data, f)
+            replace_file(aggregates_json, write)
     except Exception as e:
-        print(f"Error loading bank transactions: {str(e)}")
-        return pd.DataFrame(columns=['date', 'type', 'amount', 'site', 'user'])
+        print(f"Error saving aggregates: {str(e)}")
 
-# Save bank transactions to CSV
-def save_bank_transactions(df):
+# Rebuild the totals of a user that were thrown away, in the background so
+# the next balance read doesn't have to. Returns the job id.
+def refresh_user_aggregates(user_code):
+    return jobs.submit('aggregates', user_code, get_user_aggregates, user_code, user=user_code)
+
+# Saved totals like build_aggregates returns them, or None if there are none
+# or they don't match the current data
+def load_saved_aggregates():
     try:
-        df.to_csv(bank_csv, index=False)
-        return True
-    except Exception as e:
-        print(f"Error saving bank transactions: {str(e)}")
-        return False
+        with open(aggregates_json, encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if data.get('stamp') != storage.stamp() or 'months' not in data:
+        return None
+    return {'users': data['users'], 'months': data['months']}
+
+# Keep the running totals current on every write
+@on_storage_change
+def update_aggregates(table, old_rows, new_rows):
+    if table not in (None, 'gambles', 'bank'):
+        return
+    reset = old_rows is None and new_rows is None
+    if not reset:
+        changes = {
+            key: (ledger_contributions(table, old_rows, group), ledger_contributions(table, new_rows, group))
+            for key, group in (('users', 'site'), ('months', 'month'))
+        }
+    with _aggregates_lock:
+        _aggregates['version'] += 1
+        built_users = set(_aggregates['users'])
+        if reset:
+            _aggregates['users'] = {}
+            _aggregates['months'] = {}
+        else:
+            for key, (removed, added) in changes.items():
+                _add_contributions(_aggregates[key], removed, -1, built_users)
+                _add_contributions(_aggregates[key], added, 1, built_users)
+    jobs.submit('save-aggregates', '', _save_aggregates)
+    # Users whose totals were thrown away get them rebuilt right away
+    if reset:
+        for user in built_users:
+            refresh_user_aggregates(user)
+
+# Copy of one user's totals per group, sorted by group, with total_balance
+def _user_totals(groups):
+    rows = {}
+    for name in sorted(groups):
+        rows[name] = dict(groups[name])
+        rows[name]['total_balance'] = rows[name]['gambling_profit'] + rows[name]['bank_balance']
+    return rows
+
+# A user's totals, per-site and per-month totals, served from the running totals
+def get_user_aggregates(user_code):
+    # Pick up writes made by other processes
+    storage.refresh()
+    with _aggregates_lock:
+        if not _aggregates['loaded']:
+            _aggregates.update(load_saved_aggregates() or {'users': {}, 'months': {}})
+            _aggregates['loaded'] = True
+        by_site = _aggregates['users'].get(user_code)
+        by_month = _aggregates['months'].get(user_code, {})
+        version = _aggregates['version']
+        if by_site is not None:
+            by_site = _user_totals(by_site)
+            by_month = _user_totals(by_month)
+
+    if by_site is None:
+        # First request for this user: build from the ledgers, and keep the
+        # result unless a write happened meanwhile
+        built = build_aggregates(user=user_code)
+        by_site = built['users'].get(user_code, {})
+        by_month = built['months'].get(user_code, {})
+        with _aggregates_lock:
+            if _aggregates['version'] == version:
+                _aggregates['users'][user_code] = by_site
+                _aggregates['months'][user_code] = by_month
+                jobs.submit('save-aggregates', '', _save_aggregates)
+        by_site = _user_totals(by_site)
+        by_month = _user_totals(by_month)
+
+    totals = dict.fromkeys(AGGREGATE_COLUMNS, 0)
+    for values in by_site.values():
+        for col in AGGREGATE_COLUMNS:
+            totals[col] += values[col]
+    totals['total_balance'] = totals['gambling_profit'] + totals['bank_balance']
+    return {'totals': totals, 'by_site': by_site, 'by_month': by_month}
+
+# Compare the running totals with a rebuild from the ledgers. Returns a list
+# of (user, site or month, column, running value, rebuilt value) that differ.
+def verify_aggregates(current, rebuilt):
+    mismatches = []
+    for user in set(current) | set(rebuilt):
+        current_sites = current.get(user, {})
+        rebuilt_sites = rebuilt.get(user, {})
+        for site in set(current_sites) | set(rebuilt_sites):
+            for col in AGGREGATE_COLUMNS:
+                a = current_sites.get(site, {}).get(col, 0)
+                b = rebuilt_sites.get(site, {}).get(col, 0)
+                if abs(a - b) > 1e-6:
+                    mismatches.append((user, site, col, a, b))
+    return mismatches
 
 # Calculate overall balance for a user
 def calculate_user_balance(user_code):
     try:
-        # Load gambling data
-        gambling_df = load_gambles(user=user_code)
-        
-        # Calculate total profit from gambling
-        gambling_profit = gambling_df['profit'].sum()
-        
-        # Load bank transactions
-        bank_df = load_bank_transactions(user=user_code)
-        
-        # Calculate balance from deposits/withdrawals
-        # Deposits add to balance, withdrawals subtract
-        bank_balance = 0
-        for _, row in bank_df.iterrows():
-            if row['type'].lower() == 'deposit':
-                bank_balance += row['amount']
-            elif row['type'].lower() == 'withdrawal':
-                bank_balance -= row['amount']
-        
-        # Total balance is gambling profit + bank transactions
-        total_balance = gambling_profit + bank_balance
-        
+        totals = get_user_aggregates(user_code)['totals']
         return {
-            'gambling_profit': gambling_profit,
-            'bank_balance': bank_balance,
-            'total_balance': total_balance
+            'gambling_profit': totals['gambling_profit'],
+            'bank_balance': totals['bank_balance'],
+            'total_balance': totals['total_balance']
         }
     except Exception as e:
         print(f"Error calculating balance: {str(e)}")
@@ -685,42 +3630,14 @@ def calculate_user_balance(user_code):
             'total_balance': 0
         }
 
-
-import pandas as pd
-
+# Calculate balance per website for a user (bank transactions use the 'site' column)
 def calculate_user_balance_by_website(user_code):
     try:
-        # Load gambling data
-        gambling_df = load_gambles(user=user_code)
-        
-        # Group gambling data by website and calculate profit for each website
-        gambling_profit_by_website = gambling_df.groupby('website')['profit'].sum().to_dict()
-        
-        # Load bank transactions
-        bank_df = load_bank_transactions(user=user_code)
-        
-        # Group bank transactions by website and calculate balance for each website
-        bank_balance_by_website = {}
-        for website, group in bank_df.groupby('website'):
-            balance = 0
-            for _, row in group.iterrows():
-                if row['type'].lower() == 'deposit':
-                    balance += row['amount']
-                elif row['type'].lower() == 'withdrawal':
-                    balance -= row['amount']
-            bank_balance_by_website[website] = balance
-        
-        # Calculate total balance for each website
-        total_balance_by_website = {}
-        for website in set(gambling_profit_by_website.keys()).union(bank_balance_by_website.keys()):
-            total_balance_by_website[website] = (
-                gambling_profit_by_website.get(website, 0) + bank_balance_by_website.get(website, 0)
-            )
-        
+        by_site = get_user_aggregates(user_code)['by_site']
         return {
-            'gambling_profit_by_website': gambling_profit_by_website,
-            'bank_balance_by_website': bank_balance_by_website,
-            'total_balance_by_website': total_balance_by_website
+            'gambling_profit_by_website': {site: row['gambling_profit'] for site, row in by_site.items()},
+            'bank_balance_by_website': {site: row['bank_balance'] for site, row in by_site.items()},
+            'total_balance_by_website': {site: row['total_balance'] for site, row in by_site.items()}
         }
     except Exception as e:
         print(f"Error calculating balance by website: {str(e)}")
@@ -730,6 +3647,269 @@ def calculate_user_balance_by_website(user_code):
             'total_balance_by_website': {}
         }
 
+# Gamble statistics for the statistics page: profit, sessions, win rate and
+# free wins per website and per machine, plus profit over time. They are
+# computed in one vectorized pass over the user's gambles and cached per
+# user until one of the user's gambles changes.
+STATISTICS_PERIODS = {'daily': '%Y-%m-%d', 'weekly': '%G-W%V', 'monthly': '%Y-%m'}
+STATISTICS_COLUMNS = ['profit', 'win', 'free_win', 'sessions', 'winning_sessions', 'free_win_sessions']
+
+_statistics = {'users': {}, 'version': 0}
+_statistics_lock = threading.Lock()
+
+# Sum every figure per group with np.bincount, one pass per figure, and add
+# the share of sessions that ended in profit
+def _statistics_rollup(values, codes, names):
+    sums = {col: np.bincount(codes, weights=values[col], minlength=len(names)) for col in STATISTICS_COLUMNS}
+    rollup = {}
+    for i in sorted(range(len(names)), key=lambda i: names[i]):
+        row = {col: float(sums[col][i]) for col in STATISTICS_COLUMNS}
+        for col in ('sessions', 'winning_sessions', 'free_win_sessions'):
+            row[col] = int(row[col])
+        row['win_rate'] = row['winning_sessions'] / row['sessions'] if row['sessions'] else 0.0
+        rollup[names[i]] = row
+    return rollup
+
+def _statistics_groups(column):
+    codes, names = pd.factorize(column.fillna('').astype(str).str.strip())
+    return codes, list(names)
+
+def compute_statistics(user_code):
+    gambles = load_gambles(user=user_code)
+
+    profit = gambles['profit'].to_numpy(dtype=float)
+    free_win = gambles['free_win'].to_numpy(dtype=float)
+    values = {
+        'profit': profit,
+        'win': gambles['win'].to_numpy(dtype=float),
+        'free_win': free_win,
+        'sessions': np.ones(len(gambles)),
+        'winning_sessions': (profit > 0).astype(float),
+        'free_win_sessions': (free_win != 0).astype(float),
+    }
+
+    totals = _statistics_rollup(values, np.zeros(len(gambles), dtype=int), ['all'])['all']
+    totals['free_win_share'] = totals['free_win'] / totals['profit'] if totals['profit'] else 0.0
+
+    # Free wins by the machine they were won on, counting only sessions with a free win
+    has_free_win = free_win != 0
+    free_values = {col: values[col][has_free_win] for col in STATISTICS_COLUMNS}
+    free_codes, free_names = _statistics_groups(gambles['free_win_m'][has_free_win])
+
+    # Dates repeat a lot, so only the distinct values are parsed and formatted
+    date_codes, distinct_dates = pd.factorize(gambles['date'], use_na_sentinel=False)
+    parsed = parse_dates(distinct_dates)
+    series = {}
+    for period, period_format in STATISTICS_PERIODS.items():
+        labels = parsed.dt.strftime(period_format).fillna('')
+        period_of_date, period_names = pd.factorize(labels)
+        rollup = _statistics_rollup(values, period_of_date[date_codes], list(period_names))
+        # Undated gambles count in the totals but have no place on the time axis
+        rollup.pop('', None)
+        cumulative = 0.0
+        for row in rollup.values():
+            cumulative += row['profit']
+            row['cumulative_profit'] = cumulative
+        series[period] = rollup
+
+    return {
+        'totals': totals,
+        'by_website': _statistics_rollup(values, *_statistics_groups(gambles['website'])),
+        'by_machine': _statistics_rollup(values, *_statistics_groups(gambles['machine'])),
+        'by_free_win_machine': _statistics_rollup(free_values, free_codes, free_names),
+        'series': series,
+    }
+
+# Drop the cached statistics of every user whose gambles changed
+@on_storage_change
+def invalidate_statistics(table, old_rows, new_rows):
+    if table not in (None, 'gambles'):
+        return
+    with _statistics_lock:
+        _statistics['version'] += 1
+        if old_rows is None and new_rows is None:
+            dropped = list(_statistics['users'])
+            _statistics['users'] = {}
+        else:
+            dropped = []
+            for rows in (old_rows, new_rows):
+                if rows is not None and not rows.empty:
+                    for user in rows['user'].dropna().unique():
+                        if _statistics['users'].pop(user, None) is not None:
+                            dropped.append(user)
+    # Statistics that were in use are computed again in the background
+    for user in dropped:
+        jobs.submit('statistics', user, get_user_statistics, user, user=user)
+
+# A user's statistics, from the cache when none of their gambles changed
+def get_user_statistics(user_code):
+    # Pick up writes made by other processes
+    storage.refresh()
+    with _statistics_lock:
+        stats = _statistics['users'].get(user_code)
+        version = _statistics['version']
+    if stats is None:
+        stats = compute_statistics(user_code)
+        # Keep the result unless a write happened meanwhile
+        with _statistics_lock:
+            if _statistics['version'] == version:
+                _statistics['users'][user_code] = stats
+    return stats
+
+# Rows per chunk written by /export
+EXPORT_CHUNK_SIZE = 1000
+
+# Stream the user's gambles, bank transactions or both for accounting:
+#   /export?table=gambles|bank|both&format=csv|ndjson&date_from=...&date_to=...
+# Rows are read, filtered and written one chunk at a time, so the response
+# starts right away and memory doesn't grow with the history. With
+# table=both, every row starts with the table it comes from.
+@app.route('/export', methods=['GET'])
+def export():
+    # Check if user is logged in
+    if "user_code" not in session:
+        return jsonify({"error": "You must be logged in"}), 401
+
+    user_code = session["user_code"]
+    
+    table = request.args.get('table', 'gambles')
+    export_format = request.args.get('format', 'csv')
+    if table not in ('gambles', 'bank', 'both'):
+        return jsonify({"error": f"Unknown table: {table}"}), 400
+    if export_format not in ('csv', 'ndjson'):
+        return jsonify({"error": f"Unknown format: {export_format}"}), 400
+    try:
+        date_from = query_date(request.args['date_from']) if request.args.get('date_from') else None
+        date_to = query_date(request.args['date_to']) if request.args.get('date_to') else None
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    tables = ['gambles', 'bank'] if table == 'both' else [table]
+    # The row version is internal bookkeeping, not part of the history
+    columns = {name: [col for col in TABLES[name]['columns'] if col != 'version'] for name in tables}
+    if table == 'both':
+        header = ['table'] + list(dict.fromkeys(columns['gambles'] + columns['bank']))
+    else:
+        header = columns[table]
+    
+    def generate():
+        if export_format == 'csv':
+            yield pd.DataFrame(columns=header).to_csv(index=False)
+        for name in tables:
+            for chunk in iter_table(name, user=user_code, chunk_size=EXPORT_CHUNK_SIZE):
+                if date_from is not None or date_to is not None:
+                    dates = chunk['date']
+                    if date_from is not None:
+                        chunk = chunk[(dates >= date_from).to_numpy()]
+                    if date_to is not None:
+                        chunk = chunk[(dates <= date_to).to_numpy()]
+                    if chunk.empty:
+                        continue
+                chunk = dates_as_text(chunk[columns[name]])
+                if table == 'both':
+                    chunk.insert(0, 'table', name)
+                if export_format == 'csv':
+                    yield chunk.reindex(columns=header).to_csv(index=False, header=False)
+                else:
+                    lines = chunk.to_json(orient='records', lines=True)
+                    yield lines if lines.endswith('\n') else lines + '\n'
+    
+    extension, mimetype = {'csv': ('csv', 'text/csv'), 'ndjson': ('ndjson', 'application/x-ndjson')}[export_format]
+    return Response(
+        stream_with_context(generate()),
+        mimetype=mimetype,
+        headers={"Content-Disposition": f"attachment; filename={table}-{user_code}.{extension}"},
+    )
+
+# Bulk import of a history file for the logged-in user. Expects a multipart
+# form with the file in 'file' and 'table' (gambles or bank); 'format' (csv or
+# ndjson) defaults to the file's extension, 'dry_run' only validates.
+@app.route('/import', methods=['POST'])
+def import_file():
+    # Check if user is logged in
+    if "user_code" not in session:
+        return jsonify({"success": False, "error": "You must be logged in"}), 401
+
+    user_code = session["user_code"]
+    
+    upload = request.files.get('file')
+    table = request.form.get('table', 'gambles')
+    if upload is None:
+        return jsonify({"success": False, "error": "No file uploaded"}), 400
+    if table not in IMPORT_COLUMNS:
+        return jsonify({"success": False, "error": f"Unknown table: {table}"}), 400
+    import_format = request.form.get('format') or import_format_for(upload.filename)
+    dry_run = request.form.get('dry_run') in ('1', 'true', 'on')
+    
+    try:
+        df = read_import_file(upload.stream, import_format)
+        report = import_history(table, user_code, df, dry_run=dry_run)
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+    
+    return jsonify(dict(report, success=True))
+
+# Balances for the bank page: totals, per site and per month, from the
+# running totals (see get_user_aggregates)
+@app.route('/get_balance', methods=['GET'])
+def get_balance():
+    # Check if user is logged in
+    if "user_code" not in session:
+        return jsonify({"error": "User not logged in"}), 401
+
+    user_code = session["user_code"]
+    try:
+        return conditional_response(['gambles', 'bank'], user_code,
+                                    lambda: jsonify(get_user_aggregates(user_code)))
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Statistics for the statistics page: totals, per website, per machine, free
+# wins per machine and daily/weekly/monthly time series
+@app.route('/get_statistics', methods=['GET'])
+def get_statistics():
+    # Check if user is logged in
+    if "user_code" not in session:
+        return jsonify({"error": "User not logged in"}), 401
+
+    user_code = session["user_code"]
+    try:
+        return conditional_response(['gambles'], user_code,
+                                    lambda: jsonify(get_user_statistics(user_code)))
+    except Exception as e:
+        print(f"Error computing statistics: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+# Typeahead for the website and machine dropdowns, in select2's format:
+#   /search_items?kind=machines&q=hav&site=Bet25&page=1
+# site puts the machines the user plays on that website first.
+@app.route('/search_items', methods=['GET'])
+def search_items():
+    # Check if user is logged in
+    if "user_code" not in session:
+        return jsonify({"error": "User not logged in"}), 401
+
+    kind = request.args.get('kind', '')
+    if kind not in ITEM_USAGE_COLUMNS:
+        return jsonify({"error": f"Unknown kind: {kind}"}), 400
+    try:
+        page = max(int(request.args.get('page', 1)), 1)
+    except ValueError:
+        return jsonify({"error": "Invalid page"}), 400
+
+    try:
+        names, more = item_registry.search(
+            kind, request.args.get('q', ''), session["user_code"],
+            site=request.args.get('site') or None,
+            offset=(page - 1) * ITEM_SEARCH_PAGE_SIZE,
+        )
+        return jsonify({"results": [{"id": name, "text": name} for name in names],
+                        "pagination": {"more": more}})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
 
 
 
@@ -741,9 +3921,13 @@ def get_all_bank_transactions():
 
     user_code = session["user_code"]
     
-    try:
-        # Load bank transactions for this user
-        bank_df = load_bank_transactions(user=user_code)
+    def build():
+        # Paged, sorted and filtered when the grid asks for a page
+        if 'limit' in request.args or 'offset' in request.args:
+            return jsonify(query_table('bank', user_code, request.args))
+        
+        # Load bank transactions for this user, or as they were at ?as_of=
+        bank_df = rows_as_of('bank', user_code, load_bank_transactions(user=user_code), request.args)
         
         # If the dataframe is empty, return an empty array
         if bank_df.empty:
@@ -754,57 +3938,75 @@ def get_all_bank_transactions():
             bank_df['id'] = bank_df.index + 1
         
         # Convert to dictionary format for JSON
-        transactions_list = bank_df.to_dict(orient='records')
+        transactions_list = encode_rows(bank_df, request.args)
         
         return jsonify(transactions_list)
+    
+    try:
+        return conditional_response(['bank'], user_code, build)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 
+# Fields of a bank transaction that can be edited in the grid
+GRID_BANK_FIELDS = ['date', 'type', 'amount', 'site']
 
-
-@app.route('/update_all_bank_transactions', methods=['POST'])
-def update_all_bank_transactions():
+# Apply only the cells that changed in the bank grid, same format as /patch_gambles.
+# The grid only holds the pages it has loaded, so it can't send the whole table.
+@app.route('/patch_bank_transactions', methods=['PATCH'])
+def patch_bank_transactions():
     # Check if user is logged in
     if "user_code" not in session:
-        return jsonify({"error": "User not logged in"}), 401
+        return jsonify({"success": False, "error": "User not logged in"}), 401
 
     user_code = session["user_code"]
     
     try:
-        # Get data from request
-        data = request.json
-        
-        if not data or 'transactions' not in data:
-            return jsonify({"error": "Invalid data format"}), 400
-        
-        transactions = data['transactions']
-        
-        # Convert to DataFrame
-        updated_df = pd.DataFrame(transactions)
+        data = request.get_json()
+        if not data or not isinstance(data.get('changes'), list):
+            return jsonify({"success": False, "error": "Invalid data format"}), 400
         
-        # Ensure 'user' column exists and set to current user
-        updated_df['user'] = user_code
+        # Group the changed cells by transaction id, with the version each row had in the grid
+        changes = {}
+        versions = {}
+        for change in data['changes']:
+            if not isinstance(change, dict):
+                return jsonify({"success": False, "error": "Invalid data format. Expected list of changes."}), 400
+            field = change.get('field')
+            if field not in GRID_BANK_FIELDS:
+                return jsonify({"success": False, "error": f"Field {field} can't be edited"}), 400
+            try:
+                transaction_id = int(change.get('id'))
+            except (TypeError, ValueError):
+                return jsonify({"success": False, "error": "Invalid transaction ID format"}), 400
+            changes.setdefault(transaction_id, {})[field] = coerce_value(BankTransaction.kinds[field], change.get('value'))
+            if 'version' in change:
+                versions[transaction_id] = change['version']
         
-        # Load all existing transactions
-        all_transactions_df = load_bank_transactions()
+        if not changes:
+            return jsonify({"success": True, "transactions": []})
         
-        # Remove this user's transactions from the existing data
-        other_users_df = all_transactions_df[all_transactions_df['user'] != user_code]
+        # Check that every transaction exists among this user's transactions
+        found = set(get_rows('bank', list(changes), user_code)['id'].tolist())
+        for transaction_id in changes:
+            if transaction_id not in found:
+                return jsonify({"success": False, "error": f"Transaction {transaction_id} not found"}), 404
         
-        # Combine with the updated transactions
-        combined_df = pd.concat([other_users_df, updated_df], ignore_index=True)
+        if not update_rows('bank', changes, versions, user_code):
+            return jsonify({"success": False, "error": "Failed to save transactions"}), 500
         
-        # Save to CSV
-        if save_bank_transactions(combined_df):
-            # Update the balance information
-            balance_info = calculate_user_balance(user_code)
-            return jsonify({"success": True, "balance": balance_info})
-        else:
-            return jsonify({"error": "Failed to save transactions"}), 500
-            
+        updated = json_records(get_rows('bank', list(changes), user_code))
+        return jsonify({"success": True, "transactions": updated, "change": change_history.last_change()})
+    
+    except StaleRowError as e:
+        return stale_rows_response(e, "transactions")
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return jsonify({"success": False, "error": str(e)}), 500
+
+
+
 
 # Delete a bank transaction
 @app.route('/delete_bank_transaction/<transaction_id>', methods=['POST'])
@@ -815,29 +4017,156 @@ def delete_bank_transaction(transaction_id):
     user_code = session["user_code"]
     
     try:
-        # Load all transactions
-        all_transactions_df = load_bank_transactions()
-        
         # Convert transaction_id to int
         transaction_id = int(transaction_id)
         
         # Find the transaction with the given ID
-        transaction_mask = (all_transactions_df['id'] == transaction_id) & (all_transactions_df['user'] == user_code)
+        transaction = get_row('bank', transaction_id, user_code)
         
-        if not transaction_mask.any():
+        if transaction is None:
             return jsonify({"error": "Transaction not found"}), 404
             
-        # Remove the transaction
-        all_transactions_df = all_transactions_df[~transaction_mask]
-        
-        # Save the updated dataframe
-        if save_bank_transactions(all_transactions_df):
-            # Recalculate balance
-            balance_info = calculate_user_balance(user_code)
-            return jsonify({"success": True, "balance": balance_info})
+        # Log a tombstone for the transaction instead of rewriting the file
+        version = (request.get_json(silent=True) or {}).get('version')
+        if delete_rows('bank', [transaction_id], {transaction_id: version}, user_code):
+            return jsonify({"success": True})
         else:
             return jsonify({"error": "Failed to delete transaction"}), 500
             
+    except StaleRowError as e:
+        return stale_rows_response(e, "transactions")
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Get the user's bets, paged for the grid like the bank transactions
+@app.route('/get_all_bets', methods=['GET'])
+def get_all_bets():
+    # Check if user is logged in
+    if "user_code" not in session:
+        return jsonify({"error": "User not logged in"}), 401
+
+    user_code = session["user_code"]
+    
+    def build():
+        if 'limit' in request.args or 'offset' in request.args:
+            return jsonify(query_table('bets', user_code, request.args))
+        return jsonify(encode_rows(rows_as_of('bets', user_code, load_table('bets', user=user_code), request.args),
+                                   request.args))
+    
+    try:
+        return conditional_response(['bets'], user_code, build)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Check a bet's kind or result from the grid, '' is an open bet
+def _bet_choice(field, value):
+    choices = BET_KINDS if field == 'kind' else [''] + BET_RESULTS
+    if value not in choices:
+        raise ValueError(f"{field} must be one of {', '.join(repr(choice) for choice in choices)}")
+    return value
+
+# Apply the cells that changed in the bets grid, same format as /patch_gambles.
+# Changing the odds of many open bets is one write, and their lay stakes and
+# profits are worked out again in one go. The bets are sent back with the
+# new values.
+@app.route('/patch_bets', methods=['PATCH'])
+def patch_bets():
+    # Check if user is logged in
+    if "user_code" not in session:
+        return jsonify({"success": False, "error": "User not logged in"}), 401
+
+    user_code = session["user_code"]
+    
+    try:
+        data = request.get_json()
+        if not data or not isinstance(data.get('changes'), list):
+            return jsonify({"success": False, "error": "Invalid data format"}), 400
+        
+        # Group the changed cells by bet id, with the version each row had in the grid
+        changes = {}
+        versions = {}
+        for change in data['changes']:
+            if not isinstance(change, dict):
+                return jsonify({"success": False, "error": "Invalid data format. Expected list of changes."}), 400
+            field = change.get('field')
+            if field not in BET_INPUT_FIELDS:
+                return jsonify({"success": False, "error": f"Field {field} can't be edited"}), 400
+            try:
+                bet_id = int(change.get('id'))
+            except (TypeError, ValueError):
+                return jsonify({"success": False, "error": "Invalid bet ID format"}), 400
+            value = Bet.coerce_field(field, change.get('value'))
+            if field in ('kind', 'result'):
+                try:
+                    value = _bet_choice(field, value.strip().lower())
+                except ValueError as e:
+                    return jsonify({"success": False, "error": str(e)}), 400
+            changes.setdefault(bet_id, {})[field] = value
+            if 'version' in change:
+                versions[bet_id] = change['version']
+        
+        if not changes:
+            return jsonify({"success": True, "bets": []})
+        
+        # Check that every bet exists among this user's bets
+        found = set(get_rows('bets', list(changes), user_code)['id'].tolist())
+        for bet_id in changes:
+            if bet_id not in found:
+                return jsonify({"success": False, "error": f"Bet {bet_id} not found"}), 404
+        
+        if not update_rows('bets', changes, versions, user_code):
+            return jsonify({"success": False, "error": "Failed to save bets"}), 500
+        
+        updated = json_records(get_rows('bets', list(changes), user_code))
+        return jsonify({"success": True, "bets": updated, "change": change_history.last_change()})
+    
+    except StaleRowError as e:
+        return stale_rows_response(e, "bets")
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+
+# Delete a bet
+@app.route('/delete_bet/<int:bet_id>', methods=['POST'])
+def delete_bet(bet_id):
+    # Check if user is logged in
+    if "user_code" not in session:
+        return jsonify({"success": False, "error": "User not logged in"}), 401
+
+    user_code = session["user_code"]
+    
+    try:
+        if get_row('bets', bet_id, user_code) is None:
+            return jsonify({"success": False, "error": f"Bet {bet_id} not found"}), 404
+        
+        version = (request.get_json(silent=True) or {}).get('version')
+        if delete_rows('bets', [bet_id], {bet_id: version}, user_code):
+            return jsonify({"success": True})
+        return jsonify({"success": False, "error": "Failed to delete bet"}), 500
+    
+    except StaleRowError as e:
+        return stale_rows_response(e, "bets")
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+
+# Work out lay stakes and profits without storing anything, e.g. to try
+# other odds before placing a bet. Expects {"bets": [{"back_stake": 10,
+# "back_odds": 3, "lay_odds": 3.1, ...}, ...]} and returns the derived
+# values of each bet in the same order.
+@app.route('/calculate_bets', methods=['POST'])
+def calculate_bets():
+    # Check if user is logged in
+    if "user_code" not in session:
+        return jsonify({"error": "User not logged in"}), 401
+
+    data = request.get_json(silent=True)
+    if not data or not isinstance(data.get('bets'), list) or not all(isinstance(bet, dict) for bet in data['bets']):
+        return jsonify({"error": "Invalid data format"}), 400
+    
+    try:
+        bets = prepare_bets(pd.DataFrame(data['bets'], columns=BET_INPUT_FIELDS))
+        return jsonify({"bets": bets[BET_DERIVED_COLUMNS].to_dict(orient='records')})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -878,7 +4207,7 @@ def dashboard():
     gambles_df = load_gambles(user=user_code)
     
     # Filter the data to only show the logged-in user's entries
-    user_gambles_list = gambles_df.fillna('').to_dict(orient='records')
+    user_gambles_list = json_records(gambles_df)
 
     return render_template("dashboard.html", gambles=user_gambles_list, user_code=user_code)
 
@@ -889,9 +4218,208 @@ def logout():
     response.set_cookie("user_code", "", expires=0)  # Remove cookie
     return response
 
+# Request metrics in the Prometheus text format, only with METRICS_ENABLED
+# and only for requests from this machine
+@app.route('/metrics')
+def metrics():
+    if not METRICS_ENABLED:
+        return jsonify({"error": "Metrics are disabled"}), 404
+    if request.remote_addr not in ('127.0.0.1', '::1'):
+        return jsonify({"error": "Metrics are only served locally"}), 403
+    return Response(request_metrics.render(), mimetype='text/plain; version=0.0.4')
+
+# Status of a background job, e.g. the rebuild of a user's running totals
+# after they were thrown away. Jobs of other users are not shown.
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    if "user_code" not in session:
+        return jsonify({"error": "User not logged in"}), 401
+
+    job = jobs.get(job_id)
+    if job is None or job['user'] not in (None, session["user_code"]):
+        return jsonify({"error": "Job not found"}), 404
+    del job['user']
+    return jsonify(job)
+
+# Recent changes to the logged-in user's rows, newest first. ?table= limits
+# them to one table and ?limit= to that many (default 50).
+@app.route('/history', methods=['GET'])
+def history():
+    if "user_code" not in session:
+        return jsonify({"error": "User not logged in"}), 401
+
+    try:
+        table = request.args.get('table') or None
+        if table is not None and table not in TABLES:
+            raise ValueError(f"Unknown table: {table}")
+        limit = max(int(request.args.get('limit', 50)), 1)
+        return jsonify({"changes": change_history.changes(session["user_code"], table, limit)})
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Undo or redo one of the logged-in user's changes by the id /history and the
+# patch endpoints give out. The answer carries the id of the change this made
+# and the rows it wrote as they are now. A row edited again since isn't
+# overwritten; that is a 409 with its current values, like a stale save.
+@app.route('/undo/<int:change_id>', methods=['POST'])
+def undo_change(change_id):
+    return revert_change(change_id, change_history.undo)
+
+@app.route('/redo/<int:change_id>', methods=['POST'])
+def redo_change(change_id):
+    return revert_change(change_id, change_history.redo)
+
+def revert_change(change_id, revert):
+    if "user_code" not in session:
+        return jsonify({"success": False, "error": "You must be logged in"}), 401
+
+    user_code = session["user_code"]
+
+    try:
+        reverted = revert(user_code, change_id)
+        if reverted is None:
+            return jsonify({"success": False, "error": f"Change {change_id} not found"}), 404
+        change, table, ids = reverted
+        return jsonify({"success": True, "change": change, "table": table,
+                        "rows": json_records(get_rows(table, ids, user_code))})
+    except StaleRowError as e:
+        return stale_rows_response(e, "rows")
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 409
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+
+# One-shot import of the CSV files into the SQLite database:
+#   flask --app app import-csv
+@app.cli.command('import-csv')
+def import_csv_command():
+    counts = import_csv_into_sqlite(SqliteStorage(sqlite_path))
+    for name, count in counts.items():
+        print(f"Imported {count} rows into {name}")
+
+# Write the current contents of every table (snapshot + journal) as a
+# snapshot in another format, e.g. to export CSV files or before switching
+# SNAPSHOT_FORMAT:
+#   flask --app app write-snapshots csv
+# Journals are kept, replaying them on top of the new snapshots is harmless.
+@app.cli.command('write-snapshots')
+@click.argument('snapshot_format', type=click.Choice(list(SNAPSHOT_EXTENSIONS)))
+def write_snapshots_command(snapshot_format):
+    if snapshot_format != 'csv' and pyarrow is None:
+        raise click.ClickException(f"Snapshot format {snapshot_format} needs pyarrow")
+    # The sharded storage has a snapshot per user
+    shards = storage.all_shards() if isinstance(storage, ShardedStorage) else [None]
+    for table in TABLES:
+        for shard in shards:
+            with storage.write_lock:
+                if shard is None:
+                    df = storage.load(table)
+                    path = snapshot_path(table, snapshot_format)
+                else:
+                    df = shard.load(table)
+                    path = shard.snapshot_path(table, snapshot_format)
+                write_snapshot(table, df, path, snapshot_format)
+            print(f"Wrote {len(df)} rows to {path}")
+
+# Bulk import a history file for one user:
+#   flask --app app import-history sessions.csv --table gambles --user user1
+@app.cli.command('import-history')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--table', type=click.Choice(list(IMPORT_COLUMNS)), default='gambles')
+@click.option('--user', 'user_code', type=click.Choice(VALID_USERS), required=True)
+@click.option('--format', 'import_format', type=click.Choice(['csv', 'ndjson']), default=None,
+              help="Defaults to the file's extension.")
+@click.option('--dry-run', is_flag=True, help="Only validate the file.")
+def import_history_command(path, table, user_code, import_format, dry_run):
+    try:
+        df = read_import_file(path, import_format or import_format_for(path))
+        report = import_history(table, user_code, df, dry_run=dry_run)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    for error in report['errors']:
+        print(f"Row {error['row']}: {'; '.join(error['errors'])}")
+    print(f"{report['imported']} imported, {report['duplicates']} duplicates, "
+          f"{len(report['errors'])} rows with errors")
+
+# Rebuild the running totals from the ledgers, optionally checking the saved
+# ones against the rebuild first:
+#   flask --app app rebuild-aggregates --verify
+@app.cli.command('rebuild-aggregates')
+@click.option('--verify', is_flag=True, help='Report totals that differ from the ledgers.')
+def rebuild_aggregates_command(verify):
+    rebuilt = build_aggregates()
+    mismatches = []
+    if verify:
+        saved = load_saved_aggregates()
+        if saved is None:
+            print("No saved totals match the current data, nothing to verify")
+        else:
+            # Users that were never built aren't saved, only compare the saved ones
+            for key, label in (('users', 'site'), ('months', 'month')):
+                found = verify_aggregates(saved[key], {user: rebuilt[key].get(user, {}) for user in saved[key]})
+                for user, group, col, saved_value, rebuilt_value in found:
+                    print(f"{user} / {group or f'(no {label})'} / {col}: saved {saved_value}, ledgers {rebuilt_value}")
+                mismatches += found
+            print(f"{len(mismatches)} mismatches")
+    with _aggregates_lock:
+        _aggregates.update(rebuilt)
+        _aggregates['loaded'] = True
+        _save_aggregates()
+    print(f"Rebuilt totals for {len(rebuilt['users'])} users")
+    if mismatches:
+        raise SystemExit(1)
+
+# One-time conversion of a bets.csv in the old spreadsheet format (two bets
+# per row, see legacy_bets_frame) to one bet per row. The sheet doesn't say
+# whose bets they are, so they are given to --user. The old file is kept as
+# bets.legacy.csv.
+#   flask --app app migrate-bets --user user1
+@app.cli.command('migrate-bets')
+@click.option('--user', 'user_code', type=click.Choice(VALID_USERS), required=True)
+def migrate_bets_command(user_code):
+    with storage.write_lock:
+        if not os.path.exists(bets_csv):
+            raise click.ClickException(f"{bets_csv} not found")
+        df = read_snapshot(bets_csv, 'csv')
+        if 'SITE ODDS' not in df.columns:
+            raise click.ClickException("bets.csv isn't in the old spreadsheet format, nothing to migrate")
+        bets = prepare_bets(legacy_bets_frame(df, user_code))
+        shutil.copyfile(bets_csv, os.path.join(CSV_DIR, 'bets.legacy.csv'))
+        write_snapshot('bets', bets[BET_COLUMNS], bets_csv, 'csv')
+        notify_storage_change('bets')
+    print(f"Converted {len(df)} rows into {len(bets)} bets of {user_code}")
+
+# One-time rewrite of every table with its dates as YYYY-MM-DD:
+#   flask --app app migrate-dates --dry-run
+# Reports how many dates are stored in each format. Dates that can't be read
+# are listed and stop the migration, since rewriting would drop them, unless
+# --drop-invalid is given.
+@app.cli.command('migrate-dates')
+@click.option('--dry-run', is_flag=True, help="Only report the formats found.")
+@click.option('--drop-invalid', is_flag=True, help="Clear dates that can't be read instead of stopping.")
+def migrate_dates_command(dry_run, drop_invalid):
+    invalid = 0
+    for table in TABLES:
+        raw = storage.raw_dates(table)
+        kinds = classify_dates(raw['date'])
+        counts = kinds.value_counts()
+        print(f"{table}: " + ', '.join(f"{counts.get(kind, 0)} {kind}" for kind in ['iso', 'dmy', 'missing', 'invalid']))
+        for row_id, value in raw.loc[(kinds == 'invalid').to_numpy(), ['id', 'date']].itertuples(index=False):
+            print(f"  {table} {row_id}: {value!r}")
+        invalid += int(counts.get('invalid', 0))
+    if invalid and not drop_invalid:
+        raise click.ClickException(f"{invalid} dates can't be read, fix them or pass --drop-invalid")
+    if dry_run:
+        return
+    for table in TABLES:
+        with storage.write_lock:
+            df = storage.load(table)
+            if not save_table(table, df):
+                raise click.ClickException(f"Failed to save {table}")
+        print(f"Rewrote {len(df)} rows of {table}")
 
 if __name__ == '__main__':
-    # Ensure CSV files exist
-    initialize_csv_files()
     app.run(debug=True)
 
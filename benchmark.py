@@ -0,0 +1,290 @@
+# Benchmark of the main read, insert, edit and delete flows. Generates
+# synthetic gambling.csv/bank.csv ledgers at the requested scale, points the
+# app at them (CSV_DIR) and drives the routes through Flask's test client.
+# Reports throughput and p50/p99 latency per flow, saves the results as JSON
+# and compares them with a stored baseline:
+#   python benchmark.py --rows 100000 --save-baseline
+#   python benchmark.py --rows 100000
+# Exits with status 1 if a flow's p50 got slower than the baseline by more
+# than --tolerance.
+import atexit
+import importlib
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import click
+import numpy as np
+import pandas as pd
+
+# Rows generated and written per chunk, so 10M-row ledgers don't have to fit in memory twice
+GENERATE_CHUNK_ROWS = 500_000
+
+# Rows per page, as the grids ask for them
+PAGE_SIZE = 200
+
+# Write the synthetic ledgers and item lists into directory. Gambles are
+# spread evenly over users, sites, machines and five years of dates; bank
+# transactions are bank_ratio times as many.
+def generate_ledgers(directory, rows, users, sites, machines, bank_ratio, seed):
+    rng = np.random.default_rng(seed)
+    user_codes = np.array([f'user{i + 1}' for i in range(users)], dtype=object)
+    site_names = np.array([f'Site {i + 1:03d}' for i in range(sites)], dtype=object)
+    machine_names = np.array([f'Machine {i + 1:04d}' for i in range(machines)], dtype=object)
+    days = pd.date_range(end='2025-12-31', periods=5 * 365).strftime('%Y-%m-%d').to_numpy(dtype=object)
+
+    def write_chunks(path, total, make_chunk):
+        if os.path.exists(path):
+            os.remove(path)
+        for start in range(0, total, GENERATE_CHUNK_ROWS):
+            count = min(GENERATE_CHUNK_ROWS, total - start)
+            make_chunk(start, count).to_csv(path, mode='a', header=start == 0, index=False)
+
+    def gamble_chunk(start, count):
+        win = rng.normal(-5, 50, count).round(2)
+        has_free_win = rng.random(count) < 0.1
+        free_win = np.where(has_free_win, rng.exponential(20, count), 0).round(2)
+        machine = machine_names[rng.integers(0, machines, count)]
+        return pd.DataFrame({
+            'id': np.arange(start + 1, start + count + 1),
+            'date': days[rng.integers(0, len(days), count)],
+            'website': site_names[rng.integers(0, sites, count)],
+            'machine': machine,
+            'win': win,
+            'free_win': free_win,
+            'free_win_m': np.where(has_free_win, machine, ''),
+            'note': '',
+            'start_amount': 0.0,
+            'end_amount': 0.0,
+            'user': user_codes[rng.integers(0, users, count)],
+            'profit': win + free_win,
+            'version': 1,
+        })
+
+    def bank_chunk(start, count):
+        return pd.DataFrame({
+            'id': np.arange(start + 1, start + count + 1),
+            'date': days[rng.integers(0, len(days), count)],
+            'type': np.where(rng.random(count) < 0.7, 'deposit', 'withdrawal'),
+            'amount': rng.exponential(200, count).round(2),
+            'site': site_names[rng.integers(0, sites, count)],
+            'user': user_codes[rng.integers(0, users, count)],
+            'version': 1,
+        })
+
+    write_chunks(os.path.join(directory, 'gambling.csv'), rows, gamble_chunk)
+    write_chunks(os.path.join(directory, 'bank.csv'), int(rows * bank_ratio), bank_chunk)
+    for file_name, names in [('websites.csv', site_names), ('machines.csv', machine_names)]:
+        with open(os.path.join(directory, file_name), 'w', encoding='utf-8', newline='') as f:
+            f.writelines(f'{name}\r\n' for name in names)
+
+# Latency figures of one flow
+def summarize(latencies, total_seconds):
+    latencies = np.array(latencies) * 1000
+    return {
+        'requests': len(latencies),
+        'p50_ms': round(float(np.percentile(latencies, 50)), 3),
+        'p99_ms': round(float(np.percentile(latencies, 99)), 3),
+        'mean_ms': round(float(latencies.mean()), 3),
+        'throughput_rps': round(len(latencies) / total_seconds, 2) if total_seconds else None,
+    }
+
+# Send count requests and time them. prepare(i) builds the arguments of
+# request i outside the timing (e.g. looking up a row's version), send(args)
+# makes the request.
+def measure(count, send, prepare=lambda i: i):
+    latencies = []
+    total = 0.0
+    for i in range(count):
+        args = prepare(i)
+        start = time.perf_counter()
+        response = send(args)
+        elapsed = time.perf_counter() - start
+        if response.status_code >= 400:
+            raise click.ClickException(
+                f"{response.request.method} {response.request.path} answered {response.status_code}: "
+                f"{response.get_data(as_text=True)[:200]}")
+        latencies.append(elapsed)
+        total += elapsed
+    return summarize(latencies, total)
+
+# Drive every flow as user through the test client, reads first so the writes
+# don't leave them nothing but cache misses
+def run_flows(gamba, user, count, seed):
+    rng = np.random.default_rng(seed)
+    client = gamba.app.test_client()
+    with client.session_transaction() as session:
+        session['user_code'] = user
+
+    gambles = gamba.load_gambles(user=user)
+    transactions = gamba.load_bank_transactions(user=user)
+    gamble_ids = gambles['id'].to_numpy()
+    bank_ids = transactions['id'].to_numpy()
+    sites = gambles['website'].dropna().unique()
+    if not len(gamble_ids) or not len(bank_ids):
+        raise click.ClickException(f"{user} has no gambles or bank transactions, generate more rows")
+
+    def page_offset(total):
+        return int(rng.integers(0, max(total - PAGE_SIZE, 1)))
+
+    def version_of(table, row_id):
+        return gamba.get_row(table, row_id).version
+
+    flows = {}
+    flows['read_gambles_page'] = measure(count, lambda offset: client.get(
+        f'/get_all_gambles?limit={PAGE_SIZE}&offset={offset}&sort=date&order=desc'),
+        lambda i: page_offset(len(gamble_ids)))
+    flows['read_gambles_filtered'] = measure(count, lambda site: client.get(
+        '/get_all_gambles', query_string={'limit': PAGE_SIZE, 'website': site, 'sort': 'profit', 'order': 'desc'}),
+        lambda i: sites[i % len(sites)])
+    flows['read_bank_page'] = measure(count, lambda offset: client.get(
+        f'/get_all_bank_transactions?limit={PAGE_SIZE}&offset={offset}&sort=date&order=desc'),
+        lambda i: page_offset(len(bank_ids)))
+    flows['read_balance'] = measure(count, lambda i: client.get('/get_balance'))
+    flows['read_statistics'] = measure(count, lambda i: client.get('/get_statistics'))
+    flows['render_gambling_page'] = measure(count, lambda i: client.get('/gambling'))
+    flows['render_bank_page'] = measure(count, lambda i: client.get('/bank'))
+
+    highest_id = int(gamba.load_gambles()['id'].max())
+    flows['insert_gamble'] = measure(count, lambda i: client.post('/gambling', data={
+        'date': '2025-06-01', 'website': sites[i % len(sites)], 'machine': 'Machine 0001',
+        'win': str(round(float(rng.normal(0, 50)), 2)), 'free_win': '0', 'note': 'benchmark'}))
+    flows['edit_gamble_patch'] = measure(count, lambda change: client.patch('/patch_gambles', json={
+        'changes': [change]}),
+        lambda i: (lambda row_id: {'id': row_id, 'field': 'win', 'value': round(float(rng.normal(0, 50)), 2),
+                                   'version': version_of('gambles', row_id)})(int(rng.choice(gamble_ids))))
+    flows['edit_gamble_update_all'] = measure(count, lambda gamble: client.post('/update_all_gambles', json={
+        'gambles': [gamble]}),
+        lambda i: (lambda row_id: {'id': row_id, 'note': f'benchmark {i}',
+                                   'version': version_of('gambles', row_id)})(int(rng.choice(gamble_ids))))
+    inserted = gamba.load_gambles(user=user)
+    inserted_ids = inserted.loc[inserted['id'] > highest_id, 'id'].tolist()
+    flows['delete_gamble'] = measure(len(inserted_ids), lambda args: client.post(
+        f'/delete_gamble/{args[0]}', json={'version': args[1]}),
+        lambda i: (inserted_ids[i], version_of('gambles', inserted_ids[i])))
+
+    highest_id = int(gamba.load_bank_transactions()['id'].max())
+    flows['insert_bank'] = measure(count, lambda i: client.post('/bank', data={
+        'date': '2025-06-01', 'type': 'deposit', 'amount': '100', 'site': sites[i % len(sites)]}))
+    flows['edit_bank_patch'] = measure(count, lambda change: client.patch('/patch_bank_transactions', json={
+        'changes': [change]}),
+        lambda i: (lambda row_id: {'id': row_id, 'field': 'amount', 'value': round(float(rng.exponential(200)), 2),
+                                   'version': version_of('bank', row_id)})(int(rng.choice(bank_ids))))
+    inserted = gamba.load_bank_transactions(user=user)
+    inserted_ids = inserted.loc[inserted['id'] > highest_id, 'id'].tolist()
+    flows['delete_bank'] = measure(len(inserted_ids), lambda args: client.post(
+        f'/delete_bank_transaction/{args[0]}', json={'version': args[1]}),
+        lambda i: (inserted_ids[i], version_of('bank', inserted_ids[i])))
+    return flows
+
+# Print the results next to the baseline's and return the flows whose p50
+# got slower by more than tolerance
+def compare(results, baseline, tolerance):
+    if baseline['meta']['scale'] != results['meta']['scale']:
+        print(f"Warning: baseline was measured at {baseline['meta']['scale']}, not {results['meta']['scale']}")
+    regressions = []
+    print(f"{'flow':<26}{'p50 ms':>10}{'baseline':>10}{'change':>9}{'p99 ms':>10}{'baseline':>10}")
+    for name, flow in results['flows'].items():
+        before = baseline['flows'].get(name)
+        if before is None:
+            print(f"{name:<26}{flow['p50_ms']:>10.2f}{'-':>10}{'':>9}{flow['p99_ms']:>10.2f}{'-':>10}")
+            continue
+        change = flow['p50_ms'] / before['p50_ms'] - 1 if before['p50_ms'] else 0.0
+        marker = ' REGRESSION' if change > tolerance else ''
+        print(f"{name:<26}{flow['p50_ms']:>10.2f}{before['p50_ms']:>10.2f}{change:>+9.0%}"
+              f"{flow['p99_ms']:>10.2f}{before['p99_ms']:>10.2f}{marker}")
+        if change > tolerance:
+            regressions.append(name)
+    return regressions
+
+@click.command()
+@click.option('--rows', default=10_000, show_default=True, help="Gambles to generate (1k to 10M).")
+@click.option('--users', default=3, show_default=True)
+@click.option('--sites', default=20, show_default=True)
+@click.option('--machines', default=500, show_default=True)
+@click.option('--bank-ratio', default=0.1, show_default=True, help="Bank transactions per gamble.")
+@click.option('--requests', 'requests_per_flow', default=100, show_default=True, help="Requests per flow.")
+@click.option('--backend', type=click.Choice(['csv', 'sharded', 'sqlite']), default='csv', show_default=True)
+@click.option('--snapshot-format', type=click.Choice(['csv', 'parquet', 'feather']), default='csv', show_default=True)
+@click.option('--seed', default=0, show_default=True)
+@click.option('--data-dir', type=click.Path(file_okay=False), default=None,
+              help="Generate the ledgers here and keep them, instead of in a temporary directory.")
+@click.option('--output', type=click.Path(dir_okay=False), default='benchmark-results.json', show_default=True)
+@click.option('--baseline', type=click.Path(dir_okay=False), default='benchmark-baseline.json', show_default=True)
+@click.option('--save-baseline', is_flag=True, help="Store these results as the new baseline.")
+@click.option('--tolerance', default=0.25, show_default=True, help="Allowed p50 slowdown against the baseline.")
+def main(rows, users, sites, machines, bank_ratio, requests_per_flow, backend, snapshot_format, seed,
+         data_dir, output, baseline, save_baseline, tolerance):
+    directory = data_dir or tempfile.mkdtemp(prefix='gamba-benchmark-')
+    os.makedirs(directory, exist_ok=True)
+    gamba = None
+    try:
+        start = time.perf_counter()
+        generate_ledgers(directory, rows, users, sites, machines, bank_ratio, seed)
+        print(f"Generated {rows} gambles in {time.perf_counter() - start:.1f}s")
+
+        # The app reads its configuration when it is imported
+        os.environ.update(CSV_DIR=directory, STORAGE_BACKEND=backend, SNAPSHOT_FORMAT=snapshot_format)
+        gamba = importlib.import_module('app')
+        if backend == 'sqlite':
+            start = time.perf_counter()
+            gamba.import_csv_into_sqlite(gamba.storage, gamba.CsvStorage(snapshot_format))
+            print(f"Imported into SQLite in {time.perf_counter() - start:.1f}s")
+        elif backend == 'sharded':
+            start = time.perf_counter()
+            gamba.storage.all_shards()
+            print(f"Split into per-user shards in {time.perf_counter() - start:.1f}s")
+
+        # Reading a user's ledger into a fresh storage, what the first request after a restart pays
+        start = time.perf_counter()
+        gamba.create_storage(backend).load('gambles', user='user1')
+        cold_load = time.perf_counter() - start
+
+        results = {
+            'meta': {
+                'scale': {'rows': rows, 'users': users, 'sites': sites, 'machines': machines,
+                          'bank_ratio': bank_ratio, 'backend': backend, 'snapshot_format': snapshot_format},
+                'requests_per_flow': requests_per_flow,
+                'seed': seed,
+                'time': datetime.now().isoformat(timespec='seconds'),
+                'python': platform.python_version(),
+                'pandas': pd.__version__,
+            },
+            'cold_load_s': round(cold_load, 3),
+            'flows': run_flows(gamba, 'user1', requests_per_flow, seed),
+        }
+    finally:
+        if gamba is not None:
+            # Fold pending edits in now; the app's exit hook would find the
+            # data directory gone
+            gamba.flush_storage()
+            atexit.unregister(gamba.flush_storage)
+        if data_dir is None:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+    print(f"Cold load of user1's gambles: {results['cold_load_s']}s")
+
+    regressions = []
+    if os.path.exists(baseline) and not save_baseline:
+        with open(baseline, encoding='utf-8') as f:
+            regressions = compare(results, json.load(f), tolerance)
+    else:
+        for name, flow in results['flows'].items():
+            print(f"{name:<26}p50 {flow['p50_ms']:>9.2f} ms  p99 {flow['p99_ms']:>9.2f} ms  "
+                  f"{flow['throughput_rps']:>9.1f} req/s")
+    if save_baseline:
+        shutil.copyfile(output, baseline)
+        print(f"Saved baseline to {baseline}")
+    if regressions:
+        print(f"{len(regressions)} flows got slower than the baseline: {', '.join(regressions)}")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -19,32 +19,42 @@ document.addEventListener("DOMContentLoaded", function() {
     
 
     
-    // Set up modal for amount editing
-    setupAmountEditModal();
-
-    setupDeleteButtons();
-
-    
     // Initialize Handsontable
     initializeHandsontable(); 
 
 });
 
-// Global variables to store the current state and change history
+// Global variables to store the current state and change history. The
+// stacks hold the ids of saved changes, the server keeps what they changed.
 let undoStack = [];
 let redoStack = [];
 let currentState = [];  // Current state of the table data
 
+// Rows fetched per page as the grid scrolls
+const PAGE_SIZE = 200;
+
+// Sort and filters of the grid, applied by the server
+let gridQuery = { sort: 'date', order: 'desc', filters: {} };
 
-// Function to fetch all gamble data
-function fetchAllGambleDetails() {
-    return fetch(`/get_all_gambles`)
+
+// Function to fetch one page of gamble data for the current sort and filters
+function fetchGamblePage(offset) {
+    const params = new URLSearchParams({ offset: offset, limit: PAGE_SIZE, sort: gridQuery.sort, order: gridQuery.order,
+                                        format: 'columnar' });
+    Object.entries(gridQuery.filters).forEach(([key, value]) => {
+        if (value) params.append(key, value);
+    });
+    // Revalidate with the server's ETag: when nothing changed the answer is a
+    // 304 and the browser's cached copy is used
+    return fetch(`/get_all_gambles?${params}`, { cache: 'no-cache' })
         .then(response => response.json())
         .then(data => {
             if (data.error) {
                 alert('Error fetching all gamble data: ' + data.error);
                 return null;
             }
+            // The page comes column by column, see decodeColumnar
+            data.rows = decodeColumnar(data.rows);
             return data;  // Return the fetched data
         })
         .catch(error => {
@@ -54,23 +64,29 @@ function fetchAllGambleDetails() {
         });
 }
 
+// Show the row count and sums of the whole filtered set under the grid filters
+function updateGridSummary(page) {
+    const summary = document.getElementById('grid-summary');
+    if (!summary) return;
+    summary.textContent = `${page.total} gambles · Win ${page.sums.win.toFixed(2)} · ` +
+        `Free Win ${page.sums.free_win.toFixed(2)} · Profit ${page.sums.profit.toFixed(2)}`;
+}
+
 // Function to fetch data and initialize Handsontable with filters
 function initializeHandsontable() {
-    fetchAllGambleDetails().then(gamblesData => {
-        if (!gamblesData) return; // Exit if fetching fails
+    firstGridPage(fetchGamblePage).then(page => {
+        if (!page) return; // Exit if fetching fails
 
         var container = document.getElementById('gamble-table');
         
-        let undoStack = [];   // Stack to store previous states for undo
-        let redoStack = [];   // Stack to store undone states for redo
-        let isUndoRedoAction = false; // Flag to prevent recording undo/redo as changes
-        
-        // Clone initial data for state tracking
-        let initialState = JSON.parse(JSON.stringify(gamblesData));
+        let loadedRows = page.rows;   // Pages fetched so far
+        let totalRows = page.total;   // Rows matching the filters on the server
+        let loadingPage = false;
+        updateGridSummary(page);
         
         const hot = new Handsontable(container, {
             licenseKey: 'non-commercial-and-evaluation',
-            data: gamblesData,
+            data: loadedRows,
             columns: [
                 { data: 'id', type: 'numeric' },
                 { data: 'date', type: 'date', dateFormat: 'YYYY-MM-DD' },
@@ -89,49 +105,53 @@ function initializeHandsontable() {
             colWidths: [30, null, null, 60, 40, 60, 40, 40, 30, 17],  // Only 'Win' column has a fixed width
             colHeaders: ["ID", "Date", "Website", "Machine", "Win", "Free Win Machine", "Free Win", "Profit", "Note", ""],
             rowHeaders: true,
-            columnSorting: true,
-            filters: true,
+            height: 500, // Fixed height so only visible rows are rendered and scrolling loads more
             manualColumnResize: true,
             manualRowResize: true,
             autoColumnSize: false,
-            dropdownMenu: ['filter_by_condition', 'filter_by_value', 'filter_action_bar'],
             editable: true,
             columnSorting: {
-                initialConfig: {
-                    column: 1, // The index of the "Date" column (0-based index)
-                    sortOrder: 'desc' // Sort in descending order (newest dates first)
-                }
+                indicator: true
             },
             stretchH: 'all', // Stretch columns to fill width
             
-            beforeChange: function(changes, source) {
-                if (source === 'edit' && !isUndoRedoAction) {
-                    // Store the current state before any changes
-                    const currentData = JSON.parse(JSON.stringify(hot.getData().map(row => {
-                        const obj = {};
-                        hot.getSettings().columns.forEach((col, index) => {
-                            obj[col.data] = row[index];
-                        });
-                        return obj;
-                    })));
-                    
-                    // Push current state to undo stack before change
-                    undoStack.push(currentData);
-                    
-                    // Clear redo stack since we've made a new change
-                    redoStack = [];
-                    
-                    console.log("State saved to undo stack:", currentData);
+            // Sorting is done by the server over the whole filtered set, not only the loaded pages
+            beforeColumnSort: function(currentSortConfig, destinationSortConfigs) {
+                const sortConfig = destinationSortConfigs[0];
+                const prop = sortConfig ? this.colToProp(sortConfig.column) : null;
+                if (typeof prop !== 'string') {
+                    gridQuery.sort = 'date';
+                    gridQuery.order = 'desc';
+                } else {
+                    gridQuery.sort = prop;
+                    gridQuery.order = sortConfig.sortOrder;
                 }
+                reloadGrid();
+                return false;
             },
-            afterChange: function(changes, source) {
-                if (source === 'edit' && !isUndoRedoAction) {
-                    // Save changes to server after edit
-                    saveChangesToServer(hot.getData());
+            
+            // Fetch the next page when the user scrolls near the end of the loaded rows
+            afterScrollVertically: function() {
+                const holder = container.querySelector('.wtHolder');
+                if (holder && holder.scrollTop + holder.clientHeight >= holder.scrollHeight - 200) {
+                    loadNextPage();
                 }
+            },
+            
+            afterChange: function(changes, source) {
+                if (!changes) return;
+                if (!['edit', 'CopyPaste.paste', 'Autofill.fill'].includes(source)) return;
+
+                // Only send the cells that actually changed
+                const cellChanges = collectCellChanges(changes);
+                if (cellChanges.length === 0) return;
+
+                saveCellChangesToServer(cellChanges, hot);
             }
         });
 
+        // Set up modal for amount editing
+        setupAmountEditModal(hot);
 
         
         // Custom renderer for delete button
@@ -150,6 +170,41 @@ function initializeHandsontable() {
             }, 0);
         }
 
+        // Append the next page of gambles to the grid
+        function loadNextPage() {
+            if (loadingPage || loadedRows.length >= totalRows) return;
+            loadingPage = true;
+            fetchGamblePage(loadedRows.length).then(page => {
+                loadingPage = false;
+                if (!page) return;
+                loadedRows = loadedRows.concat(page.rows);
+                totalRows = page.total;
+                hot.updateData(loadedRows);
+            });
+        }
+
+        // Start again from the first page, after a sort, filter or delete
+        function reloadGrid() {
+            loadingPage = true;
+            fetchGamblePage(0).then(page => {
+                loadingPage = false;
+                if (!page) return;
+                loadedRows = page.rows;
+                totalRows = page.total;
+                updateGridSummary(page);
+                hot.updateData(loadedRows);
+            });
+        }
+
+        // Reload from the server whenever a filter changes (jQuery handlers
+        // also see the change events Select2 triggers)
+        document.querySelectorAll('#grid-filters [data-filter]').forEach(input => {
+            $(input).on('change', function() {
+                gridQuery.filters[input.dataset.filter] = input.value;
+                reloadGrid();
+            });
+        });
+
         // Function to delete row
         function deleteRow(rowIndex) {
             const rowData = hot.getSourceDataAtRow(rowIndex); // Get row data
@@ -165,15 +220,18 @@ function initializeHandsontable() {
             fetch(`/delete_gamble/${gambleId}`, {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ version: rowData.version })
             })
             .then(response => response.json())
             .then(data => {
                 if (data.success) {
                     console.log("Row deleted successfully!");
-                    // Refresh the entire table instead of just removing the row
-                    fetchAllGambleDetails().then(updatedData => {
-                        hot.loadData(updatedData);
-                    });
+                    // Reload the first page so the counts and sums stay right
+                    reloadGrid();
+                } else if (data.gambles) {
+                    // Changed by someone else since it was loaded, show the current values
+                    applyServerRows(hot, data.gambles);
+                    alert("Error deleting row: " + data.error);
                 } else {
                     console.error("Error deleting row:", data.error);
                     alert("Error deleting row: " + (data.error || "Unknown error"));
@@ -186,121 +244,117 @@ function initializeHandsontable() {
         }
 
         
+        // Turn Handsontable's [row, prop, oldValue, newValue] changes into
+        // {id, field, value} cell changes keyed by gamble id
+        function collectCellChanges(changes) {
+            const cellChanges = [];
+            changes.forEach(([row, prop, oldValue, newValue]) => {
+                if (oldValue === newValue) return;
+                const rowData = hot.getSourceDataAtRow(hot.toPhysicalRow(row));
+                if (!rowData || !rowData.id) return;
+                cellChanges.push({ id: rowData.id, field: prop, value: newValue });
+            });
+            return cellChanges;
+        }
+
+        // Undo or redo the last change on the server once the saves on their
+        // way are done, and show the rows it wrote
+        function revertLastChange(action, fromStack, toStack) {
+            saveQueue = saveQueue.then(() => {
+                if (fromStack.length === 0) {
+                    return;
+                }
+                const changeId = fromStack.pop();
+                return revertChange(action, changeId)
+                    .then(data => {
+                        if (data.rows) {
+                            applyServerRows(hot, data.rows);
+                        }
+                        if (!data.success) {
+                            throw new Error(data.error);
+                        }
+                        toStack.push(changeId);
+                    })
+                    .catch(error => {
+                        alert(`Error with ${action}: ` + error.message);
+                    });
+            });
+        }
+
         // Add undo functionality to the undo button
         document.getElementById('undo-btn').addEventListener('click', function() {
-            console.log("Undo stack before undo:", JSON.stringify(undoStack));
-            if (undoStack.length > 0) {
-                // Get current state to save to redo stack
-                const currentData = JSON.parse(JSON.stringify(hot.getData().map(row => {
-                    const obj = {};
-                    hot.getSettings().columns.forEach((col, index) => {
-                        obj[col.data] = row[index];
-                    });
-                    return obj;
-                })));
-                
-                // Save current state to redo stack
-                redoStack.push(currentData);
-                
-                // Get previous state from undo stack
-                const previousState = undoStack.pop();
-                
-                // Set flag to prevent recording this as a change
-                isUndoRedoAction = true;
-                
-                // Update the table with previous state
-                hot.loadData(previousState);
-                hot.render(); // Force a render of the table
-                
-                // Reset flag
-                isUndoRedoAction = false;
-                
-                // Save the reverted state to server
-                saveChangesToServer(previousState);
-                
-                console.log("Undo performed. Table reverted to previous state:", previousState);
-            } else {
-                console.log("Nothing to undo");
-            }
+            revertLastChange('undo', undoStack, redoStack);
         });
 
         // Add redo functionality to the redo button
         document.getElementById('redo-btn').addEventListener('click', function() {
-            if (redoStack.length > 0) {
-                // Get current state to save to undo stack
-                const currentData = JSON.parse(JSON.stringify(hot.getData().map(row => {
-                    const obj = {};
-                    hot.getSettings().columns.forEach((col, index) => {
-                        obj[col.data] = row[index];
-                    });
-                    return obj;
-                })));
-                
-                // Save current state to undo stack
-                undoStack.push(currentData);
-                
-                // Get next state from redo stack
-                const nextState = redoStack.pop();
-                
-                // Set flag to prevent recording this as a change
-                isUndoRedoAction = true;
-                
-                // Update the table with next state
-                hot.loadData(nextState);
-                
-                // Reset flag
-                isUndoRedoAction = false;
-                
-                // Save the redone state to server
-                saveChangesToServer(nextState);
-                
-                console.log("Redo performed. Table updated to next state.");
-            } else {
-                console.log("Nothing to redo");
-            }
+            revertLastChange('redo', redoStack, undoStack);
         });
     });
 }
 
-function saveChangesToServer(data) {
-    // Make sure data is in the expected format (array of objects with column names)
-    const columnNames = ["id", "date", "website", "machine", "win", "free_win_m", "free_win", "profit", "note"];
-    let formattedData;
-    
-    // Check if data is already in the correct format (array of objects)
-    if (data.length > 0 && typeof data[0] === 'object' && !Array.isArray(data[0])) {
-        formattedData = data;
-    } else {
-        // Format array of arrays to array of objects
-        formattedData = data.map(row => {
-            const obj = {};
-            columnNames.forEach((colName, index) => {
-                obj[colName] = row[index];
-            });
-            return obj;
+// Write rows sent back by the server into the grid by id. The 'server' source
+// keeps afterChange from treating them as edits.
+function applyServerRows(hot, rows, fields) {
+    const sourceData = hot.getSourceData();
+    rows.forEach(serverRow => {
+        const physicalRow = sourceData.findIndex(row => row.id === serverRow.id);
+        if (physicalRow === -1) return;
+        (fields || Object.keys(serverRow)).forEach(field => {
+            hot.setSourceDataAtCell(physicalRow, field, serverRow[field], 'server');
+        });
+    });
+    hot.render();
+}
+
+// Saves are sent one at a time, so each one carries the row versions the previous one produced
+let saveQueue = Promise.resolve();
+
+// Edits made while a save is on its way, sent together as the next save
+let pendingChanges = [];
+
+// Send only the changed cells to the server and refresh derived values (profit)
+function saveCellChangesToServer(cellChanges, hot) {
+    if (pendingChanges.length === 0) {
+        saveQueue = saveQueue.then(() => {
+            const changes = coalesceCellChanges(pendingChanges);
+            pendingChanges = [];
+            return sendCellChanges(changes, hot);
         });
     }
-    
-    console.log("Formatted data being sent to server:", formattedData);
-    
-    fetch('/update_all_gambles', {
-        method: 'POST',
+    pendingChanges = pendingChanges.concat(cellChanges);
+}
+
+function sendCellChanges(cellChanges, hot) {
+    // The version of each row as the grid has it, the server refuses the save if it has moved on
+    const sourceData = hot.getSourceData();
+    const changes = cellChanges.map(change => {
+        const rowData = sourceData.find(row => row.id === change.id);
+        return { id: change.id, field: change.field, value: change.value, version: rowData ? rowData.version : undefined };
+    });
+
+    return fetch('/patch_gambles', {
+        method: 'PATCH',
         headers: {
             'Content-Type': 'application/json'
         },
-        body: JSON.stringify({ gambles: formattedData })
-    })
-    .then(response => {
-        if (!response.ok) {
-            return response.json().then(errorData => {
-                alert("Error saving data: " + errorData.error);
-            });
-        }
-        return response.json();
+        body: JSON.stringify({ changes: changes })
     })
+    .then(response => response.json())
     .then(data => {
         if (data.success) {
             console.log("Data saved successfully!");
+            // Update profit and version of the edited rows from the server's values
+            applyServerRows(hot, data.gambles, ['profit', 'version']);
+            // The save can be undone by its change id, a new change clears redo
+            if (data.change) {
+                undoStack.push(data.change);
+                redoStack = [];
+            }
+        } else if (data.gambles) {
+            // Changed by someone else since it was loaded, show the current values
+            applyServerRows(hot, data.gambles);
+            alert("Error saving data: " + data.error);
         } else {
             alert("Error saving data: " + data.error);
         }
@@ -314,11 +368,31 @@ function saveChangesToServer(data) {
 // Initialize Select2 dropdowns
 function initializeSelect2() {
     $(document).ready(function() {
-        // Initialize Select2 for all dropdowns with the class 'select2'
-        $('.select2').select2({
-            placeholder: "Select an option", // Optional: Add a placeholder
-            selectOnClose: true,
-            allowClear: true // Optional: Allow clearing the selection
+        // Initialize Select2 for all dropdowns with the class 'select2'.
+        // Dropdowns with data-kind load their options from /search_items as
+        // the user types instead of listing every website or machine.
+        $('.select2').each(function() {
+            const kind = this.dataset.kind;
+            const options = {
+                placeholder: this.dataset.placeholder || "Select an option", // Optional: Add a placeholder
+                selectOnClose: true,
+                allowClear: true // Optional: Allow clearing the selection
+            };
+            if (kind) {
+                options.ajax = {
+                    url: '/search_items',
+                    dataType: 'json',
+                    delay: 150,
+                    data: params => ({
+                        kind: kind,
+                        q: params.term || '',
+                        page: params.page || 1,
+                        // Machines played on the chosen website come first
+                        site: kind === 'machines' ? $('#website').val() : undefined
+                    })
+                };
+            }
+            $(this).select2(options);
         });
     
         // Automatically focus on the search box when the dropdown is opened
@@ -369,11 +443,12 @@ function setupFormCalculations() {
 
 
 // Updated setupAmountEditModal to work with the win column
-function setupAmountEditModal() {
+function setupAmountEditModal(hot) {
     const modal = document.getElementById("edit-amount-modal");
     const closeBtn = document.querySelector(".close-btn");
     const form = document.getElementById("edit-amount-form");
-    let currentRow;
+    let currentId;      // Id of the gamble being edited
+    let currentVersion; // Version of the gamble when its amounts were fetched
     let isFreeWin = false; // Flag to determine if editing free_win column
     
     document.getElementById('gamble-table').addEventListener('contextmenu', function(event) {
@@ -381,24 +456,28 @@ function setupAmountEditModal() {
         
         const cell = event.target.closest("td");
         if (cell) {
-            // Check if the click is on the 'win' column (index 5) or 'free_win' column (index 7)
-            if (cell.cellIndex === 5 || cell.cellIndex === 7) {
-                currentRow = cell.closest("tr");
-                const gambleId = currentRow.cells[1].innerText; // Get the value from index 1 column (second column)
+            // Check if the click is on the 'win' or 'free_win' column
+            const coords = hot.getCoords(cell);
+            const prop = coords ? hot.colToProp(coords.col) : null;
+            if (prop === 'win' || prop === 'free_win') {
+                const rowData = hot.getSourceDataAtRow(hot.toPhysicalRow(coords.row));
+                const gambleId = rowData ? rowData.id : null;
                 
                 if (!gambleId) {
                     alert('Error: Could not identify the gamble.');
                     return;
                 }
+                currentId = gambleId;
                 
                 // Determine if editing free_win column
-                isFreeWin = cell.cellIndex === 7;
+                isFreeWin = prop === 'free_win';
                 
                 // Fetch gamble details
                 fetch(`/get_gamble_data?id=${gambleId}`)
                     .then(response => response.json())
                     .then(data => {
                         if (data && !data.error) {
+                            currentVersion = data.version;
                             // Set values based on whether editing win or free_win
                             if (isFreeWin) {
                                 document.getElementById("start_amount_edit").value = data.f_start_amount || '';
@@ -442,33 +521,24 @@ function setupAmountEditModal() {
         const endAmount = document.getElementById("end_amount_edit").value;
         modal.style.display = "none";
         
-        if (!currentRow) {
+        if (!currentId) {
             alert("Error: Could not identify the row to update.");
             return;
         }
         
-        // Get gambleId from the cell directly, instead of data-id attribute
-        const gambleId = currentRow.cells[1].innerText; 
-        
         // Calculate the win or free_win amount
         const amount = parseFloat(endAmount) - parseFloat(startAmount);
         
-        // Update the table based on whether editing win or free_win
-        if (isFreeWin) {
-            currentRow.querySelector('td:nth-child(8)').innerText = amount.toFixed(2); // Update free_win column (index 7)
-        } else {
-            currentRow.querySelector('td:nth-child(6)').innerText = amount.toFixed(2); // Update win column (index 5)
-        }
-        
         // Send the updated data to the server
         const updatedGambleData = {
-            id: gambleId,
+            id: currentId,
             start_amount: isFreeWin ? undefined : startAmount, // Only send start_amount for win
             end_amount: isFreeWin ? undefined : endAmount, // Only send end_amount for win
             win: isFreeWin ? undefined : amount.toFixed(2), // Only send win for win column
             f_start_amount: isFreeWin ? startAmount : undefined, // Only send f_start_amount for free_win
             f_end_amount: isFreeWin ? endAmount : undefined, // Only send f_end_amount for free_win
-            free_win: isFreeWin ? amount.toFixed(2) : undefined // Only send free_win for free_win column
+            free_win: isFreeWin ? amount.toFixed(2) : undefined, // Only send free_win for free_win column
+            version: currentVersion
         };
         
         fetch('/update_gamble', {
@@ -479,7 +549,17 @@ function setupAmountEditModal() {
         .then(response => response.json())
         .then(data => {
             if (data.success) {
-                console.log("Successfully updated amounts");
+                // Show the saved amount, profit and version in the grid so the
+                // next edit of the row sends the version it has now
+                applyServerRows(hot, [data.gamble], [isFreeWin ? 'free_win' : 'win', 'profit', 'version']);
+                if (data.change) {
+                    undoStack.push(data.change);
+                    redoStack = [];
+                }
+            } else if (data.gambles) {
+                // Changed by someone else since it was loaded, show the current values
+                applyServerRows(hot, data.gambles);
+                alert('Error updating amounts: ' + data.error);
             } else {
                 alert('Error updating amounts: ' + (data.error || 'Unknown error'));
             }
@@ -490,44 +570,3 @@ function setupAmountEditModal() {
         });
     });
 }
-
-
-
-
-function setupDeleteButtons() {
-    const deleteButtons = document.querySelectorAll('.delete-btn');
-    
-    deleteButtons.forEach(button => {
-        button.addEventListener('click', function(event) {
-            const row = event.target.closest('tr');
-            const gambleId = row.getAttribute('data-id');
-            
-            // Confirm delete action
-            const confirmDelete = confirm(`Are you sure you want to delete Gamble ID: ${gambleId}?`);
-            if (!confirmDelete) {
-                return;
-            }
-            
-            // Send DELETE request to server
-            fetch(`/delete_gamble/${gambleId}`, {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json'
-                }
-            })
-            .then(response => response.json())
-            .then(data => {
-                if (data.success) {
-                    // Successfully deleted, remove the row from the table
-                    row.remove();
-                } else {
-                    alert(data.error || "Error deleting gamble");
-                }
-            })
-            .catch(error => {
-                console.error('Error:', error);
-                alert('Error deleting gamble. Please try again.');
-            });
-        });
-    });
-}
\ No newline at end of file
@@ -9,61 +9,104 @@ document.addEventListener("DOMContentLoaded", function() {
 });
 
 // Global variables to store the current state and change history
-let undoStack = [];
-let redoStack = [];
-let currentState = [];  // Current state of the table data
+let undoStack = [];   // Ids of saved changes for undo, the server keeps what they changed
+let redoStack = [];   // Ids of undone changes for redo
 let hot; // Global reference to Handsontable instance
 
-// Function to fetch all bank transaction data
-function fetchAllBankTransactions() {
-    console.log("Starting to fetch bank transactions...");
-    return fetch(`/get_all_bank_transactions`)
+// Rows fetched per page as the grid scrolls
+const PAGE_SIZE = 200;
+
+// Sort and filters of the grid, applied by the server
+let gridQuery = { sort: 'date', order: 'desc', filters: {} };
+
+// Function to fetch one page of bank transactions for the current sort and filters
+function fetchBankTransactionPage(offset) {
+    const params = new URLSearchParams({ offset: offset, limit: PAGE_SIZE, sort: gridQuery.sort, order: gridQuery.order,
+                                        format: 'columnar' });
+    Object.entries(gridQuery.filters).forEach(([key, value]) => {
+        if (value) params.append(key, value);
+    });
+    // Revalidate with the server's ETag: when nothing changed the answer is a
+    // 304 and the browser's cached copy is used
+    return fetch(`/get_all_bank_transactions?${params}`, { cache: 'no-cache' })
         .then(response => {
-            console.log("Received response with status:", response.status);
             if (!response.ok) {
-                throw new Error(`Server responded with status: ${response.status}`);
+                return response.json().then(errorData => {
+                    throw new Error(errorData.error || `Server responded with status: ${response.status}`);
+                });
             }
             return response.json();
         })
         .then(data => {
-            console.log("Parsed response data:", data);
             if (!data) {
                 console.error("Server returned null or undefined data");
-                return [];
+                return null;
             }
             if (data.error) {
                 console.error('Error from server:', data.error);
                 alert('Error fetching bank transaction data: ' + data.error);
-                return [];
+                return null;
             }
-            console.log(`Fetched ${data.length} bank transactions`);
+            // The page comes column by column, see decodeColumnar
+            data.rows = decodeColumnar(data.rows);
+            console.log(`Fetched ${data.rows.length} of ${data.total} bank transactions`);
             return data;
         })
         .catch(error => {
             console.error("Error fetching bank transaction data:", error);
             alert('Error fetching bank transaction data: ' + error.message);
-            return [];
+            return null;
+        });
+}
+
+// Show the row count and sums of the whole filtered set under the grid filters
+function updateGridSummary(page) {
+    const summary = document.getElementById('grid-summary');
+    if (!summary) return;
+    summary.textContent = `${page.total} transactions · Amount ${page.sums.amount.toFixed(2)} · ` +
+        `Net ${page.sums.net.toFixed(2)}`;
+}
+
+// Refresh the balance cards from the server's balance engine
+function refreshBalance() {
+    // Revalidated with the ETag like the grid pages
+    return fetch('/get_balance', { cache: 'no-cache' })
+        .then(response => response.json())
+        .then(data => {
+            if (!data || data.error) {
+                console.error("Error fetching balance:", data && data.error);
+                return;
+            }
+            [
+                ['balance-gambling-profit', data.totals.gambling_profit],
+                ['balance-bank', data.totals.bank_balance],
+                ['balance-total', data.totals.total_balance]
+            ].forEach(([elementId, value]) => {
+                const element = document.getElementById(elementId);
+                if (!element) return;
+                element.textContent = value.toFixed(2);
+                element.classList.toggle('positive', value >= 0);
+                element.classList.toggle('negative', value < 0);
+            });
+        })
+        .catch(error => {
+            console.error("Error fetching balance:", error);
         });
 }
 
-// Function to fetch data and initialize Handsontable with filters
 // Function to fetch data and initialize Handsontable with filters
 function initializeBankHandsontable() {
     console.log("Initializing bank table...");
-    fetchAllBankTransactions().then(transactionsData => {
-        console.log("Transaction data received:", transactionsData);
-        
-        // Check if data is an array
-        if (!Array.isArray(transactionsData)) {
-            console.error("Data is not an array:", transactionsData);
+    firstGridPage(fetchBankTransactionPage).then(page => {
+        if (!page) {
             // Display a message in the table area
             document.getElementById('bank-table').innerHTML = 
                 '<div class="alert alert-warning">No transaction data available. The server may be unavailable or returned invalid data.</div>';
             return;
         }
         
-        // Check if array is empty
-        if (transactionsData.length === 0) {
+        // Check if there are any transactions at all
+        if (page.total === 0) {
             console.log("No transactions found in the data");
             // Display a message in the table area
             document.getElementById('bank-table').innerHTML = 
@@ -81,17 +124,14 @@ function initializeBankHandsontable() {
             hot.destroy();
         }
         
-        let isUndoRedoAction = false; // Flag to prevent recording undo/redo as changes
-        
-        // Clone initial data for state tracking
-        let initialState = JSON.parse(JSON.stringify(transactionsData));
-        
-        // Store the data separately so we can access it in the cells callback
-        let tableData = transactionsData;
+        let loadedRows = page.rows;   // Pages fetched so far
+        let totalRows = page.total;   // Rows matching the filters on the server
+        let loadingPage = false;
+        updateGridSummary(page);
         
         hot = new Handsontable(container, {
             licenseKey: 'non-commercial-and-evaluation',
-            data: transactionsData,
+            data: loadedRows,
             columns: [
                 { data: 'id', type: 'numeric' },
                 { data: 'date', type: 'date', dateFormat: 'YYYY-MM-DD' },
@@ -106,73 +146,49 @@ function initializeBankHandsontable() {
             colWidths: [null, null, null, null, null, 17],  // Only 'Win' column has a fixed width
             colHeaders: ["ID", "Date", "Type", "Amount", "Site", ""],
             rowHeaders: true,
-            columnSorting: true,
-            filters: true,
-            dropdownMenu: ['filter_by_condition', 'filter_by_value', 'filter_action_bar'],
+            height: 500, // Fixed height so only visible rows are rendered and scrolling loads more
             editable: true,
             manualColumnResize: true,
             manualRowResize: true,
             autoColumnSize: true,
             outsideClickDeselects: false,
             columnSorting: {
-                initialConfig: {
-                    column: 1, // The index of the "Date" column (0-based index)
-                    sortOrder: 'desc' // Sort in descending order (newest dates first)
-                }
+                indicator: true
             },
             stretchH: 'all', // Stretch columns to fill width
             
-            // Add safe event handlers
-            afterOnCellMouseDown: function(event, coords, TD) {
-                // Handle mousedown event safely
-                if (!event) return;
-                // Additional code if needed
-            },
-            
-            afterOnCellMouseUp: function(event, coords, TD) {
-                // Handle mouseup event safely
-                if (!event) return;
-                // Additional code if needed
+            // Sorting is done by the server over the whole filtered set, not only the loaded pages
+            beforeColumnSort: function(currentSortConfig, destinationSortConfigs) {
+                const sortConfig = destinationSortConfigs[0];
+                const prop = sortConfig ? this.colToProp(sortConfig.column) : null;
+                if (typeof prop !== 'string') {
+                    gridQuery.sort = 'date';
+                    gridQuery.order = 'desc';
+                } else {
+                    gridQuery.sort = prop;
+                    gridQuery.order = sortConfig.sortOrder;
+                }
+                reloadGrid();
+                return false;
             },
             
-            beforeChange: function(changes, source) {
-                if (!changes) return; // Guard against undefined
-                
-                if (source === 'edit' && !isUndoRedoAction) {
-                    try {
-                        // Store the current state before any changes
-                        const currentData = JSON.parse(JSON.stringify(hot.getData().map(row => {
-                            const obj = {};
-                            hot.getSettings().columns.forEach((col, index) => {
-                                obj[col.data] = row[index];
-                            });
-                            return obj;
-                        })));
-                        
-                        // Push current state to undo stack before change
-                        undoStack.push(currentData);
-                        
-                        // Clear redo stack since we've made a new change
-                        redoStack = [];
-                        
-                        console.log("State saved to undo stack");
-                    } catch (error) {
-                        console.error("Error in beforeChange:", error);
-                    }
+            // Fetch the next page when the user scrolls near the end of the loaded rows
+            afterScrollVertically: function() {
+                const holder = container.querySelector('.wtHolder');
+                if (holder && holder.scrollTop + holder.clientHeight >= holder.scrollHeight - 200) {
+                    loadNextPage();
                 }
             },
             
             afterChange: function(changes, source) {
-                if (!changes) return; // Guard against undefined
-                
-                if (source === 'edit' && !isUndoRedoAction) {
-                    try {
-                        // Save changes to server after edit
-                        saveChangesToServer(hot.getData());
-                    } catch (error) {
-                        console.error("Error in afterChange:", error);
-                    }
-                }
+                if (!changes) return;
+                if (!['edit', 'CopyPaste.paste', 'Autofill.fill'].includes(source)) return;
+
+                // Only send the cells that actually changed
+                const cellChanges = collectCellChanges(changes);
+                if (cellChanges.length === 0) return;
+
+                saveCellChangesToServer(cellChanges);
             },
             
             // Fixed cells callback that safely accesses the data
@@ -181,9 +197,9 @@ function initializeBankHandsontable() {
                 
                 if (col === 2) { // Type column
                     try {
-                        // Access tableData directly rather than using hot.getSourceDataAtRow
-                        if (tableData && tableData[row] && tableData[row].type) {
-                            cellProperties.className = tableData[row].type.toLowerCase();
+                        // Access the loaded rows directly rather than using hot.getSourceDataAtRow
+                        if (loadedRows[row] && loadedRows[row].type) {
+                            cellProperties.className = loadedRows[row].type.toLowerCase();
                         }
                     } catch (error) {
                         console.error("Error in cells callback:", error);
@@ -210,6 +226,41 @@ function initializeBankHandsontable() {
             }, 0);
         }
 
+        // Append the next page of transactions to the grid
+        function loadNextPage() {
+            if (loadingPage || loadedRows.length >= totalRows) return;
+            loadingPage = true;
+            fetchBankTransactionPage(loadedRows.length).then(page => {
+                loadingPage = false;
+                if (!page) return;
+                loadedRows = loadedRows.concat(page.rows);
+                totalRows = page.total;
+                hot.updateData(loadedRows);
+            });
+        }
+
+        // Start again from the first page, after a sort, filter or delete
+        function reloadGrid() {
+            loadingPage = true;
+            fetchBankTransactionPage(0).then(page => {
+                loadingPage = false;
+                if (!page) return;
+                loadedRows = page.rows;
+                totalRows = page.total;
+                updateGridSummary(page);
+                hot.updateData(loadedRows);
+            });
+        }
+
+        // Reload from the server whenever a filter changes (jQuery handlers
+        // also see the change events Select2 triggers)
+        document.querySelectorAll('#grid-filters [data-filter]').forEach(input => {
+            $(input).on('change', function() {
+                gridQuery.filters[input.dataset.filter] = input.value;
+                reloadGrid();
+            });
+        });
+
         // Function to delete row
         function deleteRow(rowIndex) {
             const rowData = hot.getSourceDataAtRow(rowIndex); // Get row data
@@ -225,8 +276,16 @@ function initializeBankHandsontable() {
             fetch(`/delete_bank_transaction/${transactionId}`, {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ version: rowData.version })
             })
             .then(response => {
+                if (response.status === 409) {
+                    // Changed by someone else since it was loaded, show the current values
+                    return response.json().then(data => {
+                        applyServerRows(data.transactions);
+                        throw new Error(data.error);
+                    });
+                }
                 if (!response.ok) {
                     throw new Error(`Server responded with status: ${response.status}`);
                 }
@@ -235,13 +294,9 @@ function initializeBankHandsontable() {
             .then(data => {
                 if (data.success) {
                     console.log("Row deleted successfully!");
-                    // Refresh the entire table instead of just removing the row
-                    fetchAllBankTransactions().then(updatedData => {
-                        if (updatedData) {
-                            hot.loadData(updatedData);
-                            hot.render(); // Force a render of the table
-                        }
-                    });
+                    refreshBalance();
+                    // Reload the first page so the counts and sums stay right
+                    reloadGrid();
                 } else {
                     console.error("Error deleting row:", data.error);
                     alert("Error deleting row: " + (data.error || "Unknown error"));
@@ -253,54 +308,51 @@ function initializeBankHandsontable() {
             });
         }
 
+        // Turn Handsontable's [row, prop, oldValue, newValue] changes into
+        // {id, field, value} cell changes keyed by transaction id
+        function collectCellChanges(changes) {
+            const cellChanges = [];
+            changes.forEach(([row, prop, oldValue, newValue]) => {
+                if (oldValue === newValue) return;
+                const rowData = hot.getSourceDataAtRow(hot.toPhysicalRow(row));
+                if (!rowData || !rowData.id) return;
+                cellChanges.push({ id: rowData.id, field: prop, value: newValue });
+            });
+            return cellChanges;
+        }
+
+        // Undo or redo the last change on the server once the saves on their
+        // way are done, and show the rows it wrote
+        function revertLastChange(action, fromStack, toStack) {
+            saveQueue = saveQueue.then(() => {
+                if (fromStack.length === 0) {
+                    return;
+                }
+                const changeId = fromStack.pop();
+                return revertChange(action, changeId)
+                    .then(data => {
+                        if (data.rows) {
+                            applyServerRows(data.rows);
+                        }
+                        if (!data.success) {
+                            throw new Error(data.error);
+                        }
+                        toStack.push(changeId);
+                        refreshBalance();
+                    })
+                    .catch(error => {
+                        console.error(`Error with ${action}:`, error);
+                        alert(`Error with ${action}: ` + error.message);
+                    });
+            });
+        }
 
         // Add undo functionality to the undo button
         document.getElementById('undo-btn').addEventListener('click', function(e) {
             // Prevent any default actions and stop propagation
             e.preventDefault();
             e.stopPropagation();
-            
-            console.log("Undo button clicked. Stack size:", undoStack.length);
-            if (undoStack.length > 0) {
-                try {
-                    // Get current state to save to redo stack
-                    const currentData = JSON.parse(JSON.stringify(hot.getData().map(row => {
-                        const obj = {};
-                        hot.getSettings().columns.forEach((col, index) => {
-                            obj[col.data] = row[index];
-                        });
-                        return obj;
-                    })));
-                    
-                    // Save current state to redo stack
-                    redoStack.push(currentData);
-                    
-                    // Get previous state from undo stack
-                    const previousState = undoStack.pop();
-                    
-                    // Set flag to prevent recording this as a change
-                    isUndoRedoAction = true;
-                    
-                    // Update the table with previous state
-                    hot.loadData(previousState);
-                    
-                    // Use setTimeout to ensure UI updates before releasing flag
-                    setTimeout(() => {
-                        hot.render(); // Force a render of the table
-                        isUndoRedoAction = false;
-                        
-                        // Save the reverted state to server
-                        saveChangesToServer(previousState);
-                        
-                        console.log("Undo performed. Table reverted to previous state");
-                    }, 50);
-                } catch (error) {
-                    console.error("Error during undo operation:", error);
-                    isUndoRedoAction = false;
-                }
-            } else {
-                console.log("Nothing to undo");
-            }
+            revertLastChange('undo', undoStack, redoStack);
         });
 
         // Add redo functionality to the redo button
@@ -308,48 +360,7 @@ function initializeBankHandsontable() {
             // Prevent any default actions and stop propagation
             e.preventDefault();
             e.stopPropagation();
-            
-            console.log("Redo button clicked. Stack size:", redoStack.length);
-            if (redoStack.length > 0) {
-                try {
-                    // Get current state to save to undo stack
-                    const currentData = JSON.parse(JSON.stringify(hot.getData().map(row => {
-                        const obj = {};
-                        hot.getSettings().columns.forEach((col, index) => {
-                            obj[col.data] = row[index];
-                        });
-                        return obj;
-                    })));
-                    
-                    // Save current state to undo stack
-                    undoStack.push(currentData);
-                    
-                    // Get next state from redo stack
-                    const nextState = redoStack.pop();
-                    
-                    // Set flag to prevent recording this as a change
-                    isUndoRedoAction = true;
-                    
-                    // Update the table with next state
-                    hot.loadData(nextState);
-                    
-                    // Use setTimeout to ensure UI updates before releasing flag
-                    setTimeout(() => {
-                        hot.render(); // Force a render of the table
-                        isUndoRedoAction = false;
-                        
-                        // Save the redone state to server
-                        saveChangesToServer(nextState);
-                        
-                        console.log("Redo performed. Table updated to next state.");
-                    }, 50);
-                } catch (error) {
-                    console.error("Error during redo operation:", error);
-                    isUndoRedoAction = false;
-                }
-            } else {
-                console.log("Nothing to redo");
-            }
+            revertLastChange('redo', redoStack, undoStack);
         });
         
         // Add event listener for cleanup when leaving the page
@@ -371,73 +382,114 @@ function destroyHandsontable() {
     }
 }
 
-function saveChangesToServer(data) {
-    if (!data) {
-        console.error("No data to save");
-        return;
+// Write rows sent back by the server into the grid by id. The 'server' source
+// keeps afterChange from treating them as edits.
+function applyServerRows(rows, fields) {
+    const sourceData = hot.getSourceData();
+    rows.forEach(serverRow => {
+        const physicalRow = sourceData.findIndex(row => row.id === serverRow.id);
+        if (physicalRow === -1) return;
+        (fields || Object.keys(serverRow)).forEach(field => {
+            hot.setSourceDataAtCell(physicalRow, field, serverRow[field], 'server');
+        });
+    });
+    hot.render();
+}
+
+// Saves are sent one at a time, so each one carries the row versions the previous one produced
+let saveQueue = Promise.resolve();
+
+// Edits made while a save is on its way, sent together as the next save
+let pendingChanges = [];
+
+// Send only the changed cells to the server, the grid doesn't hold every transaction
+function saveCellChangesToServer(cellChanges) {
+    if (pendingChanges.length === 0) {
+        saveQueue = saveQueue.then(() => {
+            const changes = coalesceCellChanges(pendingChanges);
+            pendingChanges = [];
+            return sendCellChanges(changes);
+        });
     }
-    
-    try {
-        // Make sure data is in the expected format (array of objects with column names)
-        const columnNames = ["id", "date", "type", "amount", "site"];
-        let formattedData;
-        
-        // Check if data is already in the correct format (array of objects)
-        if (data.length > 0 && typeof data[0] === 'object' && !Array.isArray(data[0])) {
-            formattedData = data;
-        } else {
-            // Format array of arrays to array of objects
-            formattedData = data.map(row => {
-                const obj = {};
-                columnNames.forEach((colName, index) => {
-                    obj[colName] = row[index];
-                });
-                return obj;
+    pendingChanges = pendingChanges.concat(cellChanges);
+}
+
+function sendCellChanges(cellChanges) {
+    // The version of each row as the grid has it, the server refuses the save if it has moved on
+    const sourceData = hot.getSourceData();
+    const changes = cellChanges.map(change => {
+        const rowData = sourceData.find(row => row.id === change.id);
+        return { id: change.id, field: change.field, value: change.value, version: rowData ? rowData.version : undefined };
+    });
+
+    return fetch('/patch_bank_transactions', {
+        method: 'PATCH',
+        headers: {
+            'Content-Type': 'application/json'
+        },
+        body: JSON.stringify({ changes: changes })
+    })
+    .then(response => {
+        if (response.status === 409) {
+            // Changed by someone else since it was loaded, show the current values
+            return response.json().then(data => {
+                applyServerRows(data.transactions);
+                throw new Error(data.error);
             });
         }
-        
-        console.log("Formatted bank transaction data being sent to server");
-        
-        fetch('/update_all_bank_transactions', {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json'
-            },
-            body: JSON.stringify({ transactions: formattedData })
-        })
-        .then(response => {
-            if (!response.ok) {
-                return response.json().then(errorData => {
-                    throw new Error(errorData.error || "Server error");
-                });
-            }
-            return response.json();
-        })
-        .then(data => {
-            if (data.success) {
-                console.log("Data saved successfully!");
-            } else {
-                alert("Error saving data: " + (data.error || "Unknown error"));
+        if (!response.ok) {
+            return response.json().then(errorData => {
+                throw new Error(errorData.error || "Server error");
+            });
+        }
+        return response.json();
+    })
+    .then(data => {
+        if (data.success) {
+            console.log("Data saved successfully!");
+            applyServerRows(data.transactions, ['version']);
+            refreshBalance();
+            // The save can be undone by its change id, a new change clears redo
+            if (data.change) {
+                undoStack.push(data.change);
+                redoStack = [];
             }
-        })
-        .catch(error => {
-            console.error("Error saving data:", error);
-            alert("Error saving data: " + error.message);
-        });
-    } catch (error) {
-        console.error("Error in saveChangesToServer:", error);
-        alert("Error preparing data: " + error.message);
-    }
+        } else {
+            alert("Error saving data: " + (data.error || "Unknown error"));
+        }
+    })
+    .catch(error => {
+        console.error("Error saving data:", error);
+        alert("Error saving data: " + error.message);
+    });
 }
 
 // Initialize Select2 dropdowns
 function initializeSelect2() {
     $(document).ready(function() {
-        // Initialize Select2 for all dropdowns with the class 'select2'
-        $('.select2').select2({
-            placeholder: "Select an option", // Optional: Add a placeholder
-            selectOnClose: true,
-            allowClear: true // Optional: Allow clearing the selection
+        // Initialize Select2 for all dropdowns with the class 'select2'.
+        // Dropdowns with data-kind load their options from /search_items as
+        // the user types instead of listing every website or machine.
+        $('.select2').each(function() {
+            const kind = this.dataset.kind;
+            const options = {
+                placeholder: this.dataset.placeholder || "Select an option", // Optional: Add a placeholder
+                selectOnClose: true,
+                allowClear: true // Optional: Allow clearing the selection
+            };
+            if (kind) {
+                options.ajax = {
+                    url: '/search_items',
+                    dataType: 'json',
+                    delay: 150,
+                    data: params => ({
+                        kind: kind,
+                        q: params.term || '',
+                        page: params.page || 1
+                    })
+                };
+            }
+            $(this).select2(options);
         });
     
         // Automatically focus on the search box when the dropdown is opened
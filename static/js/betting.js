@@ -0,0 +1,348 @@
+document.addEventListener("DOMContentLoaded", function() {
+
+    // Initialize Select2 components
+    initializeSelect2();
+
+    // Show the lay stake of the new bet while it is typed
+    initializeBetPreview();
+
+    // Initialize Handsontable
+    initializeBetsHandsontable();
+});
+
+let hot; // Global reference to Handsontable instance
+
+// Rows fetched per page as the grid scrolls
+const PAGE_SIZE = 200;
+
+// Sort and filters of the grid, applied by the server
+let gridQuery = { sort: 'date', order: 'desc', filters: {} };
+
+// Columns worked out by the server from the stake, the odds and the commission
+const DERIVED_FIELDS = ['lay_stake', 'liability', 'back_profit', 'lay_profit', 'qualifying_loss', 'profit', 'roi'];
+
+// Function to fetch one page of bets for the current sort and filters
+function fetchBetsPage(offset) {
+    const params = new URLSearchParams({ offset: offset, limit: PAGE_SIZE, sort: gridQuery.sort, order: gridQuery.order,
+                                        format: 'columnar' });
+    Object.entries(gridQuery.filters).forEach(([key, value]) => {
+        if (value) params.append(key, value);
+    });
+    // Revalidate with the server's ETag like the other grids
+    return fetch(`/get_all_bets?${params}`, { cache: 'no-cache' })
+        .then(response => {
+            if (!response.ok) {
+                return response.json().then(errorData => {
+                    throw new Error(errorData.error || `Server responded with status: ${response.status}`);
+                });
+            }
+            return response.json();
+        })
+        .then(data => {
+            // The page comes column by column, see decodeColumnar
+            data.rows = decodeColumnar(data.rows);
+            return data;
+        })
+        .catch(error => {
+            console.error("Error fetching bets:", error);
+            alert('Error fetching bets: ' + error.message);
+            return null;
+        });
+}
+
+// Show the row count and sums of the whole filtered set under the grid filters
+function updateGridSummary(page) {
+    const summary = document.getElementById('grid-summary');
+    if (!summary) return;
+    summary.textContent = `${page.total} bets · Staked ${page.sums.back_stake.toFixed(2)} · ` +
+        `Qualifying loss ${page.sums.qualifying_loss.toFixed(2)} · Profit ${page.sums.profit.toFixed(2)}`;
+}
+
+// Ask the server for the lay stake and profit of the bet in the form
+function initializeBetPreview() {
+    const form = document.getElementById('bet-form');
+    const preview = document.getElementById('bet-preview');
+    if (!form || !preview) return;
+
+    form.addEventListener('input', function() {
+        const values = Object.fromEntries(new FormData(form));
+        if (!values.back_stake || !values.back_odds || !values.lay_odds) {
+            preview.textContent = '';
+            return;
+        }
+        fetch('/calculate_bets', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ bets: [values] })
+        })
+        .then(response => response.json())
+        .then(data => {
+            if (!data || data.error) return;
+            const bet = data.bets[0];
+            preview.textContent = `Lay ${bet.lay_stake.toFixed(2)} · Liability ${bet.liability.toFixed(2)} · ` +
+                `Profit ${bet.profit.toFixed(2)} (${(bet.roi * 100).toFixed(1)}%)`;
+        })
+        .catch(error => console.error("Error calculating bet:", error));
+    });
+}
+
+// Function to fetch data and initialize Handsontable with filters
+function initializeBetsHandsontable() {
+    fetchBetsPage(0).then(page => {
+        const container = document.getElementById('bets-table');
+        if (!page) {
+            container.innerHTML =
+                '<div class="alert alert-warning">No bet data available. The server may be unavailable or returned invalid data.</div>';
+            return;
+        }
+        if (page.total === 0) {
+            container.innerHTML =
+                '<div class="alert alert-info">No bets found. Add a bet to get started.</div>';
+            return;
+        }
+
+        container.innerHTML = '';
+        if (hot) {
+            hot.destroy();
+        }
+
+        let loadedRows = page.rows;   // Pages fetched so far
+        let totalRows = page.total;   // Rows matching the filters on the server
+        let loadingPage = false;
+        updateGridSummary(page);
+
+        const money = { type: 'numeric', numericFormat: { pattern: '0.00' } };
+        hot = new Handsontable(container, {
+            licenseKey: 'non-commercial-and-evaluation',
+            data: loadedRows,
+            columns: [
+                { data: 'id', type: 'numeric', readOnly: true },
+                { data: 'date', type: 'date', dateFormat: 'YYYY-MM-DD' },
+                { data: 'site', type: 'text' },
+                { data: 'bet', type: 'text' },
+                { data: 'kind', type: 'dropdown', source: ['qualifying', 'free'] },
+                Object.assign({ data: 'back_stake' }, money),
+                { data: 'back_odds', type: 'numeric' },
+                { data: 'lay_odds', type: 'numeric' },
+                { data: 'commission', type: 'numeric' },
+                Object.assign({ data: 'lay_stake', readOnly: true }, money),
+                Object.assign({ data: 'liability', readOnly: true }, money),
+                Object.assign({ data: 'profit', readOnly: true }, money),
+                { data: 'roi', type: 'numeric', numericFormat: { pattern: '0.0%' }, readOnly: true },
+                { data: 'result', type: 'dropdown', source: ['', 'back', 'lay'] },
+                { data: 'ref', type: 'text' },
+                { data: 'note', type: 'text' },
+                { data: null, renderer: deleteButtonRenderer, readOnly: true }
+            ],
+            colHeaders: ["ID", "Date", "Site", "Bet", "Kind", "Stake", "Site Odds", "Lay Odds", "Commission",
+                         "Lay Stake", "Liability", "Profit", "ROI", "Result", "Ref", "Note", ""],
+            rowHeaders: true,
+            height: 500, // Fixed height so only visible rows are rendered and scrolling loads more
+            manualColumnResize: true,
+            columnSorting: {
+                indicator: true
+            },
+            stretchH: 'all',
+
+            // Sorting is done by the server over the whole filtered set, not only the loaded pages
+            beforeColumnSort: function(currentSortConfig, destinationSortConfigs) {
+                const sortConfig = destinationSortConfigs[0];
+                const prop = sortConfig ? this.colToProp(sortConfig.column) : null;
+                if (typeof prop !== 'string') {
+                    gridQuery.sort = 'date';
+                    gridQuery.order = 'desc';
+                } else {
+                    gridQuery.sort = prop;
+                    gridQuery.order = sortConfig.sortOrder;
+                }
+                reloadGrid();
+                return false;
+            },
+
+            // Fetch the next page when the user scrolls near the end of the loaded rows
+            afterScrollVertically: function() {
+                const holder = container.querySelector('.wtHolder');
+                if (holder && holder.scrollTop + holder.clientHeight >= holder.scrollHeight - 200) {
+                    loadNextPage();
+                }
+            },
+
+            // Send the changed cells, a paste of new odds over many rows is one request
+            afterChange: function(changes, source) {
+                if (!changes) return;
+                if (!['edit', 'CopyPaste.paste', 'Autofill.fill'].includes(source)) return;
+                const cellChanges = [];
+                changes.forEach(([row, prop, oldValue, newValue]) => {
+                    if (oldValue === newValue) return;
+                    const rowData = hot.getSourceDataAtRow(hot.toPhysicalRow(row));
+                    if (!rowData || !rowData.id) return;
+                    cellChanges.push({ id: rowData.id, field: prop, value: newValue });
+                });
+                if (cellChanges.length > 0) {
+                    saveCellChangesToServer(cellChanges);
+                }
+            }
+        });
+
+        // Custom renderer for delete button
+        function deleteButtonRenderer(instance, td, row, col, prop, value, cellProperties) {
+            td.innerHTML = `<button class="delete-btn">🗑️</button>`;
+            td.classList.add("htCenter", "htMiddle");
+            setTimeout(() => {
+                const button = td.querySelector(".delete-btn");
+                if (button) {
+                    button.onclick = function () {
+                        deleteRow(row);
+                    };
+                }
+            }, 0);
+        }
+
+        // Append the next page of bets to the grid
+        function loadNextPage() {
+            if (loadingPage || loadedRows.length >= totalRows) return;
+            loadingPage = true;
+            fetchBetsPage(loadedRows.length).then(page => {
+                loadingPage = false;
+                if (!page) return;
+                loadedRows = loadedRows.concat(page.rows);
+                totalRows = page.total;
+                hot.updateData(loadedRows);
+            });
+        }
+
+        // Start again from the first page, after a sort, filter or delete
+        function reloadGrid() {
+            loadingPage = true;
+            fetchBetsPage(0).then(page => {
+                loadingPage = false;
+                if (!page) return;
+                loadedRows = page.rows;
+                totalRows = page.total;
+                updateGridSummary(page);
+                hot.updateData(loadedRows);
+            });
+        }
+
+        // Reload from the server whenever a filter changes
+        document.querySelectorAll('#grid-filters [data-filter]').forEach(input => {
+            $(input).on('change', function() {
+                gridQuery.filters[input.dataset.filter] = input.value;
+                reloadGrid();
+            });
+        });
+
+        // Function to delete row
+        function deleteRow(rowIndex) {
+            const rowData = hot.getSourceDataAtRow(rowIndex);
+            if (!rowData || !rowData.id) return;
+            if (!confirm("Are you sure you want to delete this bet?")) return;
+
+            fetch(`/delete_bet/${rowData.id}`, {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ version: rowData.version })
+            })
+            .then(response => response.json().then(data => {
+                if (response.status === 409) {
+                    applyServerRows(data.bets);
+                }
+                if (!data.success) {
+                    throw new Error(data.error || `Server responded with status: ${response.status}`);
+                }
+                reloadGrid();
+            }))
+            .catch(error => {
+                console.error("Error deleting bet:", error);
+                alert("Error deleting bet: " + error.message);
+            });
+        }
+    });
+}
+
+// Write rows sent back by the server into the grid by id. The 'server' source
+// keeps afterChange from treating them as edits.
+function applyServerRows(rows, fields) {
+    const sourceData = hot.getSourceData();
+    rows.forEach(serverRow => {
+        const physicalRow = sourceData.findIndex(row => row.id === serverRow.id);
+        if (physicalRow === -1) return;
+        (fields || Object.keys(serverRow)).forEach(field => {
+            hot.setSourceDataAtCell(physicalRow, field, serverRow[field], 'server');
+        });
+    });
+    hot.render();
+}
+
+// Saves are sent one at a time, so each one carries the row versions the previous one produced
+let saveQueue = Promise.resolve();
+
+// Edits made while a save is on its way, sent together as the next save
+let pendingChanges = [];
+
+function saveCellChangesToServer(cellChanges) {
+    if (pendingChanges.length === 0) {
+        saveQueue = saveQueue.then(() => {
+            const changes = coalesceCellChanges(pendingChanges);
+            pendingChanges = [];
+            return sendCellChanges(changes);
+        });
+    }
+    pendingChanges = pendingChanges.concat(cellChanges);
+}
+
+function sendCellChanges(cellChanges) {
+    const sourceData = hot.getSourceData();
+    const changes = cellChanges.map(change => {
+        const rowData = sourceData.find(row => row.id === change.id);
+        return { id: change.id, field: change.field, value: change.value, version: rowData ? rowData.version : undefined };
+    });
+
+    return fetch('/patch_bets', {
+        method: 'PATCH',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ changes: changes })
+    })
+    .then(response => response.json().then(data => {
+        if (response.status === 409) {
+            // Changed by someone else since it was loaded, show the current values
+            applyServerRows(data.bets);
+        }
+        if (!data.success) {
+            throw new Error(data.error || "Server error");
+        }
+        // The new lay stakes and profits come back with the saved bets
+        applyServerRows(data.bets, DERIVED_FIELDS.concat(['version']));
+    }))
+    .catch(error => {
+        console.error("Error saving bets:", error);
+        alert("Error saving bets: " + error.message);
+    });
+}
+
+// Initialize Select2 dropdowns, the site lists load from /search_items as the user types
+function initializeSelect2() {
+    $(document).ready(function() {
+        $('.select2').each(function() {
+            const kind = this.dataset.kind;
+            const options = {
+                placeholder: this.dataset.placeholder || "Select an option",
+                selectOnClose: true,
+                allowClear: true
+            };
+            if (kind) {
+                options.ajax = {
+                    url: '/search_items',
+                    dataType: 'json',
+                    delay: 150,
+                    data: params => ({
+                        kind: kind,
+                        q: params.term || '',
+                        page: params.page || 1
+                    })
+                };
+            }
+            $(this).select2(options);
+        });
+    });
+}
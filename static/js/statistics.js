@@ -0,0 +1,99 @@
+document.addEventListener("DOMContentLoaded", function() {
+    document.getElementById('stat-period').addEventListener('change', function() {
+        if (statistics) renderChart(statistics.series[this.value]);
+    });
+
+    loadStatistics();
+});
+
+let statistics = null; // Last statistics fetched from the server
+let chart = null;      // Chart.js instance for the time series
+
+// Function to fetch the statistics and fill in the page
+function loadStatistics() {
+    // The server answers 304 while the gambles are unchanged, the browser
+    // then serves its cached copy
+    return fetch('/get_statistics', { cache: 'no-cache' })
+        .then(response => response.json())
+        .then(data => {
+            if (!data || data.error) {
+                console.error("Error fetching statistics:", data && data.error);
+                return;
+            }
+            statistics = data;
+            renderTotals(data.totals);
+            renderChart(data.series[document.getElementById('stat-period').value]);
+            renderTable('stat-by-website', 'Website', data.by_website);
+            renderTable('stat-by-machine', 'Machine', data.by_machine);
+            renderTable('stat-by-free-win-machine', 'Free Win Machine', data.by_free_win_machine);
+        })
+        .catch(error => {
+            console.error("Error fetching statistics:", error);
+        });
+}
+
+function formatPercent(value) {
+    return (value * 100).toFixed(1) + '%';
+}
+
+function setAmount(element, value) {
+    element.textContent = value.toFixed(2);
+    element.classList.toggle('positive', value >= 0);
+    element.classList.toggle('negative', value < 0);
+}
+
+function renderTotals(totals) {
+    setAmount(document.getElementById('stat-profit'), totals.profit);
+    setAmount(document.getElementById('stat-free-win'), totals.free_win);
+    document.getElementById('stat-sessions').textContent = totals.sessions;
+    document.getElementById('stat-win-rate').textContent = formatPercent(totals.win_rate);
+    document.getElementById('stat-free-win-share').textContent =
+        `${totals.free_win_sessions} sessions · ${formatPercent(totals.free_win_share)} of profit`;
+}
+
+// Profit per period as bars, with the running total as a line
+function renderChart(series) {
+    const labels = Object.keys(series);
+    const profit = labels.map(label => series[label].profit);
+    const cumulative = labels.map(label => series[label].cumulative_profit);
+
+    if (chart) {
+        chart.data.labels = labels;
+        chart.data.datasets[0].data = profit;
+        chart.data.datasets[1].data = cumulative;
+        chart.update();
+        return;
+    }
+    chart = new Chart(document.getElementById('stat-chart'), {
+        data: {
+            labels: labels,
+            datasets: [
+                { type: 'bar', label: 'Profit', data: profit },
+                { type: 'line', label: 'Cumulative Profit', data: cumulative, pointRadius: 0 }
+            ]
+        },
+        options: { animation: false, interaction: { mode: 'index', intersect: false } }
+    });
+}
+
+// One row per group, with the most profitable groups first
+function renderTable(tableId, groupLabel, rollup) {
+    const table = document.getElementById(tableId);
+    const header = `<thead><tr><th>${groupLabel}</th><th>Sessions</th><th>Win Rate</th>` +
+        `<th>Win</th><th>Free Win</th><th>Profit</th></tr></thead>`;
+    const rows = Object.entries(rollup)
+        .sort((a, b) => b[1].profit - a[1].profit)
+        .map(([name, row]) => {
+            const cls = row.profit >= 0 ? 'positive' : 'negative';
+            return `<tr><td>${escapeHtml(name || '(none)')}</td><td>${row.sessions}</td>` +
+                `<td>${formatPercent(row.win_rate)}</td><td>${row.win.toFixed(2)}</td>` +
+                `<td>${row.free_win.toFixed(2)}</td><td class="${cls}">${row.profit.toFixed(2)}</td></tr>`;
+        });
+    table.innerHTML = header + '<tbody>' + rows.join('') + '</tbody>';
+}
+
+function escapeHtml(text) {
+    const div = document.createElement('div');
+    div.textContent = text;
+    return div.innerHTML;
+}
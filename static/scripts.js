@@ -15,3 +15,54 @@ window.onload = function() {
         }
     });
 };
+
+// Turn a page the grids fetched with format=columnar back into row objects.
+// Every column is a list of values, or a dictionary of distinct values with
+// one index per row, so no key is parsed more than once.
+function decodeColumnar(payload) {
+    const names = Object.keys(payload.columns);
+    const columns = names.map(name => {
+        const column = payload.columns[name];
+        return Array.isArray(column) ? column : column.codes.map(code => column.dictionary[code]);
+    });
+    const rows = new Array(payload.length);
+    for (let i = 0; i < payload.length; i++) {
+        const row = {};
+        for (let c = 0; c < names.length; c++) {
+            row[names[c]] = columns[c][i];
+        }
+        rows[i] = row;
+    }
+    return rows;
+}
+
+// Fold cell edits made while an earlier save was on its way into one list:
+// the last value typed into a cell wins, cells keep the order they were
+// first edited in
+function coalesceCellChanges(cellChanges) {
+    const cells = new Map();
+    cellChanges.forEach(change => cells.set(`${change.id}:${change.field}`, change));
+    return Array.from(cells.values());
+}
+
+// Undo ('undo') or redo ('redo') a saved change on the server by the id
+// the save answered with. Resolves to the server's answer, with the rows it
+// wrote (or, if they were edited since, their current values) under rows.
+function revertChange(action, changeId) {
+    return fetch(`/${action}/${changeId}`, { method: 'POST' })
+        .then(response => response.json());
+}
+
+// The first page of a grid: the one the server embedded in the page when it
+// is there (only used once, later loads see the current data), otherwise
+// fetched with fetchPage(0)
+function firstGridPage(fetchPage) {
+    const element = document.getElementById('grid-first-page');
+    if (!element) {
+        return fetchPage(0);
+    }
+    const page = JSON.parse(element.textContent);
+    element.remove();
+    page.rows = decodeColumnar(page.rows);
+    return Promise.resolve(page);
+}